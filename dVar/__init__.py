@@ -6,9 +6,15 @@ __license__='GPL version 3'
 __email__='deshaies.martin@sca.uqam.ca'
 
 from modelCovariances import *
+from metrics import *
+from instrumentation import *
 from observations import *
 from jTerm import *
 from obsJTerm import *
 from precondJTerm import *
+from binaryArchive import *
+from cycling import *
+from eda import *
 from spectralLib import *
+from randomLib import *
 from errorStruct import * 
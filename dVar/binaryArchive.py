@@ -0,0 +1,507 @@
+import numpy as np
+import os
+import sys
+import json
+import importlib
+from metrics import Metric, ScalarMetric, DiagMetric, DenseMetric, \
+                    BlockMetric, CholMetric, CovMetric, BandedCovMetric, \
+                    OperatorMetric
+from observations import StaticObs, TimeWindowObs
+from jTerm import JMinimum, LBFGSHistory, HessianEigen, ConvergenceRecorder
+from instrumentation import Instrument
+
+#   Binary archive format
+#   ---------------------
+#   An archive is a directory:
+#
+#       header.json     :   {"format" : "dVar-binary", "version" : 1,
+#                            "kind" : <object class>,
+#                            "arrays" : {name : {"file", "dtype",
+#                                                "shape"}},
+#                            "meta" : {...}}
+#       <name>.npy      :   one numpy array per field
+#
+#   Arrays are read on demand and memory-mapped (mmap=True): opening
+#   an archive only reads its header. Observation operators and
+#   metric operators are stored as "module:name" references (no
+#   pickled code), with their array arguments as fields. The header
+#   is written last: a directory without header is not an archive.
+
+ARCHIVE_FORMAT='dVar-binary'
+ARCHIVE_VERSION=1
+
+class ArchiveError(Exception):
+    pass
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class BinaryArchive(object):
+    '''
+    Read access to a binary archive directory
+
+        BinaryArchive(dirName, mmap=True)
+
+        arch.kind       :   archived object class <str>
+        arch.meta       :   scalar fields <dict>
+        arch.array(name):   array field (memory-mapped if mmap)
+    '''
+
+    #------------------------------------------------------
+    #----| Init |------------------------------------------
+    #------------------------------------------------------
+
+    def __init__(self, dirName, mmap=True):
+        headerFile=os.path.join(dirName, 'header.json')
+        if not os.path.isfile(headerFile):
+            raise ArchiveError("no archive header in %s"%dirName)
+        with open(headerFile) as f:
+            header=json.load(f)
+        if header.get('format')<>ARCHIVE_FORMAT:
+            raise ArchiveError("not a %s archive"%ARCHIVE_FORMAT)
+        if header['version']>ARCHIVE_VERSION:
+            raise ArchiveError("archive version %d > %d"%
+                                (header['version'], ARCHIVE_VERSION))
+        self.dirName=dirName
+        self.mmap=mmap
+        self.version=header['version']
+        self.kind=header['kind']
+        self.meta=header['meta']
+        self.index=header['arrays']
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    def hasArray(self, name):
+        return name in self.index
+
+    def array(self, name):
+        if not name in self.index:
+            raise ArchiveError("no array '%s'"%name)
+        fileName=os.path.join(self.dirName, self.index[name]['file'])
+        if self.mmap:
+            return np.load(fileName, mmap_mode='r')
+        return np.load(fileName)
+
+    def _checkKind(self, kind):
+        if self.kind<>kind:
+            raise ArchiveError("%s archive, not %s"%(self.kind, kind))
+
+    #------------------------------------------------------
+    #----| Classical overloads |---------------------------
+    #------------------------------------------------------
+
+    def __str__(self):
+        output="====| BinaryArchive |============================"
+        output+="\n %s (version %d)"%(self.kind, self.version)
+        output+="\n %s"%self.dirName
+        for name in sorted(self.index.keys()):
+            output+="\n  %-24s %s %s"%(name, self.index[name]['dtype'],
+                                        tuple(self.index[name]['shape']))
+        output+="\n================================================"
+        return output
+
+#---------------------------------------------------------------------
+
+def writeBinaryArchive(dirName, kind, arrays, meta, overwrite=False):
+    '''
+    Write a binary archive directory
+
+        kind        :   archived object class <str>
+        arrays      :   {name : <numpy.ndarray>}
+        meta        :   scalar fields (JSON serializable) <dict>
+        overwrite   :   replace the archive files (header.json, *.npy)
+                            of a non-empty directory; without it, a
+                            non-empty directory is refused
+    '''
+    headerFile=os.path.join(dirName, 'header.json')
+    if not os.path.isdir(dirName):
+        os.makedirs(dirName)
+    elif os.listdir(dirName):
+        if not overwrite:
+            raise ArchiveError("%s not empty (use overwrite=True)"%dirName)
+        if os.path.exists(headerFile):
+            # invalidated first: no header while rewritten
+            os.remove(headerFile)
+        for fileName in os.listdir(dirName):
+            if fileName.endswith('.npy'):
+                os.remove(os.path.join(dirName, fileName))
+    index={}
+    for name, a in arrays.items():
+        a=np.ascontiguousarray(a)
+        fileName=name+'.npy'
+        np.save(os.path.join(dirName, fileName), a)
+        index[name]={'file':fileName, 'dtype':a.dtype.str,
+                        'shape':list(a.shape)}
+    header={'format':ARCHIVE_FORMAT, 'version':ARCHIVE_VERSION, 
+            'kind':kind, 'arrays':index, 'meta':meta}
+    with open(headerFile, 'w') as f:
+        json.dump(header, f, indent=1, sort_keys=True)
+
+#=====================================================================
+#----| Encoding helpers |---------------------------------------------
+#=====================================================================
+
+def _funcRef(func):
+    if func==None:
+        return None
+    name=getattr(func, '__name__', '<lambda>')
+    module=sys.modules.get(getattr(func, '__module__', None), None)
+    # lambdas, closures, bound methods cannot be found back by name
+    if getattr(module, name, None) is not func:
+        raise ArchiveError("%s: module level function expected"%func)
+    return "%s:%s"%(func.__module__, name)
+
+def _funcResolve(ref):
+    if ref==None:
+        return None
+    module, name=ref.split(':')
+    return getattr(importlib.import_module(module), name)
+
+#---------------------------------------------------------------------
+
+def _encodeMetric(metric, prefix, arrays):
+    if isinstance(metric, ScalarMetric):
+        return {'type':'scalar', 'value':metric.value, 'n':metric.n}
+    elif isinstance(metric, DiagMetric):
+        arrays[prefix+'d']=metric.d
+        return {'type':'diag', 'd':prefix+'d'}
+    elif isinstance(metric, DenseMetric):
+        arrays[prefix+'matrix']=metric.matrix
+        return {'type':'dense', 'matrix':prefix+'matrix'}
+    elif isinstance(metric, CovMetric):
+        arrays[prefix+'R']=metric.R
+        return {'type':'cov', 'R':prefix+'R'}
+    elif isinstance(metric, CholMetric):
+        arrays[prefix+'L']=metric.L
+        return {'type':'chol', 'L':prefix+'L'}
+    elif isinstance(metric, BandedCovMetric):
+        arrays[prefix+'RBand']=metric.RBand
+        return {'type':'bandedCov', 'RBand':prefix+'RBand'}
+    elif isinstance(metric, BlockMetric):
+        return {'type':'block',
+                'blocks':[_encodeMetric(b, prefix+'%d_'%i, arrays)
+                            for i, b in enumerate(metric.blocks)]}
+    elif isinstance(metric, OperatorMetric):
+        args=[]
+        for i, a in enumerate(metric.args):
+            if isinstance(a, np.ndarray):
+                arrays[prefix+'arg%d'%i]=a
+                args.append({'array':prefix+'arg%d'%i})
+            else:
+                try:
+                    json.dumps(a)
+                except TypeError:
+                    raise ArchiveError("OperatorMetric args: "+
+                            "numpy.ndarray or JSON serializable expected")
+                args.append({'value':a})
+        return {'type':'operator', 'op':_funcRef(metric.op), 
+                'n':metric.n, 'batched':metric.batched, 'args':args}
+    else:
+        raise ArchiveError("%s cannot be archived"%type(metric).__name__)
+
+def _decodeMetric(desc, arch):
+    mType=desc['type']
+    if mType=='scalar':
+        return ScalarMetric(desc['value'], desc['n'])
+    elif mType=='diag':
+        return DiagMetric(arch.array(desc['d']))
+    elif mType=='dense':
+        return DenseMetric(arch.array(desc['matrix']))
+    elif mType=='cov':
+        return CovMetric(np.array(arch.array(desc['R'])))
+    elif mType=='chol':
+        return CholMetric(np.array(arch.array(desc['L'])))
+    elif mType=='bandedCov':
+        return BandedCovMetric(np.array(arch.array(desc['RBand'])))
+    elif mType=='block':
+        return BlockMetric([_decodeMetric(b, arch) for b in desc['blocks']])
+    elif mType=='operator':
+        args=tuple(np.array(arch.array(a['array'])) if 'array' in a 
+                    else a['value'] for a in desc['args'])
+        return OperatorMetric(_funcResolve(desc['op']), desc['n'], 
+                                args=args, batched=desc['batched'])
+    else:
+        raise ArchiveError("unknown metric type '%s'"%mType)
+
+#---------------------------------------------------------------------
+
+def _encodeObsOp(obs):
+    try:
+        json.dumps(obs.obsOpArgs)
+    except TypeError:
+        raise ArchiveError("obsOpArgs: JSON serializable expected")
+    return {'obsOp':_funcRef(obs.obsOp),
+            'obsOpTLMAdj':_funcRef(obs.obsOpTLMAdj),
+            'obsOpArgs':list(obs.obsOpArgs)}
+
+def _staticObs(coord, values, desc, arch):
+    return StaticObs(coord, values,
+                        obsOp=_funcResolve(desc['obsOp']),
+                        obsOpTLMAdj=_funcResolve(desc['obsOpTLMAdj']),
+                        obsOpArgs=tuple(desc['obsOpArgs']),
+                        metric=_decodeMetric(desc['metric'], arch))
+
+#---------------------------------------------------------------------
+
+def _encodeHessInv(BOpt, prefix, arrays):
+    if BOpt is None:
+        return None
+    elif isinstance(BOpt, np.ndarray):
+        arrays[prefix+'matrix']=BOpt
+        return {'type':'dense', 'matrix':prefix+'matrix'}
+    elif isinstance(BOpt, LBFGSHistory):
+        arrays[prefix+'sk']=np.reshape(BOpt.sk, (BOpt.m, BOpt.N))
+        arrays[prefix+'yk']=np.reshape(BOpt.yk, (BOpt.m, BOpt.N))
+        return {'type':'lbfgs', 'sk':prefix+'sk', 'yk':prefix+'yk'}
+    elif isinstance(BOpt, HessianEigen):
+        arrays[prefix+'eigVals']=BOpt.eigVals
+        arrays[prefix+'eigVecs']=BOpt.eigVecs
+        return {'type':'eigen',
+                'eigVals':prefix+'eigVals', 'eigVecs':prefix+'eigVecs',
+                'base':_encodeHessInv(BOpt.base, prefix+'base_', arrays)}
+    else:
+        raise ArchiveError(
+                "BOpt <None | numpy.ndarray | LBFGSHistory | HessianEigen>")
+
+def _decodeHessInv(desc, arch):
+    if desc==None:
+        return None
+    hType=desc['type']
+    if hType=='dense':
+        return arch.array(desc['matrix'])
+    elif hType=='lbfgs':
+        return LBFGSHistory(list(arch.array(desc['sk'])),
+                            list(arch.array(desc['yk'])))
+    elif hType=='eigen':
+        return HessianEigen(arch.array(desc['eigVals']),
+                            arch.array(desc['eigVecs']),
+                            base=_decodeHessInv(desc['base'], arch))
+    else:
+        raise ArchiveError("unknown BOpt type '%s'"%hType)
+
+#=====================================================================
+#----| StaticObs |----------------------------------------------------
+#=====================================================================
+
+def saveStaticObs(obs, dirName, overwrite=False):
+    if not isinstance(obs, StaticObs):
+        raise TypeError("obs <StaticObs>")
+    arrays={'coord':np.asarray(obs.coord, dtype=float),
+            'values':np.asarray(obs.values, dtype=float)}
+    desc=_encodeObsOp(obs)
+    desc['metric']=_encodeMetric(obs.metric, 'metric_', arrays)
+    writeBinaryArchive(dirName, 'StaticObs', arrays, desc, 
+                        overwrite=overwrite)
+
+def openStaticObs(dirName, mmap=True):
+    '''
+    StaticObs from a binary archive (arrays memory-mapped if mmap)
+    '''
+    arch=BinaryArchive(dirName, mmap=mmap)
+    arch._checkKind('StaticObs')
+    return _staticObs(arch.array('coord'), arch.array('values'),
+                        arch.meta, arch)
+
+#=====================================================================
+#----| TimeWindowObs |------------------------------------------------
+#=====================================================================
+
+def saveTWObs(twObs, dirName, overwrite=False):
+    '''
+    Columnar archive of a TimeWindowObs: stacked coordinates and
+    values, one slice per time (see TimeWindowObs.offsets)
+    '''
+    if not isinstance(twObs, TimeWindowObs):
+        raise TypeError("twObs <TimeWindowObs>")
+    arrays={'times':np.asarray(twObs.times, dtype=float),
+            'offsets':twObs.offsets,
+            'coord':twObs.stackedCoord,
+            'values':twObs.stackedValues}
+    obsDesc=[]
+    for i, t in enumerate(twObs.times):
+        desc=_encodeObsOp(twObs[t])
+        desc['metric']=_encodeMetric(twObs[t].metric, 'metric%d_'%i,
+                                        arrays)
+        obsDesc.append(desc)
+    writeBinaryArchive(dirName, 'TimeWindowObs', arrays,
+                        {'obs':obsDesc}, overwrite=overwrite)
+
+#---------------------------------------------------------------------
+
+class TWObsArchive(object):
+    '''
+    Lazy TimeWindowObs archive
+
+        arch=openTWObs(dirName, mmap=True)
+
+        arch.times          :   observation times <numpy.ndarray>
+        arch[t]             :   <StaticObs> of time t only (slices of
+                                the memory-mapped stacked arrays)
+        arch.load(times)    :   <TimeWindowObs> of the given times
+                                (default: all)
+
+        Times are matched within timeTol (relative): a time computed
+        as t0+k*dt finds its archived observations.
+    '''
+
+    timeTol=1e-9
+
+    #------------------------------------------------------
+    #----| Init |------------------------------------------
+    #------------------------------------------------------
+
+    def __init__(self, dirName, mmap=True):
+        self.archive=BinaryArchive(dirName, mmap=mmap)
+        self.archive._checkKind('TimeWindowObs')
+        self.times=np.array(self.archive.array('times'))
+        self.offsets=np.array(self.archive.array('offsets'))
+        self.nTimes=len(self.times)
+        self.nObs=int(self.offsets[-1])
+        self.__coord=None
+        self.__values=None
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    def timeIndex(self, t):
+        '''
+        Index of the archived time t (KeyError if absent)
+        '''
+        i=np.where(np.isclose(self.times, t, rtol=self.timeTol, 
+                                atol=self.timeTol))[0]
+        if len(i)==0:
+            raise KeyError(t)
+        return i[np.argmin(np.abs(self.times[i]-t))]
+
+    #------------------------------------------------------
+
+    def load(self, times=None):
+        if times is None:
+            times=self.times
+        d_Obs={}
+        for t in times:
+            d_Obs[self.times[self.timeIndex(t)]]=self[t]
+        return TimeWindowObs(d_Obs)
+
+    #------------------------------------------------------
+    #----| Classical overloads |---------------------------
+    #------------------------------------------------------
+
+    def __getitem__(self, t):
+        i=self.timeIndex(t)
+        if self.__coord is None:
+            self.__coord=self.archive.array('coord')
+            self.__values=self.archive.array('values')
+        sl=slice(self.offsets[i], self.offsets[i+1])
+        return _staticObs(self.__coord[sl], self.__values[sl],
+                            self.archive.meta['obs'][i], self.archive)
+
+    def __len__(self):
+        return self.nTimes
+
+def openTWObs(dirName, mmap=True):
+    return TWObsArchive(dirName, mmap=mmap)
+
+#=====================================================================
+#----| JMinimum |-----------------------------------------------------
+#=====================================================================
+
+def saveJMinimum(jMin, dirName, overwrite=False):
+    if not isinstance(jMin, JMinimum):
+        raise TypeError("jMin <JMinimum>")
+    arrays={'xOpt':jMin.xOpt, 'gOpt':jMin.gOpt}
+    meta={'fOpt':float(jMin.fOpt), 'fCalls':int(jMin.fCalls),
+            'gCalls':int(jMin.gCalls), 'warnFlag':int(jMin.warnFlag),
+            'maxiter':int(jMin.maxiter)}
+    if jMin.allvecs<>None:
+        arrays['allvecs']=np.array(jMin.allvecs)
+    if jMin.convergence<>None:
+        arrays['convergence']=np.array(jMin.convergence, dtype=float)
+    meta['BOpt']=_encodeHessInv(jMin.BOpt, 'BOpt_', arrays)
+    history=jMin.history
+    if history<>None:
+        meta['history']={'storeIterates':history.storeIterates}
+        arrays['history_J']=np.array(history.J, dtype=float)
+        arrays['history_gradNorm']=np.array(history.gradNorm, dtype=float)
+        arrays['history_wallTime']=np.array(history.wallTime, dtype=float)
+        if history.storeIterates:
+            arrays['history_iterates']=np.array(history.iterates)
+    if jMin.instrumentation<>None:
+        meta['instrumentation']=jMin.instrumentation.report()
+    writeBinaryArchive(dirName, 'JMinimum', arrays, meta,
+                        overwrite=overwrite)
+
+#---------------------------------------------------------------------
+
+class JMinimumArchive(object):
+    '''
+    Lazy JMinimum archive: each field is read on first access
+
+        arch=openJMinimum(dirName, mmap=True)
+        arch.xOpt           :   reads xOpt only
+        arch.allvecs        :   (nIter, N) memory-mapped array
+        arch.instrumentation:   <Instrument | None> (from its report)
+        arch.load()         :   <JMinimum>
+    '''
+
+    _arrayFields=('xOpt', 'gOpt', 'allvecs')
+
+    def __init__(self, dirName, mmap=True):
+        self.archive=BinaryArchive(dirName, mmap=mmap)
+        self.archive._checkKind('JMinimum')
+        for name in ('fOpt', 'fCalls', 'gCalls', 'warnFlag', 'maxiter'):
+            setattr(self, name, self.archive.meta[name])
+
+    def __getattr__(self, name):
+        # fields not yet read
+        if name in self._arrayFields:
+            if self.archive.hasArray(name):
+                value=self.archive.array(name)
+            else:
+                value=None
+        elif name=='convergence':
+            if self.archive.hasArray(name):
+                value=list(self.archive.array(name))
+            else:
+                value=None
+        elif name=='BOpt':
+            value=_decodeHessInv(self.archive.meta['BOpt'], self.archive)
+        elif name=='history':
+            value=self.__history()
+        elif name=='instrumentation':
+            report=self.archive.meta.get('instrumentation', None)
+            if report==None:
+                value=None
+            else:
+                value=Instrument.fromReport(report)
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+    def __history(self):
+        desc=self.archive.meta.get('history', None)
+        if desc==None:
+            return None
+        history=ConvergenceRecorder(storeIterates=desc['storeIterates'])
+        history.J=list(self.archive.array('history_J'))
+        history.gradNorm=list(self.archive.array('history_gradNorm'))
+        history.wallTime=list(self.archive.array('history_wallTime'))
+        if history.storeIterates:
+            history.iterates=list(self.archive.array('history_iterates'))
+        return history
+
+    def load(self):
+        return JMinimum(self.xOpt, self.fOpt, self.gOpt, self.BOpt,
+                        self.fCalls, self.gCalls,
+                        self.warnFlag, self.maxiter,
+                        allvecs=self.allvecs, convergence=self.convergence,
+                        history=self.history, 
+                        instrumentation=self.instrumentation)
+
+def openJMinimum(dirName, mmap=True):
+    return JMinimumArchive(dirName, mmap=mmap)
@@ -1,6 +1,17 @@
 import numpy as np
 
-def c2r(csp):
+#   All injections act along the last axis: a leading batch axis
+#   (e.g. (nMembers, N)) is transformed in one call. The result is
+#   written in out (same shape as the result) when given.
+
+def _outArray(shape, dtype, out):
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if out.shape<>shape:
+        raise ValueError("out.shape==%s"%(shape,))
+    return out
+
+def c2r(csp, out=None):
     """
     Real to complex (hermitian signal)
 
@@ -11,38 +22,43 @@ def c2r(csp):
 
         csp=[c_0, c_1, c_2, ..., c_{N-1}]
         rsp=[a_0, a_1, b_1, a_2, b_2, ..., a_{(N-1)/2+1}, b_{(N-1)/2+1}]
-        
+
         csp.shape=(N+1)
         rsp.shape=(N+1)
     """
-    N=len(csp)-1
-    rsp=np.zeros(N+1)
-    rsp[0]=csp[0].real
-    for i in xrange(1,N/2+1):
-        rsp[2*i-1]    =2.*csp[i].real
-        rsp[2*i]      =2.*csp[i].imag
+    csp=np.asarray(csp)
+    nDemi=(csp.shape[-1]-1)//2
+    rsp=_outArray(csp.shape, float, out)
+    rsp[...,0]=csp[...,0].real
+    rsp[...,1:2*nDemi+1:2]=2.*csp[...,1:nDemi+1].real
+    rsp[...,2:2*nDemi+1:2]=2.*csp[...,1:nDemi+1].imag
+    rsp[...,2*nDemi+1:]=0.
     return rsp
 
-def r2c(rsp):
-    N=len(rsp)-1
-    csp=np.zeros(N+1, dtype=complex)
-    csp[0]=rsp[0]
-    for i in xrange(1,N/2+1):
-        csp[i]     =0.5*(rsp[2*i-1]+1j*rsp[2*i])
-        csp[N-i+1]   =0.5*(rsp[2*i-1]-1j*rsp[2*i])
+def r2c(rsp, out=None):
+    rsp=np.asarray(rsp)
+    n=rsp.shape[-1]
+    nDemi=(n-1)//2
+    csp=_outArray(rsp.shape, complex, out)
+    csp[...,0]=rsp[...,0]
+    csp.real[...,1:nDemi+1]=0.5*rsp[...,1:2*nDemi+1:2]
+    csp.imag[...,1:nDemi+1]=0.5*rsp[...,2:2*nDemi+1:2]
+    csp[...,nDemi+1:n-nDemi]=0.
+    csp[...,n-nDemi:]=csp[...,nDemi:0:-1].conj()
     return csp
 
-def r2c_Adj(csp):
-    N=len(csp)-1
-    rsp=np.zeros(N+1)
-    for i in xrange(1, N/2+1):
-        rsp[2*i-1]  =csp[i].real
-        rsp[2*i]    =csp[i].imag
-        # <!> carefull here: complex conjugate necessary!
-    rsp[0]=csp[0].real
+def r2c_Adj(csp, out=None):
+    csp=np.asarray(csp)
+    nDemi=(csp.shape[-1]-1)//2
+    rsp=_outArray(csp.shape, float, out)
+    rsp[...,1:2*nDemi+1:2]=csp[...,1:nDemi+1].real
+    rsp[...,2:2*nDemi+1:2]=csp[...,1:nDemi+1].imag
+    # <!> carefull here: complex conjugate necessary!
+    rsp[...,0]=csp[...,0].real
+    rsp[...,2*nDemi+1:]=0.
     return rsp
 
 
 def rTrunc(rsp, Ntrc):
-    rsp[2*Ntrc+1:]=0.
+    rsp[...,2*Ntrc+1:]=0.
     return rsp
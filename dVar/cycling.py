@@ -0,0 +1,279 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.pool import MaybeEncodingError
+from observations import TimeWindowObs
+from jTerm import JTerm
+from precondJTerm import PrecondTWObsJTerm
+
+#   Assimilation cycles are sequential: the background of a window is
+#   the forecast of the previous analysis, so the minimization and
+#   the background forecast of each window stay on the critical path.
+#   What does not depend on the analysis runs in a pool of worker
+#   processes while the minimization of window k goes on: the
+#   extraction of the observations of window k+1 and the extended
+#   forecasts of the past analyses. The workers are forked with their
+#   own copy of the model and of the observation record (set by the
+#   pool initializer): only the window bounds, the analyses and the
+#   results are pickled.
+
+def windowObs(obs, t0, tf):
+    '''
+    Observations of the window ]t0, tf] <TimeWindowObs>
+
+        (TimeWindowObs.window(): binary search in the sorted times,
+         slices of the columnar arrays)
+    '''
+    if not isinstance(obs, TimeWindowObs):
+        raise TypeError("obs <TimeWindowObs>")
+    return obs.window(t0, tf)
+
+_fcstModel=None
+_obsRecord=None
+
+def _initWorker(nlModel, obs):
+    global _fcstModel, _obsRecord
+    _fcstModel=nlModel
+    _obsRecord=obs
+
+def _fcstIntegrate(task):
+    x, tInt, t0=task
+    return _fcstModel.integrate(x, tInt, t0=t0)
+
+def _windowObsTask(task):
+    t0, tf=task
+    return windowObs(_obsRecord, t0, tf)
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class CycleResult(object):
+    '''
+    One assimilation cycle
+
+        t0, tf      :   window ]t0, tf]
+        bkg         :   background at t0
+        analysis    :   analysis at t0
+        minimum     :   <JMinimum | None> (None: no observation)
+        nObs        :   number of observations in the window
+        forecast()  :   extended forecast from the analysis
+                            <Trajectory | None>
+                        (waits for the worker process)
+    '''
+
+    def __init__(self, t0, tf, bkg, analysis, minimum, nObs,
+                    forecast=None):
+        self.t0=t0
+        self.tf=tf
+        self.bkg=bkg
+        self.analysis=analysis
+        self.minimum=minimum
+        self.nObs=nObs
+        self.__forecast=forecast
+
+    def forecast(self):
+        if self.__forecast==None:
+            return None
+        return self.__forecast.get()
+
+    def __str__(self):
+        output="____| CycleResult |_________________________"
+        output+="\n   window=]%f, %f]"%(self.t0, self.tf)
+        output+="\n   nObs=%d"%self.nObs
+        if self.minimum<>None:
+            output+="\n   function value=%f"%self.minimum.fOpt
+        output+="\n____________________________________________"
+        return output
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class AssimCycling(object):
+    '''
+    Sequential assimilation cycles over a long observation record
+
+        AssimCycling(obs, nlModel, tlm, x_bkg0, B_sqrt, B_sqrtAdj, tWin,
+                        B_sqrtArgs=(), t0=0., nCycles=None,
+                        JTermClass=PrecondTWObsJTerm, minimizeArgs=None,
+                        fcstLength=None, nWorkers=2)
+
+        obs             :   observation record <TimeWindowObs>
+        nlModel         :   propagator model <Launcher>
+        tlm             :   tangean linear model <TLMLauncher>
+        x_bkg0          :   background of the first window
+                                <numpy.ndarray>
+        B_sqrt          :   preconditionning operator <function>
+        B_sqrtAdj       :   adjoint of preconditionning op. <function>
+        tWin            :   window length
+        B_sqrtArgs      :   arguments <tuple>
+        t0              :   start of the first window
+        nCycles         :   number of windows <None | int>
+                                (None: up to obs.tMax)
+        JTermClass      :   JTerm built for each window, with
+                                PrecondTWObsJTerm arguments
+        minimizeArgs    :   JTermClass.minimize() keywords <dict>
+        fcstLength      :   extended forecast length from each
+                                analysis <None | float>
+        nWorkers        :   worker processes (observations of the
+                                next window, extended forecasts)
+
+        Window k is ]t0+k*tWin, t0+(k+1)*tWin]: its analysis,
+        integrated with nlModel over tWin, is the background of
+        window k+1.
+
+        for res in cycling.cycles(): ...    # <CycleResult> generator
+        results=cycling.run()               # all of them
+    '''
+
+    #------------------------------------------------------
+    #----| Init |------------------------------------------
+    #------------------------------------------------------
+
+    def __init__(self, obs, nlModel, tlm, x_bkg0, B_sqrt, B_sqrtAdj,
+                    tWin, B_sqrtArgs=(), t0=0., nCycles=None,
+                    JTermClass=PrecondTWObsJTerm, minimizeArgs=None,
+                    fcstLength=None, nWorkers=2):
+
+        if not isinstance(obs, TimeWindowObs):
+            raise TypeError("obs <TimeWindowObs>")
+        self.obs=obs
+        self.nlModel=nlModel
+        self.tlm=tlm
+
+        if not isinstance(x_bkg0, np.ndarray):
+            raise TypeError("x_bkg0 <numpy.ndarray>")
+        self.x_bkg0=x_bkg0
+
+        if not (callable(B_sqrt) and callable(B_sqrtAdj)):
+            raise TypeError("B_sqrt[Adj] <function>")
+        if not isinstance(B_sqrtArgs, tuple):
+            raise TypeError("B_sqrtArgs <tuple>")
+        self.B_sqrt=B_sqrt
+        self.B_sqrtAdj=B_sqrtAdj
+        self.B_sqrtArgs=B_sqrtArgs
+
+        if not tWin>0.:
+            raise ValueError("tWin>0.")
+        self.tWin=float(tWin)
+        self.t0=float(t0)
+        if nCycles==None:
+            if obs.empty:
+                nCycles=0
+            else:
+                nCycles=int(np.ceil((obs.tMax-self.t0)/self.tWin-1e-9))
+        if not (isinstance(nCycles, int) and nCycles>=0):
+            raise ValueError("nCycles <int> >=0")
+        self.nCycles=nCycles
+
+        if not issubclass(JTermClass, JTerm):
+            raise TypeError("JTermClass <JTerm subclass>")
+        self.JTermClass=JTermClass
+        if minimizeArgs==None:
+            minimizeArgs={}
+        if not isinstance(minimizeArgs, dict):
+            raise TypeError("minimizeArgs <dict>")
+        self.minimizeArgs=minimizeArgs
+
+        if not (fcstLength==None or fcstLength>0.):
+            raise ValueError("fcstLength <None | float> >0.")
+        self.fcstLength=fcstLength
+
+        if not (isinstance(nWorkers, int) and nWorkers>0):
+            raise ValueError("nWorkers <int> >0")
+        self.nWorkers=nWorkers
+
+    #------------------------------------------------------
+    #----| Private methods |-------------------------------
+    #------------------------------------------------------
+
+    def __fetchObs(self, asyncObs, tStart, tEnd):
+        try:
+            return asyncObs.get()
+        except MaybeEncodingError:
+            # observation operators that cannot be pickled
+            # (e.g. lambdas): extracted in the main process
+            return windowObs(self.obs, tStart, tEnd)
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    def window(self, k):
+        '''
+        Bounds (t0, tf) of the k-th window
+        '''
+        tStart=self.t0+k*self.tWin
+        return tStart, tStart+self.tWin
+
+    #------------------------------------------------------
+
+    def cycles(self):
+        '''
+        Assimilation cycles <CycleResult> generator
+
+            While window k is minimized, the workers extract the
+            observations of window k+1 and run the extended
+            forecasts of the previous analyses.
+        '''
+        if self.nCycles==0:
+            return
+        # forked workers: each one keeps its copy of nlModel and obs
+        pool=mp.Pool(min(self.nWorkers, self.nCycles),
+                        initializer=_initWorker,
+                        initargs=(self.nlModel, self.obs))
+        try:
+            xb=self.x_bkg0
+            nextObs=pool.apply_async(_windowObsTask, (self.window(0),))
+            for k in xrange(self.nCycles):
+                tStart, tEnd=self.window(k)
+                obs=self.__fetchObs(nextObs, tStart, tEnd)
+                if k+1<self.nCycles:
+                    # prefetch: runs during the minimization
+                    nextObs=pool.apply_async(_windowObsTask, 
+                                                (self.window(k+1),))
+
+                if obs.empty:
+                    xa, minimum=xb, None
+                else:
+                    J=self.JTermClass(obs, self.nlModel, self.tlm,
+                                xb, self.B_sqrt, self.B_sqrtAdj,
+                                self.B_sqrtArgs, t0=tStart, tf=tEnd)
+                    J.minimize(**self.minimizeArgs)
+                    xa, minimum=J.analysis, J.minimum
+
+                if self.fcstLength==None:
+                    fcst=None
+                else:
+                    fcst=pool.apply_async(_fcstIntegrate,
+                                    ((xa, self.fcstLength, tStart),))
+
+                # the next background: needed before the next window
+                traj=self.nlModel.integrate(xa, self.tWin, t0=tStart)
+                yield CycleResult(tStart, tEnd, xb, xa, minimum,
+                                    obs.nObs, forecast=fcst)
+                xb=traj.whereTime(tEnd)
+        finally:
+            pool.close()
+            pool.join()
+
+    #------------------------------------------------------
+
+    def run(self):
+        '''
+        All assimilation cycles <list of CycleResult>
+        '''
+        return list(self.cycles())
+
+    #------------------------------------------------------
+    #----| Classical overloads |----------------------------
+    #-------------------------------------------------------
+
+    def __str__(self):
+        output="////| AssimCycling |//////////////////////////////////////"
+        output+="\n first window=]%f, %f]"%self.window(0)
+        output+="\n nCycles=%d"%self.nCycles
+        output+="\n JTermClass=%s"%self.JTermClass.__name__
+        output+="\n nWorkers=%d"%self.nWorkers
+        output+="\n///////////////////////////////////////////////////////////\n"
+        return output
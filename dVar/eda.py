@@ -0,0 +1,261 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
+from observations import StaticObs, TimeWindowObs, degrad
+from jTerm import JMinimum
+from precondJTerm import PrecondTWObsJTerm
+from randomLib import spawnRNGs
+
+#   Members run in forked worker processes: the runner is published in
+#   the module global _edaRunner before the pool is created, so that
+#   models, operators and observations are inherited instead of being
+#   pickled for each member. Large arrays (background, observation
+#   values and errors, B_sqrt arguments) and the analysis/background
+#   ensembles live in shared memory (RawArray): members write their
+#   states in place and only return a light JMinimum.
+
+def _sharedArray(a):
+    '''
+    Copy of a in shared memory <numpy.ndarray>
+    '''
+    a=np.asarray(a, dtype=float)
+    shared=np.frombuffer(RawArray('d', max(a.size, 1)))[:a.size]
+    shared[:]=a.ravel()
+    return shared.reshape(a.shape)
+
+def _sharedArgs(args):
+    return tuple(_sharedArray(a) if isinstance(a, np.ndarray) else a
+                    for a in args)
+
+def _minimumSummary(minimum):
+    '''
+    JMinimum without iterates nor inverse Hessian
+    '''
+    return JMinimum(minimum.xOpt, minimum.fOpt, minimum.gOpt, None,
+                    minimum.fCalls, minimum.gCalls, minimum.warnFlag,
+                    minimum.maxiter, convergence=minimum.convergence)
+
+_edaRunner=None
+
+def _edaMember(task):
+    i, rng=task
+    return _edaRunner._member(i, rng)
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class EDAResult(object):
+    '''
+    Ensemble of data assimilations result
+
+        analyses    :   (nMembers, N) analysis ensemble
+        bkgs        :   (nMembers, N) perturbed backgrounds
+        minima      :   per member <list of JMinimum> (without
+                            iterates nor inverse Hessian)
+
+        mean(), std()   :   analysis ensemble statistics
+    '''
+
+    def __init__(self, analyses, bkgs, minima):
+        self.analyses=analyses
+        self.bkgs=bkgs
+        self.minima=minima
+        self.nMembers=len(minima)
+
+    def mean(self):
+        return self.analyses.mean(axis=0)
+
+    def std(self):
+        return self.analyses.std(axis=0, ddof=1)
+
+    def __str__(self):
+        output="____| EDAResult |___________________________"
+        output+="\n   nMembers=%d"%self.nMembers
+        output+="\n   mean function value=%f"%np.mean(
+                                        [m.fOpt for m in self.minima])
+        output+="\n   mean spread=%f"%self.std().mean()
+        output+="\n____________________________________________"
+        return output
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class EDARunner(object):
+    '''
+    Ensemble of data assimilations (perturbed 4D-Var members)
+
+        EDARunner(obs, nlModel, tlm, x_bkg, B_sqrt, B_sqrtAdj,
+                    B_sqrtArgs=(), nMembers=10, obsSig=None,
+                    t0=0., tf=None, seed=None, minimizeArgs=None,
+                    nProc=None)
+
+        obs             :   <TimeWindowObs>
+        nlModel         :   propagator model <Launcher>
+        tlm             :   tangean linear model <TLMLauncher>
+        x_bkg           :   background state <numpy.ndarray>
+        B_sqrt          :   preconditionning operator <function>
+        B_sqrtAdj       :   adjoint of preconditionning op. <function>
+        B_sqrtArgs      :   arguments <tuple>
+        nMembers        :   ensemble size
+        obsSig          :   observation error standard deviations
+                                <None | float | numpy.ndarray>
+                                (None: errors R^{1/2}.eta drawn
+                                 from obs.metric=R^{-1}, correlations
+                                 included)
+        seed            :   <None | int> member i only depends on
+                                (seed, i) (see spawnRNGs)
+        minimizeArgs    :   PrecondTWObsJTerm.minimize() keywords
+                                <dict> (members default to 
+                                disp=False, testGrad=False)
+        nProc           :   worker processes (default: cpu count)
+
+        Member i assimilates the observations perturbed by degrad()
+        (by obs.metric.covSqrtDot() when obsSig is None) from the
+        background x_bkg+B^{1/2}.xi, xi~N(0,I) (as errStr_isoHomo
+        with the B_sqrt_isoHomo_op operator).
+
+        result=EDARunner(...).run()     # <EDAResult>
+    '''
+
+    # quiet members: no summary nor gradient test from each worker
+    memberMinimizeDefaults={'disp':False, 'testGrad':False}
+
+    #------------------------------------------------------
+    #----| Init |------------------------------------------
+    #------------------------------------------------------
+
+    def __init__(self, obs, nlModel, tlm, x_bkg, B_sqrt, B_sqrtAdj,
+                    B_sqrtArgs=(), nMembers=10, obsSig=None,
+                    t0=0., tf=None, seed=None, minimizeArgs=None,
+                    nProc=None):
+
+        if not isinstance(obs, TimeWindowObs):
+            raise TypeError("obs <TimeWindowObs>")
+        if obs.empty:
+            raise ValueError("obs.empty==False")
+        self.obs=obs
+        self.nlModel=nlModel
+        self.tlm=tlm
+
+        if not isinstance(x_bkg, np.ndarray):
+            raise TypeError("x_bkg <numpy.ndarray>")
+        self.N=len(x_bkg)
+
+        if not (callable(B_sqrt) and callable(B_sqrtAdj)):
+            raise TypeError("B_sqrt[Adj] <function>")
+        if not isinstance(B_sqrtArgs, tuple):
+            raise TypeError("B_sqrtArgs <tuple>")
+        self.B_sqrt=B_sqrt
+        self.B_sqrtAdj=B_sqrtAdj
+
+        if not (isinstance(nMembers, int) and nMembers>1):
+            raise ValueError("nMembers <int> >1")
+        self.nMembers=nMembers
+
+        if obsSig is not None:
+            obsSig=obsSig*np.ones(obs.nObs)
+            if obsSig.shape<>(obs.nObs,):
+                raise ValueError("obsSig.shape==(obs.nObs,)")
+
+        self.t0=t0
+        self.tf=tf
+        self.seed=seed
+        if minimizeArgs==None:
+            minimizeArgs={}
+        if not isinstance(minimizeArgs, dict):
+            raise TypeError("minimizeArgs <dict>")
+        self.minimizeArgs=minimizeArgs
+
+        if nProc==None:
+            nProc=mp.cpu_count()
+        if not (isinstance(nProc, int) and nProc>0):
+            raise ValueError("nProc <int> >0")
+        self.nProc=nProc
+
+        #----| Shared memory |--------------------
+        self.x_bkg=_sharedArray(x_bkg)
+        self.B_sqrtArgs=_sharedArgs(B_sqrtArgs)
+        self.obsValues=_sharedArray(obs.stackedValues)
+        if obsSig is None:
+            self.obsSig=None
+        else:
+            self.obsSig=_sharedArray(obsSig)
+
+    #------------------------------------------------------
+    #----| Private methods |-------------------------------
+    #------------------------------------------------------
+
+    def __memberObs(self, values):
+        d_Obs={}
+        for k, t in enumerate(self.obs.times):
+            ob=self.obs.d_Obs[t]
+            sl=slice(self.obs.offsets[k], self.obs.offsets[k+1])
+            d_Obs[t]=StaticObs(ob.coord, values[sl], obsOp=ob.obsOp,
+                                obsOpTLMAdj=ob.obsOpTLMAdj,
+                                obsOpArgs=ob.obsOpArgs, metric=ob.metric)
+        return TimeWindowObs(d_Obs)
+
+    def _member(self, i, rng):
+        '''
+        i-th member: perturbed 4D-Var with the random stream rng
+        '''
+        xb=self.x_bkg+self.B_sqrt(rng.standard_normal(self.N),
+                                    *self.B_sqrtArgs)
+        if self.obsSig is None:
+            values=self.obsValues+self.obs.metric.covSqrtDot(
+                                    rng.standard_normal(self.obs.nObs))
+        else:
+            values=degrad(self.obsValues, 0., self.obsSig, seed=rng)
+        J=PrecondTWObsJTerm(self.__memberObs(values), self.nlModel,
+                            self.tlm, xb, self.B_sqrt, self.B_sqrtAdj,
+                            self.B_sqrtArgs, t0=self.t0, tf=self.tf)
+        minimizeArgs=dict(self.memberMinimizeDefaults, 
+                            **self.minimizeArgs)
+        J.minimize(**minimizeArgs)
+        self._bkgs[i]=xb
+        self._analyses[i]=J.analysis
+        return _minimumSummary(J.minimum)
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    def run(self):
+        '''
+        Runs the members <EDAResult>
+        '''
+        global _edaRunner
+        self._analyses=_sharedArray(np.zeros((self.nMembers, self.N)))
+        self._bkgs=_sharedArray(np.zeros((self.nMembers, self.N)))
+        tasks=zip(xrange(self.nMembers),
+                    spawnRNGs(self.seed, self.nMembers))
+        _edaRunner=self
+        try:
+            if self.nProc>1:
+                # forked workers inherit _edaRunner (no pickling)
+                pool=mp.Pool(min(self.nProc, self.nMembers))
+                try:
+                    minima=pool.map(_edaMember, tasks, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                minima=[_edaMember(task) for task in tasks]
+        finally:
+            _edaRunner=None
+        return EDAResult(np.array(self._analyses), np.array(self._bkgs),
+                            minima)
+
+    #------------------------------------------------------
+    #----| Classical overloads |----------------------------
+    #-------------------------------------------------------
+
+    def __str__(self):
+        output="////| EDARunner |/////////////////////////////////////////"
+        output+="\n nMembers=%d"%self.nMembers
+        output+="\n nObs=%d"%self.obs.nObs
+        output+="\n nProc=%d"%self.nProc
+        output+="\n///////////////////////////////////////////////////////////\n"
+        return output
@@ -1,5 +1,7 @@
 import numpy as np
-from modelCovariances import make_BisoHomo_args,  B_sqrt_isoHomo_op
+from modelCovariances import make_BisoHomo_args,  B_sqrt_isoHomo_op, \
+                                make_BisoHomo_op
+from randomLib import makeRNG, spawnRNGs, RunningStats
 import matplotlib.pyplot as plt
 from matplotlib.axes import Axes
 from matplotlib.gridspec import GridSpec, SubplotSpec
@@ -23,27 +25,63 @@ def errStr_isoHomo(grid, bkgLC, bkgSig=1., seed=None):
     Produce a random isotropic and homogeneous error structure 
         (coherent with the statics assimilation statistics using
             B_sqrt_isoHomo_op)
+
+        seed    :   <None | int | random stream> (see makeRNG)
     '''
     B_args=make_BisoHomo_args(grid, bkgLC, bkgSig)
 
-    np.random.seed(seed)
-    xi=np.random.normal(size=grid.N)
+    xi=makeRNG(seed).standard_normal(grid.N)
     return B_sqrt_isoHomo_op(xi, *B_args)
 
-def sample_err_isoHomo(grid, bkgLC, bkgSig=1., nRlz=1000, std=False):
-    errPS=[]
-    for i in xrange(nRlz):
-        rlz=errStr_isoHomo(grid, bkgLC, bkgSig=bkgSig)
-        nDemi=int(grid.N-1)/2
-        data=np.zeros(nDemi)
-        data=np.abs(np.fft.fft(rlz)[0:nDemi])
-        errPS.append(data)
+def errEns_isoHomo(grid, bkgLC, bkgSig=1., nRlz=1000, seed=None):
+    '''
+    Produce an ensemble (nRlz, grid.N) of random isotropic and 
+        homogeneous error structures (see errStr_isoHomo)
+    '''
+    B=make_BisoHomo_op(grid, bkgLC, bkgSig)
+
+    xi=makeRNG(seed).standard_normal((nRlz, grid.N))
+    return B.sqrt(xi)
+
+def errEnsGen_isoHomo(grid, bkgLC, bkgSig=1., nRlz=1000, chunkSize=1000,
+                        seed=None):
+    '''
+    Generator of an ensemble of nRlz random isotropic and homogeneous
+        error structures, by chunks (<=chunkSize, grid.N)
+
+        Each chunk is drawn from its own random stream (spawnRNGs):
+        for a given seed, the ensemble does not depend on how (or
+        by which process) the chunks are consumed.
+    '''
+    if not (isinstance(chunkSize, int) and chunkSize>0):
+        raise ValueError("chunkSize <int> >0")
+    B=make_BisoHomo_op(grid, bkgLC, bkgSig)
+    nChunks=(nRlz+chunkSize-1)//chunkSize
+    rngs=spawnRNGs(seed, nChunks)
+    for i in xrange(nChunks):
+        n=min(chunkSize, nRlz-i*chunkSize)
+        yield B.sqrt(rngs[i].standard_normal((n, grid.N)))
+
+def sample_err_isoHomo(grid, bkgLC, bkgSig=1., nRlz=1000, std=False,
+                        chunkSize=1000, seed=None):
+    '''
+    Power spectrum (mean [, std]) of nRlz random isotropic and
+        homogeneous error structures
+
+        streamed by chunks (errEnsGen_isoHomo): bounded memory
+        and one FFT per chunk
+    '''
+    nDemi=int(grid.N-1)/2
+    stats=RunningStats()
+    for rlz in errEnsGen_isoHomo(grid, bkgLC, bkgSig=bkgSig, nRlz=nRlz,
+                                    chunkSize=chunkSize, seed=seed):
+        stats.update(np.abs(np.fft.rfft(rlz, axis=-1)[:,0:nDemi]))
     
-    errPSMean=np.mean(errPS, axis=0)
+    errPSMean=stats.mean
     if not std:
         return errPSMean
     else:
-        errPSStd=np.std(errPS, axis=0)
+        errPSStd=stats.std()
         return errPSMean, errPSStd
 
 def plot_err_isoHomo(grid, bkgLC, bkgSig=1., nRlz=1000, 
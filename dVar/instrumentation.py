@@ -0,0 +1,316 @@
+import numpy as np
+import time
+import json
+import sys
+import threading
+from contextlib import contextmanager
+from functools import wraps
+try:
+    import resource
+except ImportError:
+    resource=None
+
+#   Opt-in instrumentation: the costly operations of the JTerms and
+#   TimeWindowObs (model, TLM and adjoint integrations, observation
+#   operators, B^{1/2}) go through timedCall(name, func, ...). Without
+#   an active Instrument it is a plain call; otherwise each active
+#   instrument counts the call, its duration and the size of the
+#   arrays it returns. Instruments nest (activate/deactivate): a
+#   minimization records into its own instrument and into those of
+#   the enclosing scopes.
+#
+#   The active instruments are per thread, and only the calling
+#   process is instrumented (not the workers of a parallel gradient
+#   test or of the extended forecasts).
+
+_local=threading.local()
+
+def _activeInstruments():
+    try:
+        return _local.instruments
+    except AttributeError:
+        _local.instruments=[]
+        return _local.instruments
+
+def _peakRSS():
+    '''
+    Peak resident set size of the process [bytes] <int | None>
+    '''
+    if resource==None:
+        return None
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform=='darwin':
+        return peak
+    return 1024*peak
+
+def _nbytes(obj):
+    '''
+    Size of the arrays held by obj (one level deep for objects)
+    '''
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, dict):
+        return sum(_nbytes(v) for v in obj.itervalues())
+    elif isinstance(obj, (list, tuple)):
+        return sum(_nbytes(v) for v in obj)
+    elif hasattr(obj, '__dict__'):
+        return sum(v.nbytes for v in vars(obj).itervalues()
+                    if isinstance(v, np.ndarray))
+    else:
+        return 0
+
+def timedCall(name, func, *args, **kwargs):
+    '''
+    func(*args, **kwargs), recorded as 'name' by the active
+    instruments
+    '''
+    instruments=_activeInstruments()
+    if not instruments:
+        return func(*args, **kwargs)
+    t0=time.time()
+    result=func(*args, **kwargs)
+    dt=time.time()-t0
+    nbytes=_nbytes(result)
+    for instrument in instruments:
+        instrument.record(name, dt, nbytes)
+    return result
+
+def activate(instrument=None):
+    '''
+    Starts recording in instrument (default: a new one)
+        <Instrument>
+    '''
+    if instrument==None:
+        instrument=Instrument()
+    if not isinstance(instrument, Instrument):
+        raise TypeError("instrument <Instrument>")
+    instrument.start()
+    _activeInstruments().append(instrument)
+    return instrument
+
+def deactivate():
+    '''
+    Stops the last activated instrument <Instrument>
+    '''
+    instruments=_activeInstruments()
+    if not instruments:
+        raise RuntimeError("no active instrument")
+    instrument=instruments.pop()
+    instrument.stop()
+    return instrument
+
+def isActive():
+    return len(_activeInstruments())>0
+
+@contextmanager
+def instrumenting(instrument=None):
+    '''
+    with instrumenting(I): ...  records the block into I
+                                    <Instrument | None>
+                                    (None: not recorded)
+    '''
+    if instrument==None:
+        yield None
+        return
+    activate(instrument)
+    try:
+        yield instrument
+    finally:
+        deactivate()
+
+def resolveInstrument(instrument):
+    '''
+    Instrument of a minimization
+
+        instrument  :   <None | bool | Instrument>
+                            None        : a new one if an instrument
+                                            is active
+                            True        : a new one
+                            False       : none
+    '''
+    if instrument is None:
+        if isActive():
+            return Instrument()
+        return None
+    elif instrument is True:
+        return Instrument()
+    elif instrument is False:
+        return None
+    elif isinstance(instrument, Instrument):
+        return instrument
+    else:
+        raise TypeError("instrument <None | bool | Instrument>")
+
+def instrumented(minimize):
+    '''
+    JTerm.minimize() decorator: handles its 'instrument' keyword
+        (see resolveInstrument); the minimization is recorded into
+        that instrument, attached to self.minimum.instrumentation
+    '''
+    @wraps(minimize)
+    def instrumentedMinimize(self, *args, **kwargs):
+        instrument=resolveInstrument(kwargs.pop('instrument', None))
+        with instrumenting(instrument):
+            minimize(self, *args, **kwargs)
+        if instrument<>None:
+            self.minimum.instrumentation=instrument
+    return instrumentedMinimize
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class Instrument(object):
+    '''
+    Counts, times and result sizes of instrumented operations
+
+        Instrument(name='')
+
+        calls           :   {operation : number of calls}
+        times           :   {operation : cumulated time [s]}
+        maxResultBytes  :   {operation : largest returned arrays
+                                [bytes]}
+        peakResultBytes :   largest returned arrays of all operations
+                                [bytes]
+        peakRSS         :   peak resident set size of the process
+                                when last stopped [bytes] (None
+                                without the resource module)
+        peakRSSGrowth   :   growth of that peak while active [bytes]
+        wallTime        :   time spent active [s]
+
+        Result sizes are only those of the arrays returned by the
+        operations (not their temporaries); the process peak RSS
+        covers everything but is a high watermark: it only grows
+        when the minimization exceeds the previous peak.
+
+        Operations: 'nlModel.integrate', 'nlModel.d_nDtInt',
+        'tlm.reference', 'tlm.d_nDtInt', 'tlm.d_nDtIntAdj', 'obsOp',
+        'obsOpAdj', 'B_sqrt', 'B_sqrtAdj'.
+
+        I.report()  :   JSON compatible <dict>
+        I.toJSON()  :   JSON report <str>
+        Instrument.fromReport(report)  :   back from a report
+
+        J.minimize(instrument=True) attaches the instrument of the
+        minimization to J.minimum.instrumentation.
+    '''
+
+    #------------------------------------------------------
+    #----| Init |------------------------------------------
+    #------------------------------------------------------
+
+    def __init__(self, name=''):
+        self.name=name
+        self.calls={}
+        self.times={}
+        self.maxResultBytes={}
+        self.peakResultBytes=0
+        self.peakRSS=None
+        self.peakRSSGrowth=0
+        self.wallTime=0.
+        self.__t0=None
+        self.__rss0=None
+        self.__lock=threading.Lock()
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    def start(self):
+        with self.__lock:
+            if self.__t0<>None:
+                raise RuntimeError("instrument already active")
+            self.__t0=time.time()
+            self.__rss0=_peakRSS()
+
+    def stop(self):
+        with self.__lock:
+            if self.__t0<>None:
+                self.wallTime+=time.time()-self.__t0
+                self.__t0=None
+                self.peakRSS=_peakRSS()
+                if self.peakRSS<>None:
+                    self.peakRSSGrowth+=self.peakRSS-self.__rss0
+
+    def record(self, name, dt, nbytes=0):
+        with self.__lock:
+            self.calls[name]=self.calls.get(name, 0)+1
+            self.times[name]=self.times.get(name, 0.)+dt
+            self.maxResultBytes[name]=max(
+                            self.maxResultBytes.get(name, 0), nbytes)
+            self.peakResultBytes=max(self.peakResultBytes, nbytes)
+
+    #------------------------------------------------------
+
+    def report(self):
+        operations={}
+        for name in self.calls.keys():
+            operations[name]={'calls':self.calls[name],
+                                'time':self.times[name],
+                                'maxResultBytes':self.maxResultBytes[name]}
+        return {'name':self.name, 'wallTime':self.wallTime,
+                'peakResultBytes':self.peakResultBytes,
+                'peakRSS':self.peakRSS,
+                'peakRSSGrowth':self.peakRSSGrowth,
+                'operations':operations}
+
+    @staticmethod
+    def fromReport(report):
+        '''
+        Instrument rebuilt from its report() <Instrument>
+        '''
+        instrument=Instrument(str(report['name']))
+        instrument.wallTime=report['wallTime']
+        instrument.peakResultBytes=report['peakResultBytes']
+        instrument.peakRSS=report['peakRSS']
+        instrument.peakRSSGrowth=report['peakRSSGrowth']
+        for name, op in report['operations'].items():
+            name=str(name)
+            instrument.calls[name]=op['calls']
+            instrument.times[name]=op['time']
+            instrument.maxResultBytes[name]=op['maxResultBytes']
+        return instrument
+
+    def toJSON(self, fun=None, indent=2):
+        '''
+        JSON report <str> (also written to the file object fun)
+        '''
+        output=json.dumps(self.report(), indent=indent, sort_keys=True)
+        if fun<>None:
+            fun.write(output)
+        return output
+
+    #------------------------------------------------------
+    #----| Classical overloads |----------------------------
+    #-------------------------------------------------------
+
+    def __getstate__(self):
+        state=self.__dict__.copy()
+        state['_Instrument__t0']=None
+        state['_Instrument__rss0']=None
+        del state['_Instrument__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock=threading.Lock()
+
+    def __str__(self):
+        output="____| Instrument %s|"%(self.name+' ' if self.name else '')
+        output+="\n   wall time=%f s"%self.wallTime
+        output+="\n   %-20s %8s %12s %8s %12s"%("operation", "calls",
+                                    "time [s]", "share", "max result")
+        for name in sorted(self.times, key=self.times.get, reverse=True):
+            if self.wallTime>0.:
+                share=100.*self.times[name]/self.wallTime
+            else:
+                share=0.
+            output+="\n   %-20s %8d %12.6f %7.1f%% %12d"%(name,
+                            self.calls[name], self.times[name], share,
+                            self.maxResultBytes[name])
+        output+="\n   largest result=%d bytes"%self.peakResultBytes
+        if self.peakRSS<>None:
+            output+="\n   process peak RSS=%d bytes (+%d while active)"%(
+                                        self.peakRSS, self.peakRSSGrowth)
+        output+="\n____________________________________________"
+        return output
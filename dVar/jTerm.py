@@ -4,15 +4,502 @@ import matplotlib.pyplot as plt
 from matplotlib.axes import Axes
 from matplotlib.gridspec import GridSpec
 import pickle
+import time
+import multiprocessing as mp
+from collections import OrderedDict
+from instrumentation import instrumented
 #from fmin_bfgs import fmin_bfgs
 
 def norm(x):
     return np.sqrt(np.dot(x,x))
 
 
+class _FusedJ(object):
+    '''
+    Shares a fused cost and gradient evaluation between the separate
+    f(x) and fprime(x) calls of a minimizer (last point memory)
+    '''
+    def __init__(self, costAndGrad):
+        self._costAndGrad=costAndGrad
+        self.x=None
+
+    def _eval(self, x):
+        if self.x is None or not np.array_equal(x, self.x):
+            self.f, self.g=self._costAndGrad(x)
+            self.x=np.array(x, copy=True)
+
+    def costAndGrad(self, x, *args):
+        self._eval(x)
+        return self.f, self.g
+
+    def J(self, x, *args):
+        self._eval(x)
+        return self.f
+
+    def gradJ(self, x, *args):
+        self._eval(x)
+        return self.g
+
+
+class ConvergenceRecorder(object):
+    '''
+    Convergence history recorded while minimizing
+
+        ConvergenceRecorder(storeIterates=False)
+
+        rec.J           :   cost function at each iterate <list>
+        rec.gradNorm    :   gradient norm at each iterate <list>
+        rec.wallTime    :   seconds since start() <list>
+        rec.iterates    :   copy of each iterate (storeIterates) <list>
+
+        Values come from the evaluations the minimizer already did
+        (iterate 0 being the first guess): no extra cost function
+        call. A recorder given to several minimizations (e.g. outer
+        loops) accumulates their histories.
+    '''
+    def __init__(self, storeIterates=False):
+        self.storeIterates=storeIterates
+        self.J=[]
+        self.gradNorm=[]
+        self.wallTime=[]
+        self.iterates=[]
+        self.t0=None
+
+    def start(self):
+        if self.t0==None:
+            self.t0=time.time()
+
+    def record(self, x, J, grad):
+        self.start()
+        self.J.append(J)
+        self.gradNorm.append(norm(grad))
+        self.wallTime.append(time.time()-self.t0)
+        if self.storeIterates:
+            self.iterates.append(np.array(x, copy=True))
+
+    def __len__(self):
+        return len(self.J)
+
+#---------------------------------------------------------------------
+
+class IterateStore(object):
+    '''
+    Minimization iterates in a preallocated array
+
+        IterateStore(N, maxiter, every=1, last=None, fileName=None)
+
+        N           :   state dimension
+        maxiter     :   iterations (maxiter+1 iterates with the
+                            first guess)
+        every       :   keep every k-th iterate (and the latest one)
+        last        :   keep only the last iterates <None | int>
+        fileName    :   back the array by a memory-mapped file
+                            <None | str>
+
+        store[i], len(store), iter(store): kept iterates (oldest first)
+        store.iterations()  :   their iteration numbers
+        numpy.array(store)  :   (nKept, N) array
+
+        Given as minimize(retall=...) to control what JMinimum.allvecs
+        keeps (retall=True: every iterate, in memory).
+    '''
+
+    #------------------------------------------------------
+    #----| Init |------------------------------------------
+    #------------------------------------------------------
+
+    def __init__(self, N, maxiter, every=1, last=None, fileName=None):
+        if not (isinstance(every, int) and every>0):
+            raise ValueError("every <int> >0")
+        if not (last==None or (isinstance(last, int) and last>0)):
+            raise ValueError("last <None | int> >0")
+        self.N=N
+        self.every=every
+        self.last=last
+        self.fileName=fileName
+        if last==None:
+            # kept iterates and the latest one
+            nRows=(maxiter+every)//every+1
+        else:
+            nRows=last
+        self.__data=self.__allocate(nRows)
+        self.__its=np.zeros(nRows, dtype=int)
+        self.__nKept=0
+        self.__pending=False
+        self.nIterates=0
+
+    #------------------------------------------------------
+    #----| Private methods |-------------------------------
+    #------------------------------------------------------
+
+    def __allocate(self, nRows):
+        if self.fileName==None:
+            return np.empty((nRows, self.N))
+        return np.memmap(self.fileName, dtype=float, mode='w+', 
+                            shape=(nRows, self.N))
+
+    def __grow(self):
+        if self.fileName<>None:
+            raise RuntimeError("IterateStore full (maxiter)")
+        nRows=len(self.__data)
+        data=np.empty((2*nRows, self.N))
+        data[:nRows]=self.__data
+        self.__data=data
+        self.__its=np.concatenate((self.__its, np.zeros(nRows, dtype=int)))
+
+    def __rows(self):
+        if self.last==None:
+            return np.arange(self.__nKept+int(self.__pending))
+        n=min(self.nIterates, self.last)
+        return np.arange(self.nIterates-n, self.nIterates)%self.last
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    def append(self, x):
+        k=self.nIterates
+        self.nIterates+=1
+        if self.last<>None:
+            i=k%self.last
+        else:
+            # an iterate not to keep only stays until the next one
+            i=self.__nKept
+            self.__pending=(k%self.every<>0)
+            if not self.__pending:
+                self.__nKept+=1
+            if i>=len(self.__data):
+                self.__grow()
+        self.__data[i]=x
+        self.__its[i]=k
+
+    def iterations(self):
+        return self.__its[self.__rows()]
+
+    def lastFinite(self, before=0):
+        '''
+        Latest kept iterate without nan/inf, excluding the 'before'
+        latest ones <numpy.ndarray | None>
+        '''
+        rows=self.__rows()
+        for r in rows[:len(rows)-before][::-1]:
+            if np.all(np.isfinite(self.__data[r])):
+                return np.array(self.__data[r])
+        return None
+
+    def flush(self):
+        if self.fileName<>None:
+            self.__data.flush()
+
+    #------------------------------------------------------
+    #----| Classical overloads |---------------------------
+    #------------------------------------------------------
+
+    def __len__(self):
+        return len(self.__rows())
+
+    def __getitem__(self, i):
+        return self.__data[self.__rows()[i]]
+
+    def __iter__(self):
+        for r in self.__rows():
+            yield self.__data[r]
+
+    def __array__(self, dtype=None):
+        a=np.asarray(self.__data[self.__rows()])
+        if dtype<>None:
+            a=a.astype(dtype)
+        return a
+
+    def __getstate__(self):
+        # pickled as an in-memory store
+        state=self.__dict__.copy()
+        rows=self.__rows()
+        state['_IterateStore__data']=np.array(self.__data[rows])
+        state['_IterateStore__its']=self.__its[rows]
+        state['_IterateStore__nKept']=len(rows)
+        state['_IterateStore__pending']=False
+        state['last']=None
+        state['every']=1
+        state['fileName']=None
+        return state
+
+#---------------------------------------------------------------------
+
+class GradTestResult(object):
+    '''
+    Gradient test result (JTerm.gradTest())
+
+        res.J0          :   J(x)
+        res.n2GradJ0    :   |grad J(x)|^2
+        res.test        :   {power : [J(x-eps*grad), ratio]}
+                            with eps=10**power
+        res.powers      :   tested powers (decreasing) <numpy.ndarray>
+        res.ratios      :   (J0-Jeps)/(eps*|grad|^2) <numpy.ndarray>
+        res.converged   :   a ratio reached 1 within stopTol <bool>
+
+        J0, n2GradJ0, test=res     (former tuple return: res[0],
+                                    res[1], res[2] and len(res)
+                                    behave as the tuple)
+    '''
+    def __init__(self, J0, n2GradJ0, test, stopTol=None):
+        self.J0=J0
+        self.n2GradJ0=n2GradJ0
+        self.test=test
+        self.stopTol=stopTol
+        self.powers=np.sort(test.keys())[::-1]
+        self.ratios=np.array([test[p][1] for p in self.powers])
+        if stopTol==None:
+            self.converged=False
+        else:
+            self.converged=bool(np.any(np.abs(1.-self.ratios)<=stopTol))
+
+    def __iter__(self):
+        return iter((self.J0, self.n2GradJ0, self.test))
+
+    def __getitem__(self, i):
+        return (self.J0, self.n2GradJ0, self.test)[i]
+
+    def __len__(self):
+        return 3
+
+    def __str__(self):
+        return gradTestString(self.J0, self.n2GradJ0, self.test)
+
+#---------------------------------------------------------------------
+
+def gradTestString(J0, n2GradJ0, test):
+    s="----| Gradient test |------------------\n"
+    s+="  J0      =%+25.15e\n"%J0
+    s+=" |grad|^2 =%+25.15e\n"%n2GradJ0
+    for i in  (np.sort(test.keys())[::-1]):
+        s+="%4d %+25.15e  %+25.15e\n"%(i, test[i][0], test[i][1])
+    return s
+
+_gTestArgs=None
+
+def _gTestEval(power):
+    J, x, gradJ0=_gTestArgs
+    return J._costFunc(x-10.**(power)*gradJ0)
+
+#---------------------------------------------------------------------
+
+class LBFGSHistory(object):
+    """
+    Bounded-history (L-BFGS) inverse Hessian representation
+
+    LBFGSHistory(sk, yk)
+
+        sk, yk  :   (m, N) correction pairs (oldest first)
+                        sk=x_{k+1}-x_k, yk=grad_{k+1}-grad_k
+
+        H.dot(v)            :   two-loop recursion (H0=gamma*I), O(mN)
+        H.sqrtDot(v)        :   S.v, with H=S.S' (S symmetric)
+        H.sqrtInvDot(v)     :   S^{-1}.v
+        H.todense()         :   dense (N,N) matrix
+
+        Takes O(mN) memory instead of the O(N^2) of a dense BOpt.
+
+        H is gamma*I outside span{sk, yk}: the square root uses
+        H=gamma*(I-UU')+U.diag(mu).U' computed once from 2m 
+        two-loop products.
+    """
+
+    def __init__(self, sk, yk):
+        sk=np.atleast_2d(np.asarray(sk, dtype=float))
+        yk=np.atleast_2d(np.asarray(yk, dtype=float))
+        if sk.shape<>yk.shape:
+            raise ValueError("sk.shape==yk.shape")
+        # only pairs with positive curvature are kept
+        sy=np.sum(sk*yk, axis=1)
+        keep=(sy>0.)
+        self.sk=sk[keep]
+        self.yk=yk[keep]
+        self.rho=1./sy[keep]
+        self.m=len(self.sk)
+        self.N=sk.shape[1]
+        if self.m>0:
+            self.gamma=1./(self.rho[-1]*np.dot(self.yk[-1], self.yk[-1]))
+        else:
+            self.gamma=1.
+        self._lowRank=None
+
+    def dot(self, v):
+        q=np.array(v, dtype=float, copy=True)
+        alpha=np.zeros(self.m)
+        for i in xrange(self.m-1, -1, -1):
+            alpha[i]=self.rho[i]*np.dot(self.sk[i], q)
+            q-=alpha[i]*self.yk[i]
+        r=self.gamma*q
+        for i in xrange(self.m):
+            beta=self.rho[i]*np.dot(self.yk[i], r)
+            r+=self.sk[i]*(alpha[i]-beta)
+        return r
+
+    #------------------------------------------------------
+
+    def __lowRank(self):
+        if self._lowRank==None:
+            if self.m==0:
+                U=np.zeros((self.N,0))
+                mu=np.zeros(0)
+            else:
+                Q, sv, _=np.linalg.svd(np.vstack((self.sk, self.yk)).T, 
+                                        full_matrices=False)
+                Q=Q[:,sv>1e-10*sv[0]]
+                HQ=np.array([self.dot(q) for q in Q.T]).T
+                M=np.dot(Q.T, HQ)
+                mu, W=np.linalg.eigh(0.5*(M+M.T))
+                mu=np.maximum(mu, 1e-12*self.gamma)
+                U=np.dot(Q, W)
+            self._lowRank=(U, mu)
+        return self._lowRank
+
+    def __sqrtPow(self, v, p):
+        U, mu=self.__lowRank()
+        coef=(mu**p-self.gamma**p)*np.dot(v, U)
+        return self.gamma**p*v+np.dot(U, coef)
+
+    def sqrtDot(self, v):
+        return self.__sqrtPow(v, 0.5)
+
+    def sqrtDotAdj(self, v):
+        return self.__sqrtPow(v, 0.5)
+
+    def sqrtInvDot(self, v):
+        return self.__sqrtPow(v, -0.5)
+
+    def sqrtInvDotAdj(self, v):
+        return self.__sqrtPow(v, -0.5)
+
+    #------------------------------------------------------
+
+    def todense(self):
+        return np.array([self.dot(e) for e in np.eye(self.N)]).T
+
+    def __len__(self):
+        return self.m
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class HessianEigen(object):
+    """
+    Spectral (low rank) inverse Hessian approximation
+
+    HessianEigen(eigVals, eigVecs, base=None)
+
+        eigVals :   (k,) leading Hessian eigenvalues
+        eigVecs :   (k, N) orthonormal eigenvectors
+        base    :   preconditioner in which the eigenpairs were
+                        computed <HessianEigen | LBFGSHistory | None>
+
+        Without base:   H^{-1} ~ I + sum_i (1/eigVal_i-1) v_i v_i'
+                        = S S'
+        With base:      S=S_base.S_eig
+
+        H.dot(v)            :   H^{-1}.v
+        H.sqrtDot(v)        :   S.v
+        H.sqrtDotAdj(v)     :   S'.v
+        H.sqrtInvDot(v)     :   S^{-1}.v
+        H.sqrtInvDotAdj(v)  :   S^{-T}.v
+
+    Produced by the 'cg' minimizer (JMinimum.BOpt) and usable as a
+    spectral preconditioner of the next minimization (hessInv0).
+    """
+
+    def __init__(self, eigVals, eigVecs, base=None):
+        eigVals=np.atleast_1d(np.asarray(eigVals, dtype=float))
+        eigVecs=np.atleast_2d(np.asarray(eigVecs, dtype=float))
+        if eigVecs.shape[0]<>len(eigVals):
+            raise ValueError("eigVecs.shape==(k, N)")
+        if np.any(eigVals<=0.):
+            raise ValueError("eigVals>0")
+        if not (base==None or 
+                isinstance(base, (HessianEigen, LBFGSHistory))):
+            raise TypeError("base <None | HessianEigen | LBFGSHistory>")
+        self.eigVals=eigVals
+        self.eigVecs=eigVecs
+        self.base=base
+        self.k=len(eigVals)
+        self.N=eigVecs.shape[1]
+
+    def __sqrtEig(self, v, p=-0.5):
+        coef=(self.eigVals**p-1.)*np.dot(self.eigVecs, v)
+        return v+np.dot(coef, self.eigVecs)
+
+    def sqrtDot(self, v):
+        if self.base==None:
+            return self.__sqrtEig(v)
+        return self.base.sqrtDot(self.__sqrtEig(v))
+
+    def sqrtDotAdj(self, v):
+        if self.base==None:
+            return self.__sqrtEig(v)
+        return self.__sqrtEig(self.base.sqrtDotAdj(v))
+
+    def sqrtInvDot(self, v):
+        if self.base==None:
+            return self.__sqrtEig(v, 0.5)
+        return self.__sqrtEig(self.base.sqrtInvDot(v), 0.5)
+
+    def sqrtInvDotAdj(self, v):
+        if self.base==None:
+            return self.__sqrtEig(v, 0.5)
+        return self.base.sqrtInvDotAdj(self.__sqrtEig(v, 0.5))
+
+    def dot(self, v):
+        return self.sqrtDot(self.sqrtDotAdj(v))
+
+    def todense(self):
+        return np.array([self.dot(e) for e in np.eye(self.N)]).T
+
+    def __len__(self):
+        return self.k
+
+#---------------------------------------------------------------------
+
+def hessInvGuess(hessInv):
+    '''
+    Inverse Hessian approximation usable to seed a minimization
+
+        hessInv :   <JMinimum | LBFGSHistory | HessianEigen 
+                        | numpy.ndarray | None>
+                    (a JMinimum gives its BOpt; a dense matrix is
+                     converted once to its eigen decomposition)
+    '''
+    if isinstance(hessInv, JMinimum):
+        hessInv=hessInv.BOpt
+    if hessInv is None or isinstance(hessInv, (LBFGSHistory, HessianEigen)):
+        return hessInv
+    elif isinstance(hessInv, np.ndarray):
+        if hessInv.ndim<>2 or hessInv.shape[0]<>hessInv.shape[1]:
+            raise ValueError("hessInv.shape==(N,N)")
+        mu, V=np.linalg.eigh(0.5*(hessInv+hessInv.T))
+        mu=np.maximum(mu, 1e-12*mu.max())
+        return HessianEigen(1./mu, V.T)
+    else:
+        raise TypeError(
+        "hessInv <JMinimum | LBFGSHistory | HessianEigen | numpy.ndarray>")
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
 class JMinimum(object):
     """
     Minimisation result of a JTerm
+
+        BOpt    :   inverse Hessian approximation
+                        <numpy.ndarray | LBFGSHistory | None>
+                        (dense for 'bfgs', bounded history
+                         for 'lbfgs')
+        convergence :   cost function at each iterate <list | None>
+        history     :   full convergence history 
+                        <ConvergenceRecorder | None>
+        instrumentation :   operations counts and times
+                        <Instrument | None> (see instrumentation)
     """
     #------------------------------------------------------
     #----| Init |------------------------------------------
@@ -20,9 +507,8 @@ class JMinimum(object):
     def __init__(self, xOpt, fOpt, gOpt, BOpt,
                     fCalls, gCalls, 
                     warnFlag, maxiter, 
-                    allvecs=None, convergence=None):
-        if ((not convergence==None) and (allvecs==None)):
-            raise Exception()
+                    allvecs=None, convergence=None, history=None,
+                    instrumentation=None):
         self.xOpt=xOpt
         self.fOpt=fOpt
         self.gOpt=gOpt
@@ -33,12 +519,15 @@ class JMinimum(object):
         self.maxiter=maxiter
         self.allvecs=allvecs
         self.convergence=convergence
+        self.history=history
+        self.instrumentation=instrumentation
 
         self.gOptNorm=np.sqrt(np.dot(self.gOpt,self.gOpt))
 
     #------------------------------------------------------
 
     def dump(self, fun):
+        pickle.dump(('JMinimum', JMINIMUM_DUMP_VERSION), fun)
         pickle.dump(self.xOpt, fun)
         pickle.dump(self.fOpt, fun)
         pickle.dump(self.gOpt, fun)
@@ -49,12 +538,33 @@ class JMinimum(object):
         pickle.dump(self.maxiter, fun)
         pickle.dump(self.allvecs, fun)
         pickle.dump(self.convergence, fun)
+        pickle.dump(self.history, fun)
+        pickle.dump(self.instrumentation, fun)
         
 #---------------------------------------------------------------------
 
+#   JMinimum.dump() format: a ('JMinimum', version) marker, then the
+#   records up to convergence, then
+#       version 1   :   history
+#       version 2   :   history, instrumentation
+#   Dumps without marker (older) stop at convergence: several can be
+#   read in a row from the same file.
+
+JMINIMUM_DUMP_VERSION=2
+
 def loadJMinimum(fun):
     
-    xOpt=pickle.load(fun)
+    first=pickle.load(fun)
+    if (isinstance(first, tuple) and len(first)==2 
+            and first[0]=='JMinimum'):
+        version=first[1]
+        if version>JMINIMUM_DUMP_VERSION:
+            raise ValueError("JMinimum dump version %d (<=%d expected)"%(
+                                version, JMINIMUM_DUMP_VERSION))
+        xOpt=pickle.load(fun)
+    else:
+        version=0
+        xOpt=first
     fOpt=pickle.load(fun)
     gOpt=pickle.load(fun)
     BOpt=pickle.load(fun)
@@ -64,10 +574,17 @@ def loadJMinimum(fun):
     maxiter=pickle.load(fun)
     allvecs=pickle.load(fun)
     convergence=pickle.load(fun)
+    history=None
+    instrumentation=None
+    if version>=1:
+        history=pickle.load(fun)
+    if version>=2:
+        instrumentation=pickle.load(fun)
     jMin=JMinimum(xOpt, fOpt, gOpt, BOpt,
                     fCalls, gCalls, 
                     warnFlag, maxiter, 
-                    allvecs=allvecs, convergence=convergence)
+                    allvecs=allvecs, convergence=convergence,
+                    history=history, instrumentation=instrumentation)
     return jMin
     
 #=====================================================================
@@ -79,29 +596,66 @@ class JTerm(object):
     JTerm(costFunc, gradCostFunc, args=()) 
 
         costFunc, gradCostFunc(x, *args)
+        costAndGradFunc(x, *args) -> (cost, grad)   (optional, fused)
 
         <!> This is a master class not meant to be instantiated, only
             subclasses should.
 
         JTerms (and sub classes) can be summed :  JSum=((J1+J2)+J3)+...
         JTerms (and sub classes) can be scaled :  JMult=J1*.5
+        (both give a flat JSum)
+
+        Minimizer backends (JTerm.minimize(minimizer=...)):
+            'lbfgs' :   limited-memory BFGS (scipy L-BFGS-B)
+                        memory=m correction pairs, O(mN) storage
+            'bfgs'  :   scipy fmin_bfgs (dense inverse Hessian)
+
+        (a subclass can register other backends in 'minimizers'
+         as {name : method name}; methods follow _minimizeBFGS())
+
+        Gradient test (gradTest()): gradTestProcs forked processes
+        evaluate the perturbed costs (1: serial).
+
+        Evaluation cache: J(), gradJ() and costAndGradJ() keep the
+        evalCacheSize last evaluated points (keyed by the content
+        of x) with their cost, gradient and the intermediate states
+        memorized by subclasses (_memo()), so that J and gradJ at 
+        the same point share the expensive work. Reassigning one of
+        the cacheDependencies attributes (e.g. J.obs=...) drops it;
+        after an in place change of what the cost depends on (e.g.
+        J.obs.metric=..., J.x_bkg[:]=...) call J.invalidate().
     """
 
     class JTermError(Exception):
         pass
 
+    minimizers={'bfgs'  : '_minimizeBFGS', 
+                'lbfgs' : '_minimizeLBFGS'}
+    # backends handling hessInv0 themselves
+    precondMinimizers=()
+
+    nEig=10
+    evalCacheSize=4
+    # attributes the cost depends on (see __setattr__)
+    cacheDependencies=('args',)
+    gradTestProcs=1
+
     #------------------------------------------------------
     #----| Init |------------------------------------------
     #------------------------------------------------------
 
     def __init__(self, costFunc, gradCostFunc, 
-                    args=(), maxGradNorm=None):
+                    args=(), maxGradNorm=None, costAndGradFunc=None):
         
         if not (callable(costFunc) and callable(gradCostFunc)):
             raise self.JTermError("costFunc, gardCostFunc <function>")
 
         self._costFunc=costFunc
         self._gradCostFunc=gradCostFunc
+        if costAndGradFunc<>None:
+            if not callable(costAndGradFunc):
+                raise self.JTermError("costAndGradFunc <function>")
+            self._costAndGrad=costAndGradFunc
 
         if not (isinstance(maxGradNorm, float) or maxGradNorm==None):
             raise self.JTermError("maxGradNorm <None|float>")
@@ -116,51 +670,141 @@ class JTerm(object):
     #------------------------------------------------------
 
     def J(self, x):
-        return self._costFunc(x,*self.args) 
+        return self._memo(x, 'cost', self._costFunc, x, *self.args)
 
     #------------------------------------------------------
 
     def gradJ(self, x):
-        if self.maxGradNorm==None:
-            return self._gradCostFunc(x, *self.args)
-        elif isinstance(self.maxGradNorm, float):
-            grad=self._gradCostFunc(x, *self.args)
-            normGrad=norm(grad)
-            if np.isnan(normGrad):
-                grad=np.zeros(self.modelGrid.N)
-            elif normGrad>self.maxGradNorm:
-                grad=(grad/normGrad)*(self.maxGradNorm)
-            return grad
+        grad=self._memo(x, 'grad', self._gradCostFunc, x, *self.args)
+        return self._clipGrad(grad.copy())
 
     def normGradJ(self, x):
         return norm(self.gradJ(x))
 
     #------------------------------------------------------
 
+    def costAndGradJ(self, x):
+        '''
+        Fused evaluation (cost, gradient) at x
 
-    def minimize(self, x_fGuess, maxiter=50, retall=True,
-                    testGrad=True, finalTestGrad=False, convergence=True, 
-                    testGradMinPow=-1, testGradMaxPow=-14):
+            subclasses override _costAndGrad() to share the
+            expensive work (e.g. model integration) between both
+        '''
+        entry=self._evalEntry(x)
+        if not ('cost' in entry and 'grad' in entry):
+            entry['cost'], entry['grad']=self._costAndGrad(x, *self.args)
+        return entry['cost'], self._clipGrad(entry['grad'].copy())
+
+    #------------------------------------------------------
+
+    def invalidate(self):
+        '''
+        Drops the memorized evaluations
+        '''
+        self._evalCache=OrderedDict()
+
+    #------------------------------------------------------
 
 
+    @instrumented
+    def minimize(self, x_fGuess, maxiter=50, retall=True,
+                    testGrad=True, finalTestGrad=False, convergence=True, 
+                    testGradMinPow=-1, testGradMaxPow=-14,
+                    minimizer='lbfgs', memory=10, storeHessInv=True,
+                    hessInv0=None, recorder=None, testGradTol=None,
+                    disp=True, minimizerOptions=None):
+        '''
+            retall          :   keep the iterates (minimum.allvecs)
+                                    <bool | IterateStore>
+                                    (an IterateStore can thin them or
+                                     back them by a file)
+            testGradTol     :   gradient tests stop once the ratio is
+                                    1 within testGradTol (default None:
+                                    whole power range)
+            convergence     :   record the convergence history
+                                    (minimum.convergence, .history)
+            recorder        :   where to record it (default: a new
+                                    one) <ConvergenceRecorder>
+            minimizer       :   backend name <'lbfgs' | 'bfgs' | ...>
+            memory          :   number of L-BFGS correction pairs
+            disp            :   print the minimizer summary
+            minimizerOptions:   backend tolerances <dict>
+                                    'lbfgs' : gtol, ftol
+                                    'bfgs'  : gtol
+                                    'cg'    : gtol, ritzTol
+            storeHessInv    :   keep the inverse Hessian approximation
+                                    in minimum.BOpt
+            hessInv0        :   warm start: curvature saved by a 
+                                    previous minimization (e.g. of the
+                                    previous assimilation cycle)
+                                    <JMinimum | LBFGSHistory |
+                                     HessianEigen | numpy.ndarray>
+                                    (see hessInvGuess)
+
+            With hessInv0=S.S', the quasi-Newton backends minimize
+            in z, x=x_fGuess+S.z, so that they start from hessInv0
+            instead of the identity; results are mapped back to x.
+
+            instrument      :   count and time the model, TLM, adjoint,
+                                    observation operators and B^{1/2}
+                                    calls (minimum.instrumentation)
+                                    <None | bool | Instrument>
+                                    (None: when an instrument is
+                                     active; see instrumented)
+        '''
+
+        if not minimizer in self.minimizers:
+            raise self.JTermError("minimizer <%s>"%
+                                    " | ".join(self.minimizers.keys()))
+        hessInv0=hessInvGuess(hessInv0)
+        if minimizerOptions==None:
+            minimizerOptions={}
+        if not isinstance(minimizerOptions, dict):
+            raise self.JTermError("minimizerOptions <dict>")
         self.retall=retall
-        self.minimizer=sciOpt.fmin_bfgs
-        #self.minimizer=fmin_bfgs
+        self.minimizer=minimizer
 
         if x_fGuess.dtype<>'float64':
             raise self.JTermError("x_fGuess.dtype=='float64'")
         #----| Gradient test |--------------------
         if testGrad:
             self.testGradInit=self.gradTest(x_fGuess,
-                                powRange=[testGradMinPow, testGradMaxPow])
+                                powRange=[testGradMinPow, testGradMaxPow],
+                                output=True, stopTol=testGradTol)
 
         #----| Minimizing |-----------------------
-        minimizeReturn=self.minimizer(self.J, x_fGuess, args=self.args,
-                                        fprime=self.gradJ,  
-                                        maxiter=maxiter, retall=self.retall,
-                                        full_output=True)
-
-        self.createMinimum(minimizeReturn, maxiter, convergence=convergence)
+        fused=_FusedJ(self.costAndGradJ)
+        backend=getattr(self, self.minimizers[minimizer])
+        if convergence:
+            if recorder==None:
+                recorder=ConvergenceRecorder()
+        else:
+            recorder=None
+        if isinstance(retall, IterateStore):
+            store=retall
+        elif retall:
+            store=IterateStore(len(x_fGuess), maxiter)
+        else:
+            store=None
+        callback=self._iterCallback(fused, recorder, store)
+        if callback<>None:
+            callback(x_fGuess)
+        if hessInv0==None or minimizer in self.precondMinimizers:
+            minimizeReturn=backend(fused, x_fGuess, maxiter, 
+                                memory=memory, storeHessInv=storeHessInv,
+                                hessInv0=hessInv0, callback=callback,
+                                disp=disp, **minimizerOptions)
+        else:
+            minimizeReturn=self._minimizeWarm(backend, fused, x_fGuess, 
+                                maxiter, hessInv0,
+                                memory=memory, storeHessInv=storeHessInv,
+                                callback=callback, disp=disp,
+                                **minimizerOptions)
+
+        if store<>None:
+            store.flush()
+        self.createMinimum(minimizeReturn, maxiter, recorder=recorder,
+                            store=store)
         self.createAnalysis()
 
         #----| Final Gradient test |--------------
@@ -171,69 +815,202 @@ class JTerm(object):
                 self.testGradFinal=None
             else:
                 self.testGradFinal=self.gradTest(self.minimum.xOpt,
-                                powRange=[testGradMinPow, testGradMaxPow])
+                                powRange=[testGradMinPow, testGradMaxPow],
+                                output=True, stopTol=testGradTol)
 
 
+    #-----------------------------------------------------
+    #----| Minimizer backends |---------------------------
+    #
+    #   backend(fused, x0, maxiter, **options) returns 
+    #   the fmin_bfgs(full_output=True) layout:
+    #       (xOpt, fOpt, gOpt, BOpt, fCalls, gCalls, warnFlag)
+    #   and calls options['callback'](xk[, f, g]) after each 
+    #   iteration (when not None): iterates and convergence 
+    #   history are recorded there
+    #-----------------------------------------------------
+
+    def _iterCallback(self, fused, recorder, store):
+        if recorder==None and store==None:
+            return None
+        if recorder<>None:
+            recorder.start()
+        def callback(xk, f=None, g=None):
+            if store<>None:
+                store.append(xk)
+            if recorder<>None:
+                if f is None:
+                    # memorized: last point evaluated by the minimizer
+                    f, g=fused.costAndGrad(xk)
+                recorder.record(xk, f, g)
+        return callback
+
+    def _minimizeWarm(self, backend, fused, x0, maxiter, hessInv0,
+                        **kwargs):
+        '''
+        Warm started minimization: backend run in z, x=x0+S.z
+        '''
+        S=hessInv0.sqrtDot
+        SAdj=hessInv0.sqrtDotAdj
+        callback=kwargs.get('callback', None)
+        if callback<>None:
+            kwargs['callback']=lambda z, f=None, g=None: callback(x0+S(z))
+        last={}
+        def costAndGradZ(z):
+            f, g=fused.costAndGrad(x0+S(z))
+            last['z']=np.array(z, copy=True)
+            last['g']=g
+            return f, SAdj(g)
+
+        ret=backend(_FusedJ(costAndGradZ), np.zeros(len(x0)), maxiter,
+                    **kwargs)
+
+        zOpt=ret[0]
+        xOpt=x0+S(zOpt)
+        if np.array_equal(zOpt, last['z']):
+            gOpt=last['g']
+        else:
+            gOpt=fused.costAndGrad(xOpt)[1]
+        #----| curvature back in x |--------------
+        BOpt=ret[3]
+        if isinstance(BOpt, LBFGSHistory):
+            BOpt=LBFGSHistory([S(s) for s in BOpt.sk],
+                              [hessInv0.sqrtInvDotAdj(y) for y in BOpt.yk])
+        elif isinstance(BOpt, np.ndarray):
+            SB=np.array([S(c) for c in BOpt.T]).T
+            BOpt=np.array([S(r) for r in SB]).T
+        return (xOpt, ret[1], gOpt, BOpt)+tuple(ret[4:7])
+
+    def _minimizeBFGS(self, fused, x0, maxiter, storeHessInv=True,
+                        callback=None, disp=True, gtol=1e-5, **kwargs):
+        minimizeReturn=sciOpt.fmin_bfgs(fused.J, x0, args=self.args,
+                                        fprime=fused.gradJ, gtol=gtol,
+                                        maxiter=maxiter, full_output=True,
+                                        callback=callback, disp=disp)
+        if not storeHessInv:
+            minimizeReturn=(minimizeReturn[:3]+(None,)+minimizeReturn[4:])
+        return minimizeReturn
+
+    def _minimizeLBFGS(self, fused, x0, maxiter, memory=10, 
+                        storeHessInv=True, callback=None, disp=True,
+                        gtol=1e-5, ftol=2.2e-9, **kwargs):
+        '''
+            gtol    :   stop when max |projected gradient| <= gtol
+            ftol    :   stop when the relative reduction of J
+                            is <= ftol
+        '''
+        res=sciOpt.minimize(fused.costAndGrad, x0, jac=True, 
+                            method='L-BFGS-B', callback=callback,
+                            options={'maxcor':memory, 'maxiter':maxiter,
+                                     'gtol':gtol, 'ftol':ftol})
+        if storeHessInv and hasattr(res.hess_inv, 'sk'):
+            BOpt=LBFGSHistory(res.hess_inv.sk, res.hess_inv.yk)
+        else:
+            BOpt=None
+        if disp:
+            print(res.message)
+            print("         Current function value: %f"%res.fun)
+            print("         Iterations: %d"%res.nit)
+            print("         Function evaluations: %d"%res.nfev)
+        # fused evaluations: as many gradients as costs otherwise
+        gCalls=getattr(res, 'njev', res.nfev)
+        return (res.x, res.fun, res.jac, BOpt, res.nfev, gCalls, 
+                res.status)
+
     #-----------------------------------------------------
 
-    def createMinimum(self, minimizeReturn, maxiter, convergence=True):
-        if self.retall:
-            allvecs=minimizeReturn[7]
-            if convergence:
-                convJVal=self._jAllVecs(allvecs)
+    def createMinimum(self, minimizeReturn, maxiter, recorder=None,
+                        store=None):
+        allvecs=store
+        if recorder<>None:
+            convJVal=list(recorder.J)
         else:
-            allvecs=None
             convJVal=None
 
         self.minimum=JMinimum(
             minimizeReturn[0], minimizeReturn[1], minimizeReturn[2],
             minimizeReturn[3], minimizeReturn[4], minimizeReturn[5],
             minimizeReturn[6], maxiter,
-            allvecs=allvecs, convergence=convJVal)
+            allvecs=allvecs, convergence=convJVal, history=recorder)
         self.isMinimized=True
 
     #-----------------------------------------------------
 
     def createAnalysis(self):
         if np.any(np.isnan(self.minimum.gOpt)):
-            if not self.retall:
-                raise jTermError(
+            if self.minimum.allvecs==None:
+                raise self.JTermError(
                     "No previous state to fall back: try minimize with retall=True")
-            nIters=len(self.minimum.allvecs)
-            self.analysis=self.minimum.allvecs[nIters-2]
+            # last sound iterate before the final one
+            self.analysis=self.minimum.allvecs.lastFinite(before=1)
+            if self.analysis is None:
+                raise self.JTermError("No finite previous state")
         else:
             self.analysis=self.minimum.xOpt
                 
     #------------------------------------------------------
     #----| Gradient test |---------------------------------
 
-    def _gTest(self, x, J0, gradJ0, n2GradJ0, powRange):
+    def _gTest(self, x, J0, gradJ0, n2GradJ0, powRange, nProc=1,
+                stopTol=None):
+        global _gTestArgs
+        powers=range(powRange[0],powRange[1], -1)
+        _gTestArgs=(self, x, gradJ0)
+        if nProc>1:
+            # forked workers inherit the term (no pickling)
+            pool=mp.Pool(nProc)
+            evaluate=pool.map
+        else:
+            evaluate=lambda func, chunk: [func(p) for p in chunk]
         test={}
-        for power in xrange(powRange[0],powRange[1], -1):
-            eps=10.**(power)
-            Jeps=self._costFunc(x-eps*gradJ0)
-            
-            res=((J0-Jeps)/(eps*n2GradJ0))
-            test[power]=[Jeps, res]
+        converged=False
+        try:
+            for i in xrange(0, len(powers), nProc):
+                chunk=powers[i:i+nProc]
+                for power, Jeps in zip(chunk, evaluate(_gTestEval, chunk)):
+                    eps=10.**(power)
+                    res=((J0-Jeps)/(eps*n2GradJ0))
+                    test[power]=[Jeps, res]
+                    if stopTol<>None and abs(1.-res)<=stopTol:
+                        converged=True
+                if converged:
+                    break
+        finally:
+            if nProc>1:
+                pool.close()
+                pool.join()
+            _gTestArgs=None
         return test
 
     def gradTestString(self, J0, n2GradJ0, test):
-        s="----| Gradient test |------------------\n"
-        s+="  J0      =%+25.15e\n"%J0
-        s+=" |grad|^2 =%+25.15e\n"%n2GradJ0
-        for i in  (np.sort(test.keys())[::-1]):
-            s+="%4d %+25.15e  %+25.15e\n"%(i, test[i][0], test[i][1])
-        return s
+        return gradTestString(J0, n2GradJ0, test)
 
     def gradTest(self, x, powRange=[-1,-14], 
                     findFirst9=False,
-                    output=True):
+                    output=True, nProc=None, stopTol=None):
+        '''
+        Gradient test: (J(x)-J(x-eps*grad))/(eps*|grad|^2) -> 1
+
+            powRange    :   eps=10**power, power in
+                                xrange(powRange[0], powRange[1], -1)
+            output      :   print the test table
+            nProc       :   perturbed costs evaluated by a pool of
+                                nProc forked processes (default:
+                                gradTestProcs)
+            stopTol     :   stop once |1-ratio|<=stopTol
+                                (whole powRange if None)
+
+            returns <GradTestResult>
+        '''
+        if nProc==None:
+            nProc=self.gradTestProcs
         J0=self._costFunc(x)
         gradJ0=self._gradCostFunc(x)
         n2GradJ0=np.dot(gradJ0, gradJ0)
 
         powRangeTrial=powRange[:]
-        test=self._gTest(x, J0, gradJ0, n2GradJ0, powRangeTrial)
+        test=self._gTest(x, J0, gradJ0, n2GradJ0, powRangeTrial, 
+                            nProc=nProc, stopTol=stopTol)
 
         if output:  print(self.gradTestString(J0, n2GradJ0, test))
 
@@ -252,7 +1029,8 @@ class JTerm(object):
                 powRangeTrial[0]=powerMin
                 powRangeTrial[1]=powerMin-7
                 print("      redoing on %s"%powRangeTrial)
-                test=self._gTest(x, J0, gradJ0, n2GradJ0, powRangeTrial)
+                test=self._gTest(x, J0, gradJ0, n2GradJ0, powRangeTrial,
+                                    nProc=nProc, stopTol=stopTol)
                 if output:  print(self.gradTestString(J0, n2GradJ0, test))
             else:
                 testTmp={}
@@ -263,9 +1041,7 @@ class JTerm(object):
                         break
                 test=testTmp
 
-
-
-        return (J0, n2GradJ0, test)
+        return GradTestResult(J0, n2GradJ0, test, stopTol=stopTol)
 
     #------------------------------------------------------
 
@@ -286,13 +1062,58 @@ class JTerm(object):
     #------------------------------------------------------
     
 
-    def _jAllVecs(self, allvecs):
-        convJVal=[]
-        for i in xrange(len(allvecs)):
-            convJVal.append(self.J(allvecs[i]))
-        return convJVal
+    def _costAndGrad(self, x, *args):
+        return (self._costFunc(x, *args), self._gradCostFunc(x, *args))
 
     #------------------------------------------------------
+
+    def _evalEntry(self, x):
+        '''
+        Evaluation cache entry of x <dict>
+
+            (least recently used entries dropped beyond
+             evalCacheSize; the cache is created on first use,
+             subclasses not calling JTerm.__init__)
+        '''
+        if self.evalCacheSize<1:
+            return {}
+        cache=getattr(self, '_evalCache', None)
+        if cache is None:
+            cache=self._evalCache=OrderedDict()
+        x=np.asarray(x)
+        key=(x.shape, x.tostring())
+        entry=cache.pop(key, None)
+        if entry is None:
+            entry={}
+            while len(cache)>=self.evalCacheSize:
+                cache.popitem(last=False)
+        cache[key]=entry
+        return entry
+
+    def _memo(self, x, name, func, *args, **kwargs):
+        '''
+        func(*args, **kwargs) memorized as 'name' in the evaluation 
+        cache entry of x
+        '''
+        entry=self._evalEntry(x)
+        if not name in entry:
+            entry[name]=func(*args, **kwargs)
+        return entry[name]
+
+    #------------------------------------------------------
+
+    def _clipGrad(self, grad):
+        if self.maxGradNorm==None:
+            return grad
+        normGrad=norm(grad)
+        if np.isnan(normGrad):
+            grad=np.zeros(grad.shape)
+        elif normGrad>self.maxGradNorm:
+            grad=(grad/normGrad)*(self.maxGradNorm)
+        return grad
+
+    #------------------------------------------------------
+
     #----| Classical overloads |----------------------------
     #-------------------------------------------------------
 
@@ -312,39 +1133,24 @@ class JTerm(object):
 
     #-------------------------------------------------------
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in self.cacheDependencies:
+            self.invalidate()
+
+    #-------------------------------------------------------
+
     def __add__(self, J2):
         if not isinstance(J2, JTerm):
             raise self.JTermError("J1,J2 <JTerm>")
-
-        def CFSum(x):
-            return self.J(x)+J2.J(x)
-        def gradCFSum(x):
-            return self.gradJ(x)+J2.gradJ(x)
-
-        if (self.maxGradNorm==None and J2.maxGradNorm==None):
-            maxGradNorm=None
-        elif self.maxGradNorm==None:
-            maxGradNorm=J2.maxGradNorm
-        elif J2.maxGradNorm==None:
-            maxGradNorm=self.maxGradNorm
-
-
-        JSum=JTerm(CFSum, gradCFSum, maxGradNorm=maxGradNorm)
-        return JSum
+        return JSum([self, J2])
 
     #------------------------------------------------------
 
     def __mul__(self, scalar):
         if not isinstance(scalar,float):
             raise self.JTermError("scalar <float>")
-
-        def CFMult(x):
-            return self.J(x)*scalar
-        def gradCFMult(x):
-            return self.gradJ(x)*scalar
-
-        JMult=JTerm(CFMult, gradCFMult)
-        return JMult
+        return JSum([self], weights=[scalar])
             
     
     #-------------------------------------------------------
@@ -363,6 +1169,117 @@ class JTerm(object):
 #---------------------------------------------------------------------
 #=====================================================================
 
+class JSum(JTerm):
+    """
+    JSum(terms, weights=None, maxGradNorm=None)
+
+        J(x)=sum_i w_i*J_i(x)
+
+        terms       :   <list of JTerm>
+        weights     :   w_i (default 1.) <list of float>
+        maxGradNorm :   clipping of the total gradient <None|float>
+                        (the terms clip their own gradients: the sum
+                         is only clipped when maxGradNorm is given)
+
+        Nested sums and scaled terms are flattened: ((J1+J2)+J3)*.5
+        is a single node of three weighted terms. Each point is
+        evaluated in one pass (each term's fused costAndGradJ), the
+        gradients being accumulated in place in a single array.
+
+        J.termCosts :   unweighted J_i at the last evaluated point
+                        <numpy.ndarray>
+    """
+
+    class JSumError(Exception):
+        pass
+
+    # the terms cache their own evaluations
+    evalCacheSize=0
+    cacheDependencies=('terms', 'weights')
+
+    #------------------------------------------------------
+    #----| Init |------------------------------------------
+    #------------------------------------------------------
+
+    def __init__(self, terms, weights=None, maxGradNorm=None):
+        if weights is None:
+            weights=[1.]*len(terms)
+        if len(weights)<>len(terms) or len(terms)==0:
+            raise self.JSumError("len(weights)==len(terms)>0")
+        if not (isinstance(maxGradNorm, float) or maxGradNorm==None):
+            raise self.JSumError("maxGradNorm <None|float>")
+
+        self.terms=[]
+        self.weights=[]
+        for J, w in zip(terms, weights):
+            if not isinstance(J, JTerm):
+                raise self.JSumError("terms <list of JTerm>")
+            if isinstance(J, JSum) and J.maxGradNorm==None:
+                self.terms.extend(J.terms)
+                self.weights.extend([w*wi for wi in J.weights])
+            else:
+                self.terms.append(J)
+                self.weights.append(float(w))
+        self.nTerms=len(self.terms)
+
+        self.maxGradNorm=maxGradNorm
+        self.args=()
+        self.termCosts=np.zeros(self.nTerms)
+
+        self.isMinimized=False
+        self.retall=False
+
+    #------------------------------------------------------
+    #----| Private methods |-------------------------------
+    #------------------------------------------------------
+
+    def _costFunc(self, x):
+        for i in xrange(self.nTerms):
+            self.termCosts[i]=self.terms[i].J(x)
+        return np.dot(self.weights, self.termCosts)
+
+    #------------------------------------------------------
+
+    def _gradCostFunc(self, x):
+        grad=np.zeros(x.shape)
+        for J, w in zip(self.terms, self.weights):
+            self.__accumulate(grad, J.gradJ(x), w)
+        return grad
+
+    #------------------------------------------------------
+
+    def _costAndGrad(self, x):
+        grad=np.zeros(x.shape)
+        for i in xrange(self.nTerms):
+            cost, g=self.terms[i].costAndGradJ(x)
+            self.termCosts[i]=cost
+            self.__accumulate(grad, g, self.weights[i])
+        return np.dot(self.weights, self.termCosts), grad
+
+    #------------------------------------------------------
+
+    def __accumulate(self, grad, g, w):
+        if w==1.:
+            grad+=g
+        else:
+            grad+=w*g
+
+    #------------------------------------------------------
+    #----| Classical overloads |----------------------------
+    #-------------------------------------------------------
+
+    def __str__(self):
+        output=super(JSum, self).__str__()
+        output+=" %d terms\n"%self.nTerms
+        for J, w, c in zip(self.terms, self.weights, self.termCosts):
+            output+="  %-24s weight=%-8g J=%f\n"%(J.__class__.__name__, 
+                                                    w, c)
+        return output
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
 class TrivialJTerm(JTerm):
     
     class TrivialJTermError(Exception):
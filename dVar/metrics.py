@@ -0,0 +1,571 @@
+import numpy as np
+import scipy.linalg as sciLin
+from abc import ABCMeta, abstractmethod
+
+#-----------------------------------------------------------
+#----| Utilitaries |----------------------------------------
+#-----------------------------------------------------------
+
+def makeMetric(metric, n, args=()):
+    """
+    Structured metric from its user specification
+
+        makeMetric(metric, n, args=())
+
+        metric  :   <None | float | numpy.ndarray | Metric | function>
+                        None            : identity
+                        float           : scalar times identity
+                        1D array        : diagonal
+                        2D array        : dense matrix
+                        function        : operator metric(y, *args)
+        n       :   size of the space
+        args    :   operator arguments <tuple>
+    """
+    if metric is None:
+        return ScalarMetric(1., n)
+    elif isinstance(metric, Metric):
+        if metric.n<>n:
+            raise ValueError("metric.n==%d"%n)
+        return metric
+    elif callable(metric):
+        return OperatorMetric(metric, n, args=args)
+    elif isinstance(metric, (float, int, np.number)):
+        return ScalarMetric(metric, n)
+    elif isinstance(metric, np.ndarray):
+        if metric.ndim==1:
+            return DiagMetric(metric)
+        elif metric.ndim==2:
+            return DenseMetric(metric)
+        else:
+            raise ValueError("metric.ndim=[1|2]")
+    else:
+        raise TypeError(
+            "metric <None | float | numpy.ndarray | Metric | function>")
+
+def makeCovMetric(R, n):
+    """
+    Metric R^{-1} from the error covariance R
+
+        makeCovMetric(R, n)
+
+        R       :   <float | numpy.ndarray | Metric>
+                        float           : variance
+                        1D array        : variances (diagonal R)
+                        2D array        : covariance matrix
+                                          (Cholesky factorized once)
+                        Metric          : already a metric R^{-1}
+                                          (e.g. CholMetric, 
+                                           corrCovMetric(...))
+        n       :   size of the space
+    """
+    if isinstance(R, Metric):
+        return makeMetric(R, n)
+    elif isinstance(R, (float, int, np.number)):
+        return ScalarMetric(1./R, n)
+    elif isinstance(R, np.ndarray):
+        if R.ndim==1:
+            if len(R)<>n:
+                raise ValueError("len(R)==%d"%n)
+            return DiagMetric(1./R)
+        elif R.ndim==2:
+            if R.shape<>(n,n):
+                raise ValueError("R.shape==(%d,%d)"%(n,n))
+            return CovMetric(R)
+        else:
+            raise ValueError("R.ndim=[1|2]")
+    else:
+        raise TypeError("R <float | numpy.ndarray | Metric>")
+
+def corrCovMetric(coord, sig, lCorr, period=None, bandwidth=None):
+    """
+    Metric R^{-1} for gaussian correlated observation errors
+
+        R_ij=sig_i*sig_j*exp(-d_ij^2/(2*lCorr^2))
+
+        coord       :   observation positions <numpy.ndarray>
+        sig         :   error standard deviation <float | numpy.ndarray>
+        lCorr       :   correlation length
+        period      :   domain length for periodic distances
+        bandwidth   :   number of sub-diagonals kept (R is then
+                            factorized in banded form: coord must
+                            be sorted)
+
+        <!> period and bandwidth are exclusive: a band cannot hold the
+            wrap-around correlations of a periodic domain. The
+            truncated band must stay positive definite (ValueError
+            otherwise): take a bandwidth covering a few lCorr.
+    """
+    if period<>None and bandwidth<>None:
+        raise ValueError("period and bandwidth are exclusive")
+    coord=np.asarray(coord, dtype=float)
+    n=len(coord)
+    sig=sig*np.ones(n)
+    if bandwidth==None:
+        dist=np.abs(np.subtract.outer(coord, coord))
+        if period<>None:
+            dist=np.minimum(dist, period-dist)
+        R=np.outer(sig, sig)*np.exp(-dist**2/(2.*lCorr**2))
+        return CovMetric(R)
+    else:
+        if np.any(np.diff(coord)<0.):
+            raise ValueError("banded R: coord must be sorted")
+        # k-th sub-diagonal from the k-th neighbour distances: 
+        # O(n*bandwidth), R is never formed
+        RBand=np.zeros((bandwidth+1, n))
+        for k in xrange(min(bandwidth, n-1)+1):
+            dist=coord[k:]-coord[:n-k]
+            RBand[k,:n-k]=sig[k:]*sig[:n-k]*np.exp(-dist**2/(2.*lCorr**2))
+        return BandedCovMetric(RBand)
+
+def blockMetric(blocks):
+    """
+    Block-diagonal assembly of metrics
+
+        Nested blocks are flattened, empty blocks dropped, and
+        scalar/diagonal blocks collapsed into a single DiagMetric
+        (or ScalarMetric) so that the result keeps the cheapest
+        structure.
+    """
+    flat=[]
+    for b in blocks:
+        if not isinstance(b, Metric):
+            raise TypeError("blocks <list of Metric>")
+        if isinstance(b, BlockMetric):
+            flat.extend(b.blocks)
+        elif b.n>0:
+            flat.append(b)
+
+    if len(flat)==0:
+        return ScalarMetric(1., 0)
+    elif len(flat)==1:
+        return flat[0]
+    elif all(isinstance(b, ScalarMetric) for b in flat):
+        if all(b.value==flat[0].value for b in flat):
+            return ScalarMetric(flat[0].value, sum(b.n for b in flat))
+        return DiagMetric(np.concatenate([b.diagonal() for b in flat]))
+    elif all(isinstance(b, (ScalarMetric, DiagMetric)) for b in flat):
+        return DiagMetric(np.concatenate([b.diagonal() for b in flat]))
+    else:
+        return BlockMetric(flat)
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class Metric(object):
+    """
+    Metric (information matrix, e.g. R^{-1}) master class
+
+        <!> This is a master class not meant to be instantiated, only
+            subclasses should.
+
+        Subclasses keep the structure of the matrix and apply it at
+        the matching cost (CholMetric, CovMetric and BandedCovMetric
+        apply R^{-1} from a cached factorization of R); all methods 
+        act along the last axis:
+
+            M.apply(y)          :   M.y
+            M.prosca(y1, y2)    :   y1'.M.y2
+            M.diagonal()        :   diagonal of M
+            M.dense()           :   dense (n,n) matrix
+            M.covSqrtDot(eta)   :   S.eta with S.S'=M^{-1} (e.g. 
+                                    R^{1/2}.eta: eta~N(0,I) gives
+                                    errors of covariance R)
+            numpy.asarray(M)    :   dense (n,n) matrix (so that
+                                    numpy.dot(M, y) still works)
+            M1+M2               :   block-diagonal assembly
+
+        apply() and diagonal() are abstract: a subclass missing one of
+        them cannot be instantiated.
+    """
+
+    __metaclass__=ABCMeta
+
+    n=0
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    @abstractmethod
+    def apply(self, y):
+        pass
+
+    @abstractmethod
+    def diagonal(self):
+        pass
+
+    def dense(self):
+        return self.apply(np.eye(self.n))
+
+    def covSqrtDot(self, eta):
+        # M=CC' => M^{-1}=C'^{-1}C^{-1}: S=C'^{-1}
+        eta=self._yValidate(eta)
+        C=sciLin.cholesky(self.dense(), lower=True)
+        x=sciLin.solve_triangular(C, eta.reshape(-1, self.n).T, 
+                                    lower=True, trans='T')
+        return x.T.reshape(eta.shape)
+
+    #------------------------------------------------------
+
+    def prosca(self, y1, y2):
+        return np.sum(np.asarray(y1)*self.apply(y2), axis=-1)
+
+    def squareNorm(self, y):
+        return self.prosca(y, y)
+
+    #------------------------------------------------------
+    #----| Private methods |-------------------------------
+    #------------------------------------------------------
+
+    def _yValidate(self, y):
+        y=np.asarray(y)
+        if y.shape[-1:]<>(self.n,):
+            raise ValueError("y.shape[-1]==%d"%self.n)
+        return y
+
+    #------------------------------------------------------
+    #----| Classical overloads |---------------------------
+    #------------------------------------------------------
+
+    def __add__(self, metric):
+        return blockMetric([self, metric])
+
+    def __len__(self):
+        return self.n
+
+    def __array__(self, dtype=None):
+        M=np.asarray(self.dense())
+        if dtype<>None:
+            M=M.astype(dtype)
+        return M
+
+    def __str__(self):
+        return "<%s n=%d>"%(self.__class__.__name__, self.n)
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class ScalarMetric(Metric):
+    """
+    Scalar metric: value*I
+
+        ScalarMetric(value, n)
+    """
+
+    def __init__(self, value, n):
+        if not isinstance(value, (float, int, np.number)):
+            raise TypeError("value <float>")
+        self.value=float(value)
+        self.n=int(n)
+
+    def apply(self, y):
+        return self.value*self._yValidate(y)
+
+    def diagonal(self):
+        return self.value*np.ones(self.n)
+
+    def dense(self):
+        return self.value*np.eye(self.n)
+
+    def covSqrtDot(self, eta):
+        return self._yValidate(eta)/np.sqrt(self.value)
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class DiagMetric(Metric):
+    """
+    Diagonal metric: diag(d)
+
+        DiagMetric(d)
+    """
+
+    def __init__(self, d):
+        d=np.asarray(d, dtype=float)
+        if d.ndim<>1:
+            raise ValueError("d.ndim==1")
+        self.d=d
+        self.n=len(d)
+
+    def apply(self, y):
+        return self.d*self._yValidate(y)
+
+    def diagonal(self):
+        return self.d
+
+    def dense(self):
+        return np.diag(self.d)
+
+    def covSqrtDot(self, eta):
+        return self._yValidate(eta)/np.sqrt(self.d)
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class DenseMetric(Metric):
+    """
+    Dense (symmetric) metric
+
+        DenseMetric(matrix)
+    """
+
+    def __init__(self, matrix):
+        matrix=np.asarray(matrix, dtype=float)
+        if matrix.ndim<>2 or matrix.shape[0]<>matrix.shape[1]:
+            raise ValueError("matrix.shape==(n,n)")
+        self.matrix=matrix
+        self.n=matrix.shape[0]
+
+    def apply(self, y):
+        return np.dot(self._yValidate(y), self.matrix.T)
+
+    def diagonal(self):
+        return np.diag(self.matrix).copy()
+
+    def dense(self):
+        return self.matrix
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class OperatorMetric(Metric):
+    """
+    Metric given as a (symmetric) linear operator
+
+        OperatorMetric(op, n, args=(), batched=True)
+
+        op      :   op(y, *args)=M.y <function>
+                        (e.g. B_isoHomo_inv_op or BIsoHomo(...).inv)
+        n       :   size of the space
+        args    :   operator arguments <tuple>
+        batched :   op transforms a (..., n) batch along its last axis
+                        (as the B_*_isoHomo_* operators); otherwise
+                        it is called once per vector
+
+        The matrix is never formed: each application is one operator
+        call (one per vector if not batched).
+    """
+
+    def __init__(self, op, n, args=(), batched=True):
+        if not callable(op):
+            raise TypeError("op <function>")
+        if not isinstance(args, tuple):
+            raise TypeError("args <tuple>")
+        self.op=op
+        self.args=args
+        self.n=int(n)
+        self.batched=batched
+
+    def apply(self, y):
+        y=self._yValidate(y)
+        if y.ndim==1 or self.batched:
+            return self.op(y, *self.args)
+        My=np.empty(y.shape)
+        for idx in np.ndindex(*y.shape[:-1]):
+            My[idx]=self.op(y[idx], *self.args)
+        return My
+
+    def diagonal(self):
+        return np.diag(self.dense()).copy()
+
+    def dense(self):
+        return self.apply(np.eye(self.n)).T
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class BlockMetric(Metric):
+    """
+    Block-diagonal metric
+
+        BlockMetric(blocks)
+
+        blocks  :   <list of Metric>
+
+        (use blockMetric() or '+' to get the cheapest structure)
+    """
+
+    def __init__(self, blocks):
+        for b in blocks:
+            if not isinstance(b, Metric):
+                raise TypeError("blocks <list of Metric>")
+        self.blocks=list(blocks)
+        self.offsets=np.cumsum([0]+[b.n for b in self.blocks])
+        self.n=int(self.offsets[-1])
+
+    def apply(self, y):
+        y=self._yValidate(y)
+        My=np.empty(y.shape)
+        for i in xrange(len(self.blocks)):
+            sl=slice(self.offsets[i], self.offsets[i+1])
+            My[...,sl]=self.blocks[i].apply(y[...,sl])
+        return My
+
+    def diagonal(self):
+        return np.concatenate([b.diagonal() for b in self.blocks])
+
+    def dense(self):
+        M=np.zeros((self.n, self.n))
+        for i in xrange(len(self.blocks)):
+            sl=slice(self.offsets[i], self.offsets[i+1])
+            M[sl, sl]=self.blocks[i].dense()
+        return M
+
+    def covSqrtDot(self, eta):
+        eta=self._yValidate(eta)
+        x=np.empty(eta.shape)
+        for i in xrange(len(self.blocks)):
+            sl=slice(self.offsets[i], self.offsets[i+1])
+            x[...,sl]=self.blocks[i].covSqrtDot(eta[...,sl])
+        return x
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class CholMetric(Metric):
+    """
+    Metric R^{-1} from the lower Cholesky factor of R (R=LL')
+
+        CholMetric(L)
+
+        R^{-1} is never formed: it is applied with two triangular
+        solves.
+    """
+
+    def __init__(self, L):
+        L=np.asarray(L, dtype=float)
+        if L.ndim<>2 or L.shape[0]<>L.shape[1]:
+            raise ValueError("L.shape==(n,n)")
+        self.L=np.tril(L)
+        self.n=L.shape[0]
+
+    #------------------------------------------------------
+    #----| Private methods |-------------------------------
+    #------------------------------------------------------
+
+    def _flat(self, y):
+        y=self._yValidate(y)
+        return y, y.reshape(-1, self.n).T
+
+    def _whiten(self, y):
+        """
+        L^{-1}.y
+        """
+        y, yFlat=self._flat(y)
+        z=sciLin.solve_triangular(self.L, yFlat, lower=True)
+        return z.T.reshape(y.shape)
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    def apply(self, y):
+        y, yFlat=self._flat(y)
+        My=sciLin.cho_solve((self.L, True), yFlat)
+        return My.T.reshape(y.shape)
+
+    def prosca(self, y1, y2):
+        z2=self._whiten(y2)
+        if y1 is y2:
+            z1=z2
+        else:
+            z1=self._whiten(y1)
+        return np.sum(z1*z2, axis=-1)
+
+    def diagonal(self):
+        Linv=sciLin.solve_triangular(self.L, np.eye(self.n), lower=True)
+        return np.sum(Linv**2, axis=0)
+
+    def dense(self):
+        return sciLin.cho_solve((self.L, True), np.eye(self.n))
+
+    def covSqrtDot(self, eta):
+        # R=LL'
+        return np.dot(self._yValidate(eta), self.L.T)
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class CovMetric(CholMetric):
+    """
+    Metric R^{-1} from the error covariance matrix R
+
+        CovMetric(R)
+
+        R is Cholesky factorized once at construction.
+    """
+
+    def __init__(self, R):
+        R=np.asarray(R, dtype=float)
+        if R.ndim<>2 or R.shape[0]<>R.shape[1]:
+            raise ValueError("R.shape==(n,n)")
+        self.R=R
+        super(CovMetric, self).__init__(sciLin.cholesky(R, lower=True))
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class BandedCovMetric(Metric):
+    """
+    Metric R^{-1} from a banded error covariance matrix R
+
+        BandedCovMetric(RBand)
+
+        RBand   :   (bandwidth+1, n) lower banded form of R
+                        RBand[i, j]=R[i+j, j]
+                    (see scipy.linalg.cholesky_banded)
+
+        R is factorized once; each application costs
+        O(n*bandwidth).
+    """
+
+    def __init__(self, RBand):
+        RBand=np.asarray(RBand, dtype=float)
+        if RBand.ndim<>2:
+            raise ValueError("RBand.ndim==2")
+        self.bandwidth=RBand.shape[0]-1
+        self.n=RBand.shape[1]
+        self.RBand=RBand
+        try:
+            self.cBand=sciLin.cholesky_banded(RBand, lower=True)
+        except np.linalg.LinAlgError:
+            raise ValueError(
+                "banded R not positive definite (bandwidth=%d): "%(
+                    self.bandwidth)+"widen or taper the band")
+
+    @staticmethod
+    def fromDense(R, bandwidth):
+        n=R.shape[0]
+        RBand=np.zeros((bandwidth+1, n))
+        for k in xrange(bandwidth+1):
+            RBand[k,:n-k]=np.diag(R, -k)
+        return BandedCovMetric(RBand)
+
+    def apply(self, y):
+        y=self._yValidate(y)
+        My=sciLin.cho_solve_banded((self.cBand, True), 
+                                    y.reshape(-1, self.n).T)
+        return My.T.reshape(y.shape)
+
+    def diagonal(self):
+        return np.diag(self.dense()).copy()
+
+    def dense(self):
+        return sciLin.cho_solve_banded((self.cBand, True), np.eye(self.n))
+
+    def covSqrtDot(self, eta):
+        # R=LL', L[j+k, j]=cBand[k, j]: O(n*bandwidth)
+        eta=self._yValidate(eta)
+        x=np.zeros(eta.shape)
+        for k in xrange(self.bandwidth+1):
+            x[...,k:]+=self.cBand[k,:self.n-k]*eta[...,:self.n-k]
+        return x
@@ -31,13 +31,13 @@ def rCTilde_sqrt_isoHomo(g, fCorr):
     """
     rFTilde=g.N*c2r(np.fft.fft(fCorr))
 
+    nDemi=(g.N-1)//2
     rCTilde=np.zeros(g.N)
     rCTilde[0]=np.abs(rFTilde[0])
-    for i in xrange(1, (g.N-1)/2+1):
-        # rFTilde[idx pairs] contain real coefficients
-        # resulting from c2r.C.(c2r)*
-        rCTilde[2*i-1]=np.abs(rFTilde[2*i-1])
-        rCTilde[2*i]=np.abs(rFTilde[2*i-1])
+    # rFTilde[idx pairs] contain real coefficients
+    # resulting from c2r.C.(c2r)*
+    rCTilde[1:2*nDemi+1:2]=np.abs(rFTilde[1:2*nDemi+1:2])
+    rCTilde[2:2*nDemi+1:2]=np.abs(rFTilde[1:2*nDemi+1:2])
     
     if rCTilde.min()<0.:
         raise Exception(
@@ -51,20 +51,169 @@ def make_BisoHomo_args(grid, bkgLC, bkgSig):
     sig=bkgSig*np.ones(grid.N)
     return (sig, rCTilde_sqrt)
 
+def make_BisoHomo_op(grid, bkgLC, bkgSig):
+    return BIsoHomo(*make_BisoHomo_args(grid, bkgLC, bkgSig))
+
+#----| Operator object |--------------------------
+
+class BIsoHomo(object):
+    """
+    Isotropic and homogeneous B operator
+
+    BIsoHomo(sig, rCTilde_sqrt)
+
+        sig             :   1D array of std
+                            (diagonal os Sigma matrix)
+        rCTilde_sqrt    :   1D array of the diagonal
+                            of CTilde_sqrt (in 'r' basis)
+
+        B=BIsoHomo(*make_BisoHomo_args(grid, bkgLC, bkgSig))
+
+    Spectral weights are computed once in numpy.fft.rfft layout
+    (mode 0, then modes 1..(N-1)/2 as real/imaginary weight pairs),
+    so that each application costs one real FFT and no
+    'r' <-> 'c' injection.
+
+        B.sqrt(xi)          :   B^{1/2}
+        B.sqrt_adj(x)       :   B^{1/2}'
+        B.apply(x)          :   B
+        B.inv_sqrt(x)       :   B^{-1/2}
+        B.inv_sqrt_adj(xi)  :   B^{-1/2}'
+        B.inv(x)            :   B^{-1}
+
+    Same results as the B_*_isoHomo_* functions (the zero modes of
+    rCTilde_sqrt, if any, are pseudo-inverted).
+
+    All methods accept a single state (N,) or an ensemble
+    (nMembers, N) and transform along the last axis in one FFT call.
+    """
+
+    #------------------------------------------------------
+    #----| Init |------------------------------------------
+    #------------------------------------------------------
+
+    def __init__(self, sig, rCTilde_sqrt):
+        rCTilde_sqrt=np.asarray(rCTilde_sqrt, dtype=float)
+        if rCTilde_sqrt.ndim<>1:
+            raise ValueError("rCTilde_sqrt.ndim==1")
+        self.N=len(rCTilde_sqrt)
+        N=self.N
+        sig=np.asarray(sig, dtype=float)*np.ones(N)
+        if sig.shape<>(N,):
+            raise ValueError("sig.shape==(N,)")
+        self.sig=sig
+        self.rCTilde_sqrt=rCTilde_sqrt
+
+        self.nDemi=(N-1)//2
+        self.nSpec=N//2+1
+
+        rCInv=np.zeros(N)
+        nonZero=(rCTilde_sqrt<>0.)
+        rCInv[nonZero]=1./rCTilde_sqrt[nonZero]
+        sigInv=np.zeros(N)
+        sigInv[sig<>0.]=1./sig[sig<>0.]
+
+        #----| rfft layout weights |--------------
+        # w[0] weights mode 0, wRe/wIm weight modes 1..nDemi
+        self._sqrtW=self.__rfftWeights(rCTilde_sqrt, 1., 0.5)
+        self._sqrtAdjW=self.__rfftWeights(rCTilde_sqrt/N, 1., 1.)
+        self._invSqrtW=self.__rfftWeights(rCInv, 1., 2.)
+        self._invSqrtAdjW=self.__rfftWeights(rCInv, 1., 1.)
+
+        self._sigInv=sigInv
+        self._NSigInv=N*sigInv
+
+    #------------------------------------------------------
+    #----| Private methods |-------------------------------
+    #------------------------------------------------------
+
+    def __rfftWeights(self, rW, f0, f):
+        nD=self.nDemi
+        return (f0*rW[0], f*rW[1:2*nD+1:2], f*rW[2:2*nD+1:2])
+
+    def _r2Spec(self, xi, w):
+        """
+        'r' representation to (weighted) rfft layout
+        """
+        nD=self.nDemi
+        w0, wRe, wIm=w
+        spec=np.zeros(xi.shape[:-1]+(self.nSpec,), dtype=complex)
+        spec.real[...,0]=w0*xi[...,0]
+        spec.real[...,1:nD+1]=wRe*xi[...,1:2*nD+1:2]
+        spec.imag[...,1:nD+1]=wIm*xi[...,2:2*nD+1:2]
+        return spec
+
+    def _spec2R(self, spec, w):
+        """
+        (weighted) rfft layout to 'r' representation
+        """
+        nD=self.nDemi
+        w0, wRe, wIm=w
+        xi=np.zeros(spec.shape[:-1]+(self.N,))
+        xi[...,0]=w0*spec.real[...,0]
+        xi[...,1:2*nD+1:2]=wRe*spec.real[...,1:nD+1]
+        xi[...,2:2*nD+1:2]=wIm*spec.imag[...,1:nD+1]
+        return xi
+
+    def _validate(self, x):
+        x=np.asarray(x, dtype=float)
+        if x.shape[-1:]<>(self.N,):
+            raise ValueError("x.shape[-1]==N")
+        return x
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    def sqrt(self, xi):
+        xi=self._validate(xi)
+        spec=self._r2Spec(xi, self._sqrtW)              #   1, 2
+        return np.fft.irfft(spec, n=self.N)*self.sig    #   3, 4
+
+    def sqrt_adj(self, x):
+        x=self._validate(x)
+        spec=np.fft.rfft(x*self.sig)                    #   4.T, 3.T
+        return self._spec2R(spec, self._sqrtAdjW)       #   2.T, 1.T
+
+    def apply(self, x):
+        return self.sqrt(self.sqrt_adj(x))
+
+    #------------------------------------------------------
+
+    def inv_sqrt(self, x):
+        x=self._validate(x)
+        spec=np.fft.rfft(x*self._sigInv)                #   1, 2
+        return self._spec2R(spec, self._invSqrtW)       #   3, 4, 5
+
+    def inv_sqrt_adj(self, xi):
+        xi=self._validate(xi)
+        spec=self._r2Spec(xi, self._invSqrtAdjW)        #   5.T, 4.T, 3.T
+        return np.fft.irfft(spec, n=self.N)*self._NSigInv   #   2.T, 1.T
+
+    def inv(self, x):
+        return self.inv_sqrt_adj(self.inv_sqrt(x))
+
+    #------------------------------------------------------
+    #----| Classical overloads |----------------------------
+    #-------------------------------------------------------
+
+    def __str__(self):
+        output="____| BIsoHomo |____________________________"
+        output+="\n   N=%d"%self.N
+        output+="\n____________________________________________"
+        return output
+
 #----| Fourier operators |------------------------
 
 def ifft_Adj(x):
-    N=len(x)
-    xi=np.zeros(N)
-    xi=np.fft.fft(x)
+    N=np.shape(x)[-1]
+    xi=np.fft.fft(x, axis=-1)
     xi=xi/N
     return xi
 
 def fft_Adj(xi):
-    N=len(xi)
-
-    x=np.zeros(N)
-    x=np.fft.ifft(xi).real
+    N=np.shape(xi)[-1]
+    x=np.fft.ifft(xi, axis=-1).real
     x=x*N
     return x
 
@@ -74,26 +223,23 @@ def B_sqrt_isoHomo_op(xi, sig, rCTilde_sqrt, aliasing=3):
     """
         B^{1/2} operator
 
+        xi              :   (N,) or (nMembers, N) array
         sig             :   1D array of std
                             (diagonal os Sigma matrix)
         rCTilde_sqrt    :   1D array of the diagonal
                             of CTilde_sqrt (in 'r' basis)
+
+        <!> builds a BIsoHomo at each call: when applied repeatedly,
+            use BIsoHomo(sig, rCTilde_sqrt).sqrt instead.
     """
-    xiR=rCTilde_sqrt*xi         #   1
-    xiC=r2c(xiR)                #   2
-    x1=np.fft.ifft(xiC).real    #   3
-    return x1*sig               #   4
+    return BIsoHomo(sig, rCTilde_sqrt).sqrt(xi)
 
 
 def B_sqrt_isoHomo_op_Adj(x, sig, rCTilde_sqrt, aliasing=3):
-    x1=x*sig                    #   4.T
-    xiC=ifft_Adj(x1)            #   3.T
-    xiR=r2c_Adj(xiC)            #   2.T
-    return rCTilde_sqrt*xiR     #   1.T
+    return BIsoHomo(sig, rCTilde_sqrt).sqrt_adj(x)
 
 def B_isoHomo_op(x, sig, rCTilde_sqrt):
-    return B_sqrt_isoHomo_op(B_sqrt_isoHomo_op_Adj(x, sig, rCTilde_sqrt),
-                        sig, rCTilde_sqrt)
+    return BIsoHomo(sig, rCTilde_sqrt).apply(x)
 
 #----| B^{1/2} inverse operators |----------------
 
@@ -111,16 +257,7 @@ def B_sqrt_isoHomo_inv_op(x, sig, rCTilde_sqrt):
         is the inverse of B^{1/2}.
         
     """
-    N=len(x)
-    xiR2=np.zeros(N)
-
-    x2=x*sig**(-1)                    #   1
-    xiC=np.fft.fft(x2)                #   2
-    xiR=r2c_Adj(xiC)                  #   3
-    xiR2[0]=xiR[0]
-    for i in xrange(1,N):
-        xiR2[i]=2.*xiR[i]             #   4
-    return rCTilde_sqrt**(-1)*xiR2    #   5
+    return BIsoHomo(sig, rCTilde_sqrt).inv_sqrt(x)
     
 def B_sqrt_isoHomo_inv_op_Adj(xi, sig, rCTilde_sqrt):
     """
@@ -131,31 +268,22 @@ def B_sqrt_isoHomo_inv_op_Adj(xi, sig, rCTilde_sqrt):
         rCTilde_sqrt    :   1D array of the diagonal
                             of CTilde_sqrt (in 'r' basis)
     """
-    N=len(xi)
-    xiR=np.zeros(N)
-
-    xiR2=rCTilde_sqrt**(-1)*xi      #   5.T
-    for i in xrange(1,N):
-        xiR[i]=2.*xiR2[i]
-    xiR[0]=xiR2[0]                  #   4.T
-    xiC=r2c(xiR)                    #   3.T
-    x2=fft_Adj(xiC)                 #   2.T
-    return x2*sig**(-1)             #   1.T
+    return BIsoHomo(sig, rCTilde_sqrt).inv_sqrt_adj(xi)
 
 
 def B_isoHomo_inv_op(x, sig, rCTilde_sqrt):
-    return B_sqrt_isoHomo_inv_op_Adj(B_sqrt_isoHomo_inv_op(
-                        x, sig, rCTilde_sqrt),
-                        sig, rCTilde_sqrt)
+    return BIsoHomo(sig, rCTilde_sqrt).inv(x)
 
 
 
 def normBInv2(x, grid, bkgLC, bkgSig):
     """ 
         x'.B^{-1}.x
+
+        (one value per member for x.shape=(nMembers, N))
     """
     B_args=make_BisoHomo_args(grid, bkgLC, bkgSig)
-    return np.dot(x, B_isoHomo_inv_op(x, *B_args))
+    return np.sum(x*B_isoHomo_inv_op(x, *B_args), axis=-1)
 
 def normBInv2Norm(x, grid, bkgLC, bkgSig):
     """ 
@@ -169,10 +297,12 @@ def normBInv2Norm(x, grid, bkgLC, bkgSig):
 #-------------------------------------------------
 
 def B_sqrt_str_op(xi, sig, strVec):
-    return sig*strVec*xi
+    # xi : scalar or (nMembers,) array
+    return sig*np.multiply.outer(xi, strVec)
 
 def B_sqrt_str_op_Adj(x, sig, strVec):
-    return sig*np.dot(strVec,x)
+    # x : (N,) or (nMembers, N) array
+    return sig*np.dot(x, strVec)
 
 def B_str_op(x, sig, strVec):
     return B_sqrt_str_op(B_sqrt_str_op_Adj(x, sig, strVec),
@@ -188,8 +318,10 @@ def normBInvAdapted2(x, grid, strVec, bkgLC, bkgSig, sigAdapted):
     (SigMat, rCTilde_sqrt)=make_BisoHomo_args(grid, bkgLC, bkgSig)
     xi1=B_sqrt_isoHomo_inv_op(x, SigMat, rCTilde_sqrt)
     xiStr=B_sqrt_isoHomo_inv_op(strVec, SigMat, rCTilde_sqrt)
-    xi2=xi1-sigAdapted**2/(1.+sigAdapted**2)*np.dot(np.outer(xiStr,xiStr),xi1)
-    return np.dot(x,B_sqrt_isoHomo_inv_op_Adj(xi2, SigMat, rCTilde_sqrt))
+    xi2=xi1-sigAdapted**2/(1.+sigAdapted**2)*np.multiply.outer(
+                                        np.dot(xi1, xiStr), xiStr)
+    return np.sum(x*B_sqrt_isoHomo_inv_op_Adj(xi2, SigMat, rCTilde_sqrt),
+                    axis=-1)
 
 #=====================================================================
 #---------------------------------------------------------------------
@@ -1,4 +1,6 @@
 from jTerm import JTerm, norm
+from metrics import makeMetric
+from instrumentation import timedCall
 from observations import StaticObs, TimeWindowObs
 from pseudoSpec1D import PeriodicGrid, Launcher, TLMLauncher
 import numpy as np
@@ -7,19 +9,34 @@ class BkgJTerm(JTerm):
     """
     Background model state JTerm subclass
 
-        BkgJTerm(bkg, grid, metric=None)
-
-            bkg     :   background model state <numpy.ndarray>
-            grid    :   <PeriodicGrid>
-            metric  :   information metric (B^{-1})
-                            <float | numpy.ndarray >
+        BkgJTerm(bkg, grid, metric=1., metricArgs=())
+
+            bkg         :   background model state <numpy.ndarray>
+            grid        :   <PeriodicGrid>
+            metric      :   information metric (B^{-1})
+                                <float | numpy.ndarray | Metric | 
+                                 function>
+                                float       : scalar times identity
+                                1D array    : diagonal
+                                2D array    : dense matrix
+                                function    : operator
+                                                metric(x, *metricArgs)
+                                                (e.g. B_isoHomo_inv_op)
+            metricArgs  :   operator arguments <tuple>
+
+        B^{-1} is applied at the cost of its structure (self.metric
+        is a Metric): no dense matrix is formed for scalar, diagonal
+        or operator metrics.
     """
 
+    cacheDependencies=('bkg', 'metric', 'grid')
+
     #------------------------------------------------------
     #----| Init |------------------------------------------
     #------------------------------------------------------
 
-    def __init__(self, bkg, g, metric=1., maxGradNorm=None): 
+    def __init__(self, bkg, g, metric=1., maxGradNorm=None, 
+                    metricArgs=()): 
 
         if not isinstance(g, PeriodicGrid):
             raise TypeError("g <pseudoSpec1D.PeriodicGrid>")
@@ -32,18 +49,9 @@ class BkgJTerm(JTerm):
         self.bkg=bkg
         self.N=self.grid.N
 
-        if isinstance(metric, (float, int)):
-            self.metric=metric*np.eye(self.N)
-        elif isinstance(metric, np.ndarray):
-            if metric.ndim==1:
-                self.metric=np.diag(metric)
-            elif metric.ndim==2:
-                self.metric=metric
-            else:
-                raise ValueError("metric.ndim=[1|2]")
-        else:   
-            raise TypeError("metric <None | numpy.ndarray>")
-
+        if not isinstance(metricArgs, tuple):
+            raise TypeError("metricArgs <tuple>")
+        self.metric=makeMetric(metric, self.N, args=metricArgs)
 
         if not (isinstance(maxGradNorm, float) or maxGradNorm==None):
             raise TypeError("maxGradNorm <None|float>")
@@ -71,14 +79,23 @@ class BkgJTerm(JTerm):
     def _costFunc(self, x): 
         self.__xValidate(x)
         inno=(x-self.bkg)
-        return 0.5*np.dot(inno, np.dot(self.metric, inno)) 
+        return 0.5*self.metric.prosca(inno, inno)
 
     #------------------------------------------------------
 
     def _gradCostFunc(self, x):
+        return self._costAndGrad(x)[1]
+
+    #------------------------------------------------------
+
+    def _costAndGrad(self, x):
+        '''
+        J=0.5*(x-bkg)'B^{-1}(x-bkg), grad J=B^{-1}(x-bkg)
+        '''
         self.__xValidate(x)
         inno=(x-self.bkg)
-        return -np.dot(self.metric, inno)
+        Binno=self.metric.apply(inno)
+        return 0.5*np.dot(inno, Binno), Binno
 
 #=====================================================================
 #---------------------------------------------------------------------
@@ -93,6 +110,9 @@ class StaticObsJTerm(JTerm):
         obs             :   <StaticObs>
         g               :   <PeriodicGrid>
     """
+
+    cacheDependencies=('obs', 'modelGrid', 'obsOpTLMAdj', 
+                        'obsOpTLMAdjArgs')
         
     #------------------------------------------------------
     #----| Init |------------------------------------------
@@ -135,24 +155,30 @@ class StaticObsJTerm(JTerm):
 
     #------------------------------------------------------
 
+    def __inno(self, x):
+        return self._memo(x, 'inno', timedCall, 'obsOp', self.obs.innovation,
+                            x, self.modelGrid)
+
+    #------------------------------------------------------
+
     def _costFunc(self, x, normalize=False): 
         self.__xValidate(x)
-        inno=self.obs.innovation(x, self.modelGrid)
+        inno=self.__inno(x)
         if normalize:
-            return (0.5/self.nObs)*np.dot(
-                                inno, np.dot(self.obs.metric, inno)) 
+            return (0.5/self.nObs)*self.obs.metric.prosca(inno, inno)
         else:
-            return 0.5*np.dot(inno, np.dot(self.obs.metric, inno)) 
+            return 0.5*self.obs.metric.prosca(inno, inno)
 
     #------------------------------------------------------
 
     def _gradCostFunc(self, x, normalize=False):
         self.__xValidate(x)
-        inno=self.obs.innovation(x, self.modelGrid)
+        inno=self.__inno(x)
         if self.obsOpTLMAdj==None:
-            grad= -np.dot(self.obs.metric, inno)
+            grad= -self.obs.metric.apply(inno)
         else:
-            grad= -self.obsOpTLMAdj(np.dot(self.obs.metric, inno),
+            grad= -timedCall('obsOpAdj', self.obsOpTLMAdj, 
+                                            self.obs.metric.apply(inno),
                                             self.modelGrid,
                                             self.obs.coord,
                                             *self.obsOpTLMAdjArgs)
@@ -163,6 +189,21 @@ class StaticObsJTerm(JTerm):
             pass 
         return grad
 
+    #------------------------------------------------------
+
+    def _costAndGrad(self, x):
+        self.__xValidate(x)
+        inno=self.__inno(x)
+        Rinno=self.obs.metric.apply(inno)
+        Jo=0.5*np.dot(inno, Rinno)
+        if self.obsOpTLMAdj==None:
+            grad= -Rinno
+        else:
+            grad= -timedCall('obsOpAdj', self.obsOpTLMAdj, Rinno, 
+                                            self.modelGrid, self.obs.coord,
+                                            *self.obsOpTLMAdjArgs)
+        return Jo, grad
+
 #=====================================================================
 #---------------------------------------------------------------------
 #=====================================================================
@@ -176,7 +217,14 @@ class TWObsJTerm(JTerm):
         obs             :   <StaticObs>
         nlModel         :   propagator model <Launcher>
         tlm             :   tangean linear model <TLMLauncher>
+
+        The cost alone integrates the model to the observation times
+        only (TimeWindowObs.innovation); the fused cost and gradient
+        memorize the whole trajectory, which then also gives the
+        innovations.
     """
+
+    cacheDependencies=('obs', 'nlModel', 'tlm', 'tWin', 'modelGrid')
     
     #------------------------------------------------------
     #----| Init |------------------------------------------
@@ -225,6 +273,10 @@ class TWObsJTerm(JTerm):
     #------------------------------------------------------
 
     def __obsCycleExtract(self, obs):
+        if obs.empty or (obs.tMin>self.tWin[0] 
+                            and obs.tMax<=self.tWin[1]):
+            # already within the window (e.g. cycling.windowObs)
+            return obs
         obsTimes=obs.d_Obs.keys()
         obsTimes.sort()
 
@@ -249,34 +301,68 @@ class TWObsJTerm(JTerm):
             
     #------------------------------------------------------
 
+    def __traj(self, x):
+        return self._memo(x, 'traj', timedCall, 'nlModel.integrate',
+                            self.nlModel.integrate, x, 
+                            self.obs.times[-1]-self.tWin[0], 
+                            t0=self.tWin[0])
+
+    def __inno(self, x, traj=None):
+        # stacked innovations (see TimeWindowObs)
+        entry=self._evalEntry(x)
+        if not 'inno' in entry:
+            if traj is None:
+                traj=entry.get('traj', None)
+            if traj is not None:
+                entry['inno']=self.obs.innovationTraj(traj, 
+                                            self.modelGrid, stacked=True)
+            else:
+                entry['inno']=self.obs.innovation(x, self.nlModel, 
+                                            t0=self.tWin[0], stacked=True)
+        return entry['inno']
+
+    #------------------------------------------------------
+
     def _costFunc(self, x): 
         if self.obs.empty:
             return 0.
         else:
             self.__xValidate(x)
-            d_inno=self.obs.innovation(x, self.nlModel, t0=self.tWin[0])
-            Jo=0.5*self.obs.prosca(d_inno, d_inno)
+            inno=self.__inno(x)
+            Jo=0.5*self.obs.prosca(inno, inno)
             return Jo
 
     #------------------------------------------------------
 
     def _gradCostFunc(self, x):
+        return self.__costAndGrad(x)[1]
+
+    #------------------------------------------------------
+
+    def _costAndGrad(self, x):
+        return self.__costAndGrad(x)
+
+    #------------------------------------------------------
+
+    def __costAndGrad(self, x):
+        '''
+        Fused cost and gradient: the nonlinear model is integrated
+        once (memorized), its trajectory gives the innovations and
+        references the TLM.
+        '''
         self.__xValidate(x)
         if self.obs.empty:
-            return np.zeros(shape=x.shape)
+            return 0., np.zeros(shape=x.shape)
         else:
-            self.tlm.reference(self.nlModel.integrate(
-                                x, 
-                                self.obs.times[-1]-self.tWin[0],
-                                t0=self.tWin[0]))
-            d_inno=self.obs.innovation(x, self.nlModel, t0=self.tWin[0])
-            d_NormInno={}
-            for t in d_inno.keys():
-                d_NormInno[t]=np.dot(self.obs[t].metric,d_inno[t])
+            traj=self.__traj(x)
+            timedCall('tlm.reference', self.tlm.reference, traj)
+            inno=self.__inno(x, traj)
+            Rinno=self.obs.applyMetric(inno)
+            Jo=0.5*np.dot(inno, Rinno)
         
-            grad=-self.obs.modelEquivalent_Adj(d_NormInno, self.tlm, 
+            grad=-self.obs.modelEquivalent_Adj(Rinno, self.tlm, 
                                             t0=self.tWin[0])
-            return grad
+            return Jo, grad
 
 
 #=====================================================================
@@ -333,11 +419,11 @@ if __name__=="__main__":
         obs=twObs1[tTotal]
         J2=StaticObsJTerm(obs, g)
         x=kdv.rndSpecVec(g, amp=1., seed=1)
-        J2.gradTest(x)
+        print(J2.gradTest(x))
 
 
     if testGradJTWObs:
         print("\nTWObsJTerm gradient test") 
         J3=TWObsJTerm(twObs1, model, tlm, t0=t0)
         x=kdv.rndSpecVec(g, amp=1., seed=1)
-        J3.gradTest(x0)
+        print(J3.gradTest(x0))
@@ -1,10 +1,12 @@
 import numpy as np
 from pseudoSpec1D import Grid, Launcher, TLMLauncher, Trajectory
-import random as rnd
 import matplotlib.pyplot as plt
 from matplotlib.axes import Axes
 from matplotlib.gridspec import GridSpec
 import pickle
+from metrics import makeMetric, makeCovMetric, blockMetric
+from randomLib import makeRNG, rngSample
+from instrumentation import timedCall
 
 #-----------------------------------------------------------
 #----| Utilitaries |----------------------------------------
@@ -18,13 +20,11 @@ def degrad(signal,mu,sigma,seed=None):
 
     signal  :  input signal
     mu      :  noise mean (gaussian mean)
-    sigma   :  noise variance
+    sigma   :  noise standard deviation
+    seed    :  <None | int | random stream> (see randomLib.makeRNG)
     '''
-    rnd.seed(seed)
-    sig_degrad=signal.copy()
-    for i in xrange(signal.size):
-        sig_degrad[i]=signal[i]+rnd.gauss(mu, sigma)
-    return sig_degrad
+    signal=np.asarray(signal)
+    return signal+makeRNG(seed).normal(mu, sigma, size=signal.shape)
 
 def degradTraj(traj, mu, sigma, seed=None):
     '''
@@ -38,6 +38,9 @@ def degradTraj(traj, mu, sigma, seed=None):
 #-----------------------------------------------------------
 
 def homoSampling(grid, nObs, xlim=None):
+    '''
+    nObs evenly spaced coordinates <numpy.ndarray>
+    '''
     if not isinstance(grid, Grid):
         raise TypeError("grid <pseudoSpec>")
     if xlim:
@@ -45,7 +48,6 @@ def homoSampling(grid, nObs, xlim=None):
         if xlim[0]>=xlim[1] or xlim[0]<grid.min() or xlim[1]>grid.max():
             raise ValueError()
 
-    coord=[]
     if xlim:
         minCoord=xlim[0]
         maxCoord=xlim[1]
@@ -54,11 +56,19 @@ def homoSampling(grid, nObs, xlim=None):
         maxCoord=grid.max()
 
     ObsDx=(maxCoord-minCoord)/nObs
-    for j in xrange(nObs):
-        coord.append(minCoord+j*ObsDx)
-    return coord
+    return minCoord+np.arange(nObs)*ObsDx
 
 def rndSampling(grid, nObs, precision=2, xlim=None, seed=None):
+    '''
+    nObs distinct random coordinates, rounded to precision decimals,
+        sorted <numpy.ndarray>
+
+        drawn without replacement among the admissible rounded 
+        positions
+
+        seed    :   <None | int | float | random stream>
+                    (see randomLib.makeRNG)
+    '''
     if not isinstance(grid, Grid):
         raise TypeError("grid <pseudoSpec>")
     if xlim:
@@ -66,22 +76,23 @@ def rndSampling(grid, nObs, precision=2, xlim=None, seed=None):
         if xlim[0]>=xlim[1] or xlim[0]<grid.min() or xlim[1]>grid.max():
             raise ValueError()
 
-    rnd.seed(seed)
-    coord=[]
-    i=0
-    while (i < nObs):
-        if xlim:
-            pick=round(rnd.random()*(xlim[1]-xlim[0]), precision)+xlim[0]
-        else:
-            pick=round(rnd.random()*grid.L, precision)
-            if grid.centered:
-                pick-=grid.L/2
-        if ((not pick in coord) and (pick <=grid.max()) 
-                and (pick >=grid.min()) ):
-            coord.append(pick)
-            i+=1
-    coord.sort()
-    return coord 
+    if xlim:
+        base=xlim[0]
+        span=xlim[1]-xlim[0]
+    else:
+        base=-grid.L/2 if grid.centered else 0.
+        span=grid.L
+    step=10.**(-precision)
+    # admissible positions: base+k*step, in the grid
+    kMin=max(0, int(np.ceil((grid.min()-base)/step-1e-9)))
+    kMax=min(int(round(span/step)), 
+                int(np.floor((grid.max()-base)/step+1e-9)))
+    nPos=kMax-kMin+1
+    if nObs>nPos:
+        raise ValueError("nObs<=%d (precision)"%nPos)
+
+    k=kMin+np.sort(rngSample(makeRNG(seed), nPos, nObs))
+    return np.round(k*step, precision)+base
 
 def removeDuplicates(coord):
     coord=list(set(coord))
@@ -94,29 +105,56 @@ def removeDuplicates(coord):
 #----| Observation operators |------------------------------
 #-----------------------------------------------------------
 
+_coordIdxCache={}
+_coordIdxCacheMaxSize=256
+
+def coordIdx(g, obsCoord):
+    """
+    Grid indices of observation coordinates
+
+        resolved once per (grid, coord) with g.pos2Idx() and cached
+    """
+    coord=np.ascontiguousarray(obsCoord, dtype=float)
+    key=(id(g), coord.shape, coord.tostring())
+    try:
+        return _coordIdxCache[key][1]
+    except KeyError:
+        pass
+    idx=np.asarray(g.pos2Idx(coord), dtype=int).reshape(coord.shape)
+    idx.setflags(write=False)
+    if len(_coordIdxCache)>=_coordIdxCacheMaxSize:
+        _coordIdxCache.clear()
+    # the grid is kept alive with its indices so that id(g) is not reused
+    _coordIdxCache[key]=(g, idx)
+    return idx
+
 def obsOp_Coord(x, g, obsCoord):
     """
     Trivial static observation operator
+
+        gather of the grid values at the observation coordinates
+        (x can be (N,) or (nMembers, N))
     """
-    idxObs=g.pos2Idx(obsCoord)
-    nObs=len(idxObs)
-    H=np.zeros(shape=(nObs,g.N))
-    for i in xrange(nObs):
-        H[i, idxObs[i]]=1.
-    return np.dot(H,x)
+    idxObs=coordIdx(g, obsCoord)
+    return np.asarray(x)[...,idxObs]
 
 def obsOp_Coord_Adj(obsValues, g, obsCoord):
     """
     Trivial static observation operator adjoint
+
+        scatter-add of the observation values on the grid
+        (obsValues can be (nObs,) or (nMembers, nObs))
     """
-    if len(obsValues)<>len(obsCoord):
+    obsValues=np.asarray(obsValues)
+    if obsValues.shape[-1]<>len(obsCoord):
         raise ValueError()
-    idxObs=g.pos2Idx(obsCoord)
-    nObs=len(idxObs)
-    H=np.zeros(shape=(nObs,g.N))
-    for i in xrange(nObs):
-        H[i, idxObs[i]]=1.
-    return np.dot(H.T,obsValues)
+    idxObs=coordIdx(g, obsCoord)
+    if obsValues.ndim==1:
+        return np.bincount(idxObs, weights=obsValues, minlength=g.N)
+    else:
+        x=np.zeros(obsValues.shape[:-1]+(g.N,))
+        np.add.at(x, (Ellipsis, idxObs), obsValues)
+        return x
 
 
 #=====================================================================
@@ -139,6 +177,12 @@ class StaticObs(object):
         obsOpArgs   :   obsOp additional arguments
                             obsOp(x_state, x_grid, x_obsSpaceCoord, 
                                     *obsOpArgs)
+        metric      :   observation error metric (R^{-1})
+                            <None | float | numpy.ndarray | Metric>
+                            (kept structured, see metrics.makeMetric)
+        R           :   observation error covariance, instead of metric
+                            <None | float | numpy.ndarray | Metric>
+                            (factorized once, see metrics.makeCovMetric)
     """
 
 
@@ -147,7 +191,7 @@ class StaticObs(object):
     #------------------------------------------------------
 
     def __init__(self, coord, values, obsOp=None, obsOpTLMAdj=None,
-                    obsOpArgs=(), metric=None):
+                    obsOpArgs=(), metric=None, R=None):
 
         if isinstance(coord, Grid):
             self.grid=coord
@@ -186,29 +230,22 @@ class StaticObs(object):
         self.obsOpTLMAdj=obsOpTLMAdj
         self.obsOpArgs=obsOpArgs
 
-        if metric==None:
-            self.metric=np.eye(self.nObs)
-        elif isinstance(metric, (float, int)):
-            self.metric=metric*np.eye(self.nObs)
-        elif isinstance(metric, np.ndarray):
-            if metric.ndim==1:
-                self.metric=np.diag(metric)
-            elif metric.ndim==2:
-                # this is why coord must not be sorted!
-                self.metric=metric
-            else:
-                raise ValueError("metric.ndim=[1|2]")
-        else:   
-            raise TypeError("metric <None | numpy.ndarray>")
+        # a 2D metric is why coord must not be sorted!
+        if R is None:
+            self.metric=makeMetric(metric, self.nObs)
+        elif metric is None:
+            self.metric=makeCovMetric(R, self.nObs)
+        else:
+            raise ValueError("metric or R, not both")
     #------------------------------------------------------
     #----| Private methods |-------------------------------
     #------------------------------------------------------
 
     def __pos2Idx(self, g):
-        
-        idx=np.zeros(self.nObs, dtype=int)
-        for i in xrange(self.nObs):
-            idx[i]=np.min(np.where(g.x>=self.coord[i]))
+        # first grid point at or after each coordinate
+        idx=np.searchsorted(g.x, self.coord, side='left')
+        if np.any(idx>=len(g.x)):
+            raise ValueError("coord<=g.x[-1]")
         return idx
 
     #------------------------------------------------------
@@ -266,7 +303,7 @@ class StaticObs(object):
     def prosca(self, y1, y2):
         if len(y1)<>self.nObs or len(y2)<>self.nObs:
             raise ValueError()
-        return np.dot(y1, np.dot(self.metric, y2))
+        return self.metric.prosca(y1, y2)
 
     #------------------------------------------------------
 
@@ -428,18 +465,9 @@ class StaticObs(object):
         '''
         Build the observation operator metric
         assuming observation sets independant
+            (block-diagonal, keeping the blocks structure)
         '''
-        metric=np.zeros(shape=(self.nObs+statObs.nObs,
-                              self.nObs+statObs.nObs))
-        if self.nObs>0 and statObs.nObs>0:
-            metric[:self.nObs, :self.nObs]=self.metric
-            metric[-statObs.nObs:, -statObs.nObs:]=statObs.metric
-        elif self.nObs>0 and statObs.nObs==0:
-            metric=self.metric
-        elif self.nObs==0:
-            metric=statObs.metric 
-        
-        return metric
+        return self.metric+statObs.metric
 
     def __add__(self, statObs, obsOpEq=True):
         if not isinstance(statObs, StaticObs): raise TypeError()
@@ -493,6 +521,23 @@ class TimeWindowObs(object):
         d_Obs       :   {time : <staticObs>} <dict>
         propagator  :   propagator launcher <Launcher>
 
+    Columnar storage: the observations of all times (sorted) are
+    also stacked in single arrays
+
+        offsets         :   observations of times[i] are 
+                            [offsets[i]:offsets[i+1]]
+        stackedCoord    :   concatenated coordinates
+        stackedValues   :   concatenated values
+        metric          :   block diagonal window metric (R^{-1})
+                            <Metric> (collapsed when diagonal)
+
+    Observation space vectors can be {time : <numpy.ndarray>} dicts
+    or stacked <numpy.ndarray> (stack(), split()): prosca(), norm(),
+    applyMetric() and modelEquivalent_Adj() accept both, and
+    modelEquivalent*(), innovation*() return stacked arrays with
+    stacked=True. With obsOp_Coord (or no obsOp) the model
+    equivalents of the whole window are one gather (one scatter
+    for the adjoint).
     """
 
 
@@ -538,6 +583,30 @@ class TimeWindowObs(object):
             self.obsOp=None
             self.obsOpArgs=()
 
+        #----| Columnar storage |-----------------
+        obsList=[self.d_Obs[t] for t in self.times]
+        nObsTimes=np.array([obs.nObs for obs in obsList], dtype=int)
+        self.offsets=np.concatenate(([0], np.cumsum(nObsTimes)))
+        self.stackedCoord=np.concatenate(
+                    [np.asarray(obs.coord, dtype=float) for obs in obsList]
+                    +[np.zeros(0)])
+        self.stackedValues=np.concatenate(
+                    [np.asarray(obs.values, dtype=float) for obs in obsList]
+                    +[np.zeros(0)])
+        self.metric=blockMetric([obs.metric for obs in obsList])
+        self.__rows=np.repeat(np.arange(self.nTimes), nObsTimes)
+        self.__gather=None
+        if self.empty:
+            self.__fastOp=None
+        elif all(obs.obsOp==None for obs in obsList):
+            self.__fastOp='identity'
+        elif all(obs.obsOp is obsOp_Coord and 
+                    obs.obsOpTLMAdj is obsOp_Coord_Adj and
+                    obs.obsOpArgs==() for obs in obsList):
+            self.__fastOp='coord'
+        else:
+            self.__fastOp=None
+
        
                 
     #------------------------------------------------------
@@ -566,17 +635,93 @@ class TimeWindowObs(object):
                 nDtList.append(int((t-t0)/dt))
         return nDtList
 
+    def __nDtWindow(self, dt, t0):
+        '''
+        Time steps of all the observation times from t0
+            (every observation must lie after t0: stacked vectors
+             cover the whole window: extract ]t0, tf] first, as
+             TWObsJTerm does)
+        '''
+        nDtList=self._times2NDt(dt, t0=t0)
+        if len(nDtList)<>self.nTimes:
+            raise ValueError("times>t0")
+        return nDtList
+
+    #------------------------------------------------------
+
+    def __gatherIdx(self, g):
+        if self.__gather==None or self.__gather[0] is not g:
+            self.__gather=(g, coordIdx(g, self.stackedCoord))
+        return self.__gather[1]
+
+    def _stackedModelEquivalent(self, X, g):
+        '''
+        Stacked model equivalents of the states X[i] at times[i]
+        '''
+        if self.__fastOp=='coord':
+            return X[self.__rows, self.__gatherIdx(g)]
+        elif self.__fastOp=='identity':
+            return X.ravel()
+        else:
+            return np.concatenate(
+                    [self.d_Obs[t].modelEquivalent(X[i], g) 
+                        for i, t in enumerate(self.times)])
+
+    def _stackedModelEquivalent_Adj(self, y, g):
+        '''
+        Adjoint of _stackedModelEquivalent: W[i] forcing at times[i]
+        '''
+        if self.__fastOp=='coord':
+            flatIdx=self.__rows*g.N+self.__gatherIdx(g)
+            return np.bincount(flatIdx, weights=y, 
+                                minlength=self.nTimes*g.N
+                                ).reshape(self.nTimes, g.N)
+        elif self.__fastOp=='identity':
+            return y.reshape(self.nTimes, g.N)
+        else:
+            d_y=self.split(y)
+            return np.array([self.d_Obs[t].modelEquivalent_Adj(d_y[t], g)
+                                for t in self.times])
+
     #------------------------------------------------------
     #----| Public methods |--------------------------------
     #------------------------------------------------------
     
+    def stack(self, d_y):
+        '''
+        {time : <numpy.ndarray>} -> stacked <numpy.ndarray>
+            (stacked arrays are returned as is)
+        '''
+        if isinstance(d_y, np.ndarray):
+            if d_y.shape<>(self.nObs,):
+                raise ValueError("y.shape==(nObs,)")
+            return d_y
+        if len(d_y)<>self.nTimes:
+            raise ValueError("d_y.keys()==times")
+        return np.concatenate([d_y[t] for t in self.times]+[np.zeros(0)])
+
+    def split(self, y):
+        '''
+        stacked <numpy.ndarray> -> {time : <numpy.ndarray>} (views)
+        '''
+        d_y={}
+        for i in xrange(self.nTimes):
+            d_y[self.times[i]]=y[self.offsets[i]:self.offsets[i+1]]
+        return d_y
+
+    #------------------------------------------------------
+    
     def prosca(self, d_y1, d_y2):
-        if d_y1.keys()<>d_y2.keys():    
-            raise ValueError()
-        prosca=0.
-        for t in d_y1.keys():
-            prosca+=self[t].prosca(d_y1[t],d_y2[t])
-        return prosca
+        if isinstance(d_y1, dict) and isinstance(d_y2, dict):
+            if sorted(d_y1.keys())<>sorted(d_y2.keys()):    
+                raise ValueError()
+            if len(d_y1)<self.nTimes:
+                # partial window
+                prosca=0.
+                for t in d_y1.keys():
+                    prosca+=self[t].prosca(d_y1[t],d_y2[t])
+                return prosca
+        return self.metric.prosca(self.stack(d_y1), self.stack(d_y2))
    
     #------------------------------------------------------
     
@@ -590,76 +735,105 @@ class TimeWindowObs(object):
 
     #------------------------------------------------------
 
-    def modelEquivalent(self, x, nlModel, t0=0.):
+    def applyMetric(self, d_y):
+        '''
+        R^{-1}y (same layout as y: dict or stacked)
+        '''
+        Ry=self.metric.apply(self.stack(d_y))
+        if isinstance(d_y, dict):
+            return self.split(Ry)
+        return Ry
+
+    #------------------------------------------------------
+
+    def modelEquivalent(self, x, nlModel, t0=0., stacked=False):
         if self.empty:
             raise RuntimeError()
         self.__propagatorValidate(nlModel)
-        nDtList=self._times2NDt(nlModel.dt, t0=t0)
-        g=nlModel.grid
+        nDtList=self.__nDtWindow(nlModel.dt, t0)
 
-        d_x=nlModel.d_nDtInt(x, nDtList, t0=t0)
-        
-        d_Hx={}
-        for n in xrange(len(nDtList)):
-            i=nDtList[n]
-            t=self.times[n]
-            d_Hx[t]=self.d_Obs[t].modelEquivalent(d_x[i], g)
+        d_x=timedCall('nlModel.d_nDtInt', nlModel.d_nDtInt, x, nDtList, 
+                        t0=t0)
+        X=np.array([d_x[i] for i in nDtList])
 
-        return d_Hx
+        Hx=timedCall('obsOp', self._stackedModelEquivalent, X, nlModel.grid)
+        if stacked:
+            return Hx
+        return self.split(Hx)
 
     #------------------------------------------------------
 
-    def modelEquivalentTLM(self, x, tlm, t0=0.):
+    def modelEquivalentTLM(self, x, tlm, t0=0., stacked=False):
         if self.empty:
             raise RuntimeError()
         self.__propagatorValidate(tlm, tlm=True)
-        nDtList=self._times2NDt(tlm.dt, t0=t0)
-        g=tlm.grid
+        nDtList=self.__nDtWindow(tlm.dt, t0)
 
-        d_x=tlm.d_nDtInt(x, nDtList, t0=t0)
-        
-        d_Hx={}
-        for n in xrange(len(nDtList)):
-            i=nDtList[n]
-            t=self.times[n]
-            d_Hx[t]=self.d_Obs[t].modelEquivalent(d_x[i], g)
+        d_x=timedCall('tlm.d_nDtInt', tlm.d_nDtInt, x, nDtList, t0=t0)
+        X=np.array([d_x[i] for i in nDtList])
 
-        return d_Hx
+        Hx=timedCall('obsOp', self._stackedModelEquivalent, X, tlm.grid)
+        if stacked:
+            return Hx
+        return self.split(Hx)
 
         
     def modelEquivalent_Adj(self, d_inno, tlm, t0=0.):
         if self.empty:
             raise RuntimeError()
         self.__propagatorValidate(tlm, tlm=True)
-        nDtList=self._times2NDt(tlm.dt, t0=t0)
-        g=tlm.grid
+        nDtList=self.__nDtWindow(tlm.dt, t0)
 
+        W=timedCall('obsOpAdj', self._stackedModelEquivalent_Adj, 
+                        self.stack(d_inno), tlm.grid)
         d_w={} 
         for n in xrange(len(nDtList)):
-            i=nDtList[n]
-            t=self.times[n]
-            d_w[i]=self.d_Obs[t].modelEquivalent_Adj(d_inno[t], g)
+            d_w[nDtList[n]]=W[n]
 
-        adj=tlm.d_nDtIntAdj(d_w, t0=t0)
+        adj=timedCall('tlm.d_nDtIntAdj', tlm.d_nDtIntAdj, d_w, t0=t0)
 
         return adj
         
     #------------------------------------------------------
 
     def modelEqNorm(self, x, nlModel, t0=0.):
-        return self.norm(self.modelEquivalent(x, nlModel, t0=t0))
+        return self.norm(self.modelEquivalent(x, nlModel, t0=t0, 
+                                                stacked=True))
 
     #------------------------------------------------------
     
-    def innovation(self, x, nlModel, t0=0.):
+    def innovation(self, x, nlModel, t0=0., stacked=False):
         if self.empty:
             raise RuntimeError()
-        self.__propagatorValidate(nlModel)
-        d_inno={}
-        d_Hx=self.modelEquivalent(x, nlModel, t0=t0)
-        for t in self.times:
-            d_inno[t]=self.d_Obs[t].values-d_Hx[t]
-        return d_inno
+        inno=self.stackedValues-self.modelEquivalent(x, nlModel, t0=t0,
+                                                        stacked=True)
+        if stacked:
+            return inno
+        return self.split(inno)
+
+    #------------------------------------------------------
+
+    def modelEquivalentTraj(self, traj, g, stacked=False):
+        '''
+        Model equivalents from an already integrated trajectory
+            (no model integration)
+        '''
+        if self.empty:
+            raise RuntimeError()
+        if not isinstance(traj, Trajectory):
+            raise TypeError("traj <Trajectory>")
+        X=np.array([traj.whereTime(t) for t in self.times])
+        Hx=timedCall('obsOp', self._stackedModelEquivalent, X, g)
+        if stacked:
+            return Hx
+        return self.split(Hx)
+
+    def innovationTraj(self, traj, g, stacked=False):
+        inno=self.stackedValues-self.modelEquivalentTraj(traj, g, 
+                                                            stacked=True)
+        if stacked:
+            return inno
+        return self.split(inno)
         
     #------------------------------------------------------
 
@@ -678,8 +852,54 @@ class TimeWindowObs(object):
         for t in self.d_Obs.keys():
             if t >= tMin and t<= tMax:
                 cut_d_Obs[t]=self[t]
-                
+
         return TimeWindowObs(cut_d_Obs)
+
+    #------------------------------------------------------
+
+    def window(self, t0, tf):
+        '''
+        Observations of the window ]t0, tf] <TimeWindowObs>
+
+            Binary search in times; the columnar arrays are sliced
+            with the offsets (no validation nor concatenation of
+            the observations again).
+        '''
+        iStart, iEnd=np.searchsorted(self.times, [t0, tf], side='right')
+        iEnd=max(iStart, iEnd)
+        oStart, oEnd=self.offsets[iStart], self.offsets[iEnd]
+        sub=TimeWindowObs.__new__(TimeWindowObs)
+        sub.times=self.times[iStart:iEnd].copy()
+        sub.nTimes=len(sub.times)
+        sub.empty=(sub.nTimes==0)
+        sub.d_Obs=dict((t, self.d_Obs[t]) for t in sub.times)
+        sub.values=dict((t, self.values[t]) for t in sub.times)
+        sub.nObs=int(oEnd-oStart)
+        if sub.empty:
+            sub.tMax=None
+            sub.tMin=None
+            sub.obsOp=None
+            sub.obsOpArgs=()
+        else:
+            sub.tMax=sub.times[-1]
+            sub.tMin=sub.times[0]
+            sub.obsOp=self.obsOp
+            sub.obsOpArgs=self.obsOpArgs
+        sub.offsets=self.offsets[iStart:iEnd+1]-oStart
+        sub.stackedCoord=self.stackedCoord[oStart:oEnd]
+        sub.stackedValues=self.stackedValues[oStart:oEnd]
+        sub.metric=blockMetric([self.d_Obs[t].metric for t in sub.times])
+        sub.__rows=self.__rows[oStart:oEnd]-iStart
+        if self.__gather==None:
+            sub.__gather=None
+        else:
+            sub.__gather=(self.__gather[0], self.__gather[1][oStart:oEnd])
+        if sub.empty:
+            sub.__fastOp=None
+        else:
+            sub.__fastOp=self.__fastOp
+        return sub
+
     #-------------------------------------------------------
     #----| Plotting methods |-------------------------------
     #-------------------------------------------------------
@@ -819,7 +1039,7 @@ if __name__=="__main__":
     nObs=10
     freqObs=3
     d_Obs={}
-    timesObs=[i*(tTotal)/freqObs for i in xrange(1,freqObs+1)]
+    timesObs=[t0+i*tInt/freqObs for i in xrange(1,freqObs+1)]
     for tObs in timesObs:
         coords=rndSampling(g, nObs, seed=tObs)
         d_Obs[tObs]=StaticObs(coords, 
@@ -847,9 +1067,7 @@ if __name__=="__main__":
         print("  2: y -( H*)-> H*y ")
         Ay=twObs1.modelEquivalent_Adj(y, tlm, t0=t0)
         
-        y_Hx=0.
-        for t in y.keys():
-            y_Hx+=np.dot(y[t], Hx[t])
+        y_Hx=np.dot(twObs1.stack(y), twObs1.stack(Hx))
         Ay_x=np.dot(Ay, x)
         print("    <y, Hx> - <H*y, x>=%e\n"%(y_Hx-Ay_x))
     
@@ -864,9 +1082,7 @@ if __name__=="__main__":
         def gradFct(x, twObs, model, tlm, t0):
             Hx=twObs.modelEquivalent(x, model, t0=t0)
             tlm.reference(model.integrate(x, twObs.times[-1], t0=t0))
-            RHx={}
-            for t in Hx.keys():
-                RHx[t]=np.dot(twObs[t].metric, Hx[t])
+            RHx=twObs.applyMetric(Hx)
             gradJ=twObs.modelEquivalent_Adj(RHx, tlm, t0=t0)
             return gradJ
 
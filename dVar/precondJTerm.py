@@ -1,6 +1,7 @@
 from observations import StaticObs, TimeWindowObs
-from jTerm import JTerm, JMinimum, norm
+from jTerm import JTerm, JMinimum, HessianEigen, norm
 from obsJTerm import TWObsJTerm, StaticObsJTerm
+from instrumentation import timedCall, instrumented
 import numpy as np
 
 class PrecondJTerm(JTerm):
@@ -8,7 +9,20 @@ class PrecondJTerm(JTerm):
 
         <!> This is a master class not meant to be instantiated, only
             subclasses should.
+
+        Additional minimizer backend:
+            'cg'    :   preconditioned conjugate gradient (Lanczos)
+                        for quadratic costs (linear observation
+                        operators, incremental inner loops); exports
+                        the leading Hessian eigenpairs (nEig) as
+                        minimum.BOpt <HessianEigen>, which can be 
+                        given back as hessInv0 (spectral 
+                        preconditioner) to the next minimization.
     '''
+
+    minimizers=dict(JTerm.minimizers, cg='_minimizeCG')
+    precondMinimizers=('cg',)
+    cacheDependencies=('x_bkg', 'B_sqrt', 'B_sqrtAdj', 'B_sqrtArgs')
     
     #------------------------------------------------------
     #----| Private methods |-------------------------------
@@ -28,9 +42,14 @@ class PrecondJTerm(JTerm):
 
     #------------------------------------------------------
 
+    def _xi2xMemo(self, xi):
+        return self._memo(xi, 'x', self.xi2x, xi)
+
+    #------------------------------------------------------
+
     def _costFunc(self, xi, normalize=False): 
         self._xValidate(xi)
-        x=self.xi2x(xi)
+        x=self._xi2xMemo(xi)
         return super(PrecondJTerm, self)._costFunc(x)+0.5*np.dot(xi,xi)
 
     #------------------------------------------------------
@@ -44,33 +63,146 @@ class PrecondJTerm(JTerm):
 
         '''
         self._xValidate(xi)
-        x=self.xi2x(xi)
+        x=self._xi2xMemo(xi)
         # dx0=-H'R^{-1}d
         dx0=super(PrecondJTerm, self)._gradCostFunc(x)
-        grad=xi+ self.B_sqrtAdj(dx0,*self.B_sqrtArgs)
+        grad=xi+ timedCall('B_sqrtAdj', self.B_sqrtAdj, dx0,
+                            *self.B_sqrtArgs)
         return grad
-    
+
     #------------------------------------------------------
-    #----| Public methods |--------------------------------
+
+    def _costAndGrad(self, xi):
+        self._xValidate(xi)
+        x=self._xi2xMemo(xi)
+        Jo, dx0=super(PrecondJTerm, self)._costAndGrad(x)
+        return (Jo+0.5*np.dot(xi,xi),
+                xi+timedCall('B_sqrtAdj', self.B_sqrtAdj, dx0,
+                                *self.B_sqrtArgs))
+
     #------------------------------------------------------
-    
 
-    def gradJ(self, xi):
+    def _clipGrad(self, grad):
         if self.maxGradNorm==None:
-            return self._gradCostFunc(xi, *self.args)
-        elif isinstance(self.maxGradNorm, float):
-            grad=self._gradCostFunc(xi, *self.args)
-            # norm compared in physical space
-            # B^{1/2} being linear
-            normGrad=norm(self.xi2x(grad))
-            if normGrad>self.maxGradNorm:
-                grad=(grad/normGrad)*(self.maxGradNorm)
             return grad
-    
+        # norm compared in physical space
+        # B^{1/2} being linear
+        normGrad=norm(self.xi2x(grad))
+        if normGrad>self.maxGradNorm:
+            grad=(grad/normGrad)*(self.maxGradNorm)
+        return grad
+
+    #------------------------------------------------------
+
+    def _minimizeCG(self, fused, xi0, maxiter, hessInv0=None, 
+                    gtol=1e-5, ritzTol=1e-2, storeHessInv=True,
+                    callback=None, disp=True, **kwargs):
+        '''
+        Conjugate gradient (Lanczos) minimization of a quadratic cost
+
+            Solved in w, with xi=xi0+S.w (S=hessInv0.sqrtDot, 
+            identity without preconditioner): Hessian-vector
+            products are gradient differences, one fused evaluation
+            per iteration.
+
+            hessInv0 :  <HessianEigen | LBFGSHistory | None>
+
+            With storeHessInv, the converged Ritz pairs give BOpt, 
+            a HessianEigen composed with hessInv0 (every level 
+            of a chain of warm starts is kept).
+        '''
+        if hessInv0==None:
+            S=lambda v: v
+            SAdj=S
+        else:
+            S=hessInv0.sqrtDot
+            SAdj=hessInv0.sqrtDotAdj
+
+        f0, g0=fused.costAndGrad(xi0)
+        nCalls=1
+        xi=xi0.copy()
+        f=f0
+        g=g0.copy()
+        r=-SAdj(g)
+        p=r.copy()
+        rr=np.dot(r,r)
+        alphas=[]
+        betas=[]
+        lanczosVecs=[]
+
+        warnFlag=1
+        for k in xrange(maxiter):
+            if np.max(np.abs(g))<=gtol:
+                warnFlag=0
+                break
+            lanczosVecs.append((-1)**k*r/np.sqrt(rr))
+            Sp=S(p)
+            ASp=fused.costAndGrad(xi0+Sp)[1]-g0
+            nCalls+=1
+            pAp=np.dot(Sp, ASp)
+            if pAp<=0.:
+                # not a positive definite quadratic
+                lanczosVecs.pop()
+                warnFlag=2
+                break
+            alpha=rr/pAp
+            f+=alpha*np.dot(g, Sp)+0.5*alpha**2*pAp
+            xi+=alpha*Sp
+            g+=alpha*ASp
+            r=-SAdj(g)
+            # full reorthogonalization: keeps the Lanczos basis
+            # orthonormal (no spurious copies of the Ritz pairs)
+            Q=np.array(lanczosVecs)
+            r-=np.dot(np.dot(Q, r), Q)
+            rrNew=np.dot(r,r)
+            beta=rrNew/rr
+            rr=rrNew
+            p=r+beta*p
+            alphas.append(alpha)
+            betas.append(beta)
+            if callback<>None:
+                callback(xi, f, g)
+        if warnFlag==1 and np.max(np.abs(g))<=gtol:
+            warnFlag=0
+
+        #----| Lanczos: Ritz pairs |--------------
+        BOpt=None
+        nIter=len(alphas)
+        if storeHessInv and nIter>0:
+            alphas=np.array(alphas)
+            betas=np.array(betas)
+            T=np.diag(1./alphas)
+            T[1:,1:]+=np.diag(betas[:-1]/alphas[:-1])
+            offDiag=np.sqrt(betas[:-1])/alphas[:-1]
+            T+=np.diag(offDiag, 1)+np.diag(offDiag, -1)
+            theta, W=np.linalg.eigh(T)
+            errBound=np.sqrt(betas[-1])/alphas[-1]*np.abs(W[-1])
+            converged=np.where((errBound<=ritzTol*theta)&(theta>1.))[0]
+            leading=converged[np.argsort(theta[converged])[::-1]][:self.nEig]
+            if len(leading)>0:
+                eigVecs=np.dot(W[:,leading].T, np.array(lanczosVecs))
+                BOpt=HessianEigen(theta[leading], eigVecs, base=hessInv0)
+
+        if disp:
+            if warnFlag==0:
+                print("Optimization terminated successfully.")
+            elif warnFlag==1:
+                print("Warning: Maximum number of iterations has been exceeded.")
+            else:
+                print("Warning: Hessian not positive definite (cost not quadratic?)")
+            print("         Current function value: %f"%f)
+            print("         Iterations: %d"%nIter)
+            print("         Gradient evaluations: %d"%nCalls)
+
+        return (xi, f, g, BOpt, nCalls, nCalls, warnFlag)
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
     #------------------------------------------------------
     
     def xi2x(self, xi):
-        return self.B_sqrt(xi, *self.B_sqrtArgs)+self.x_bkg
+        return timedCall('B_sqrt', self.B_sqrt, xi, 
+                            *self.B_sqrtArgs)+self.x_bkg
 
     #-----------------------------------------------------
 
@@ -82,14 +214,22 @@ class PrecondJTerm(JTerm):
     
     def minimize(self, maxiter=50, retall=True,
                     testGrad=True, finalTestGrad=False, convergence=True, 
-                    testGradMinPow=-1, testGradMaxPow=-14):
+                    testGradMinPow=-1, testGradMaxPow=-14,
+                    minimizer='lbfgs', memory=10, storeHessInv=True,
+                    hessInv0=None, recorder=None, testGradTol=None,
+                    instrument=None, disp=True, minimizerOptions=None):
         super(PrecondJTerm, self).minimize(
                     np.zeros(self.modelGrid.N), maxiter=maxiter,
                     retall=retall,
                     testGrad=testGrad, finalTestGrad=finalTestGrad,
                     convergence=convergence, 
                     testGradMinPow=testGradMinPow,
-                    testGradMaxPow=testGradMaxPow)
+                    testGradMaxPow=testGradMaxPow,
+                    minimizer=minimizer, memory=memory,
+                    storeHessInv=storeHessInv, hessInv0=hessInv0,
+                    recorder=recorder, testGradTol=testGradTol,
+                    instrument=instrument, disp=disp,
+                    minimizerOptions=minimizerOptions)
         
 
         
@@ -103,6 +243,9 @@ class PrecondStaticObsJTerm(PrecondJTerm, StaticObsJTerm):
     (classical 3D-Var context)
     '''
 
+    cacheDependencies=(PrecondJTerm.cacheDependencies
+                        +StaticObsJTerm.cacheDependencies)
+
     #------------------------------------------------------
     #----| Init |------------------------------------------
     #------------------------------------------------------
@@ -148,6 +291,10 @@ class PrecondTWObsJTerm(PrecondJTerm, TWObsJTerm):
         B_sqrt          :   preconditionning operator <function>
         B_sqrtAdj       :   adjoint of preconditionning op. <function>
         B_sqrtArgs      :   arguments <tuple>
+
+        (with B=BIsoHomo(*B_args), B_sqrt=B.sqrt, B_sqrtAdj=B.sqrt_adj
+         and B_sqrtArgs=() avoid rebuilding the spectral weights at
+         each call)
                                 
     The purpose of this class is to facilitate the convergence of a cost
     function of the form:
@@ -164,6 +311,9 @@ class PrecondTWObsJTerm(PrecondJTerm, TWObsJTerm):
         x=B^{1/2}xi+x_b
 
     """
+
+    cacheDependencies=(PrecondJTerm.cacheDependencies
+                        +TWObsJTerm.cacheDependencies)
     
 
     #------------------------------------------------------
@@ -217,3 +367,152 @@ class PrecondTWObsJTerm(PrecondJTerm, TWObsJTerm):
 #---------------------------------------------------------------------
 #=====================================================================
 
+
+class IncrPrecondTWObsJTerm(PrecondTWObsJTerm):
+    """
+    Incremental preconditionned time window observations JTerm
+    (incremental 4D-Var, Gauss-Newton outer/inner loops)
+
+    IncrPrecondTWObsJTerm(obs, nlModel, tlm
+                        x_bkg, B_sqrt, B_sqrtAdj, B_sqrtArgs=())
+
+        (same arguments as PrecondTWObsJTerm)
+
+    Each outer loop k integrates the nonlinear model once from the
+    current guess x_k=B^{1/2}xi_k+x_bkg, references the TLM on that
+    trajectory and computes the innovations d_k=y-H(M(x_k)).
+    The inner loop then minimizes the quadratic cost
+
+        J(xi)= 0.5*xi'xi + 0.5*(d_k-HM'B^{1/2}(xi-xi_k))'R^{-1}(...)
+
+    using only the TLM and its adjoint.
+
+        J.minimize(maxiter=50, nOuter=3)
+
+            maxiter :   inner loop iterations
+            nOuter  :   outer loop iterations
+    """
+
+    #------------------------------------------------------
+    #----| Init |------------------------------------------
+    #------------------------------------------------------
+
+    def __init__(self, obs, nlModel, tlm, 
+                    x_bkg, B_sqrt, B_sqrtAdj, B_sqrtArgs=(),
+                    t0=0., tf=None, maxGradNorm=None):
+
+        super(IncrPrecondTWObsJTerm, self).__init__(obs, nlModel, tlm, 
+                                x_bkg, B_sqrt, B_sqrtAdj, B_sqrtArgs,
+                                t0=t0, tf=tf, maxGradNorm=maxGradNorm)
+        self.xiOuter=None
+        self.innoOuter=None
+        self.outerMinima=[]
+        self.outerJ=[]
+
+    #------------------------------------------------------
+    #----| Private methods |-------------------------------
+    #------------------------------------------------------
+
+    def _outerUpdate(self, xi):
+        '''
+        Outer loop: nonlinear integration from xi2x(xi), TLM
+        referencing and innovations
+        '''
+        self._xValidate(xi)
+        # the quadratic cost changes with the outer loop
+        self.invalidate()
+        self.xiOuter=xi.copy()
+        if self.obs.empty:
+            self.innoOuter=np.zeros(0)
+            Jo=0.
+        else:
+            traj=timedCall('nlModel.integrate', self.nlModel.integrate,
+                                self.xi2x(xi), 
+                                self.obs.times[-1]-self.tWin[0],
+                                t0=self.tWin[0])
+            timedCall('tlm.reference', self.tlm.reference, traj)
+            # stacked innovations (see TimeWindowObs)
+            self.innoOuter=self.obs.innovationTraj(traj, self.modelGrid,
+                                                    stacked=True)
+            Jo=0.5*self.obs.prosca(self.innoOuter, self.innoOuter)
+        self.outerJ.append(Jo+0.5*np.dot(xi,xi))
+
+    #------------------------------------------------------
+
+    def _costAndGrad(self, xi):
+        self._xValidate(xi)
+        if self.xiOuter is None:
+            raise RuntimeError("outer loop not initialized")
+        if self.obs.empty:
+            return 0.5*np.dot(xi,xi), xi.copy()
+
+        dx=timedCall('B_sqrt', self.B_sqrt, xi-self.xiOuter, 
+                        *self.B_sqrtArgs)
+        res=self.innoOuter-self.obs.modelEquivalentTLM(dx, self.tlm, 
+                                            t0=self.tWin[0], stacked=True)
+        Rres=self.obs.applyMetric(res)
+        Jo=0.5*np.dot(res, Rres)
+        dx0=-self.obs.modelEquivalent_Adj(Rres, self.tlm, 
+                                            t0=self.tWin[0])
+        return (Jo+0.5*np.dot(xi,xi),
+                xi+timedCall('B_sqrtAdj', self.B_sqrtAdj, dx0, 
+                                *self.B_sqrtArgs))
+
+    #------------------------------------------------------
+
+    def _costFunc(self, xi):
+        return self._costAndGrad(xi)[0]
+
+    def _gradCostFunc(self, xi):
+        return self._costAndGrad(xi)[1]
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    @instrumented
+    def minimize(self, maxiter=50, nOuter=3, retall=True,
+                    testGrad=True, finalTestGrad=False, convergence=True, 
+                    testGradMinPow=-1, testGradMaxPow=-14,
+                    minimizer='lbfgs', memory=10, storeHessInv=True,
+                    hessInv0=None, recorder=None, testGradTol=None,
+                    disp=True, minimizerOptions=None):
+        '''
+            instrument  :   the last minimum reports all the outer 
+                                loops (each of outerMinima[:-1] its
+                                inner loop)
+        '''
+        if not (isinstance(nOuter, int) and nOuter>0):
+            raise ValueError("nOuter <int> >0")
+        self.outerMinima=[]
+        self.outerJ=[]
+        xi=np.zeros(self.modelGrid.N)
+        for k in xrange(nOuter):
+            self._outerUpdate(xi)
+            JTerm.minimize(self, xi, maxiter=maxiter, retall=retall,
+                    testGrad=(testGrad and k==0), 
+                    finalTestGrad=finalTestGrad,
+                    convergence=convergence, 
+                    testGradMinPow=testGradMinPow,
+                    testGradMaxPow=testGradMaxPow,
+                    minimizer=minimizer, memory=memory,
+                    storeHessInv=storeHessInv, hessInv0=hessInv0,
+                    recorder=recorder, testGradTol=testGradTol,
+                    disp=disp, minimizerOptions=minimizerOptions)
+            self.outerMinima.append(self.minimum)
+            xi=self.minimum.xOpt
+
+    #------------------------------------------------------
+    #----| Classical overloads |----------------------------
+    #-------------------------------------------------------
+
+    def __str__(self):
+        output=super(IncrPrecondTWObsJTerm, self).__str__()
+        output+=" outer loops=%d\n"%len(self.outerMinima)
+        for k in xrange(len(self.outerJ)):
+            output+="  J(x_%d)=%f\n"%(k, self.outerJ[k])
+        return output
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
@@ -0,0 +1,139 @@
+import numpy as np
+
+#   Random streams: numpy.random.Generator when available (numpy>=1.17),
+#   numpy.random.RandomState otherwise. Both provide standard_normal(),
+#   normal(), uniform(), choice() and permutation(); integers are drawn
+#   with rngIntegers(), without replacement with rngSample().
+
+try:
+    from numpy.random import default_rng, SeedSequence
+    _hasGenerator=True
+except ImportError:
+    _hasGenerator=False
+
+def _seedValue(seed):
+    # float seeds (e.g. observation times) by their bit pattern
+    if isinstance(seed, float):
+        return np.array([seed]).view(np.uint32).tolist()
+    return seed
+
+def makeRNG(seed=None):
+    '''
+    Random stream from a seed
+
+        seed    :   <None | int | float | numpy.random.Generator |
+                        numpy.random.RandomState>
+                    (a stream is returned as is)
+    '''
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    if _hasGenerator:
+        if isinstance(seed, np.random.Generator):
+            return seed
+        return default_rng(_seedValue(seed))
+    else:
+        return np.random.RandomState(_seedValue(seed))
+
+def spawnRNGs(seed, n):
+    '''
+    n independent random streams derived from a single seed
+
+        the i-th stream only depends on (seed, i): results do not
+        depend on which process (or in which order) consumes them
+
+        seed    :   <None | int | float>
+    '''
+    if not (isinstance(n, int) and n>=0):
+        raise ValueError("n <int> >=0")
+    if _hasGenerator:
+        return [default_rng(s) 
+                    for s in SeedSequence(_seedValue(seed)).spawn(n)]
+    else:
+        if seed==None:
+            seed=np.random.RandomState().randint(2**31)
+        seed=np.atleast_1d(_seedValue(seed)).tolist()
+        return [np.random.RandomState(seed+[i]) for i in xrange(n)]
+
+def rngIntegers(rng, low, high, size=None):
+    '''
+    Integers in [low, high)
+    '''
+    if _hasGenerator and isinstance(rng, np.random.Generator):
+        return rng.integers(low, high, size=size)
+    else:
+        return rng.randint(low, high, size=size)
+
+def rngSample(rng, n, k):
+    '''
+    k distinct integers drawn uniformly in [0, n) (random order)
+    '''
+    if not 0<=k<=n:
+        raise ValueError("0<=k<=n")
+    if _hasGenerator and isinstance(rng, np.random.Generator):
+        return rng.choice(n, k, replace=False)
+    if 4*k>n:
+        return rng.permutation(n)[:k]
+    # sparse draw: no O(n) permutation
+    picks=np.unique(rngIntegers(rng, 0, n, size=2*k))
+    while len(picks)<k:
+        picks=np.union1d(picks, rngIntegers(rng, 0, n, size=k))
+    return picks[rng.permutation(len(picks))[:k]]
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class RunningStats(object):
+    '''
+    Streaming mean and variance (Welford, batched)
+
+        stats=RunningStats()
+        for chunk in ...:
+            stats.update(chunk)     # chunk.shape=(nSamples, ...)
+
+        stats.n     :   number of samples
+        stats.mean  :   <numpy.ndarray>
+        stats.var() :   (population) variance <numpy.ndarray>
+        stats.std() :   standard deviation <numpy.ndarray>
+
+        Memory is that of one sample, whatever the number of
+        chunks.
+    '''
+
+    #------------------------------------------------------
+    #----| Init |------------------------------------------
+    #------------------------------------------------------
+
+    def __init__(self):
+        self.n=0
+        self.mean=None
+        self.__M2=None
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    def update(self, chunk):
+        chunk=np.asarray(chunk, dtype=float)
+        nB=chunk.shape[0]
+        if nB==0:
+            return
+        meanB=chunk.mean(axis=0)
+        M2B=((chunk-meanB)**2).sum(axis=0)
+        if self.n==0:
+            self.mean=meanB
+            self.__M2=M2B
+        else:
+            n=self.n+nB
+            delta=meanB-self.mean
+            self.mean=self.mean+delta*(float(nB)/n)
+            self.__M2=self.__M2+M2B+delta**2*(float(self.n)*nB/n)
+        self.n+=nB
+
+    def var(self):
+        if self.n==0:
+            raise ValueError("no sample")
+        return self.__M2/self.n
+
+    def std(self):
+        return np.sqrt(self.var())
@@ -12,21 +12,76 @@ def fftOrder(N):
 
         N       :   number of grid point
     """
-    m=np.zeros(N)
-    for i in xrange(N):
-        if i <= (N-1)/2:
-            m[i]=i
-        else:
-            m[i]=i-N
-    return m
+    i=np.arange(N)
+    return np.where(i<=(N-1)//2, i, i-N).astype(float)
+
+#=====================================================================
+#---------------------------------------------------------------------
+#=====================================================================
+
+class SpectralFilter(object):
+    """
+    Spectral truncature filter
+
+    SpectralFilter(N, Ntrc)
+
+        N       :   number of grid point
+        Ntrc    :   truncature (modes |m|>Ntrc are removed)
+
+    The truncature mask is computed once in numpy.fft.rfft layout;
+    filter() acts along the last axis, so a single state (N,), an 
+    ensemble (nMembers, N) or a whole trajectory (nTimes, N) are
+    filtered in one call.
+    """
+
+    #------------------------------------------------------
+    #----| Init |------------------------------------------
+    #------------------------------------------------------
+
+    def __init__(self, N, Ntrc):
+        if not (isinstance(N, (int, np.integer)) and N>0):
+            raise spectralLibError("N <int> >0")
+        if Ntrc<0:
+            raise spectralLibError("Ntrc>=0")
+        self.N=N
+        self.Ntrc=Ntrc
+        self.mask=(np.arange(N//2+1)<=Ntrc)
+
+    #------------------------------------------------------
+    #----| Public methods |--------------------------------
+    #------------------------------------------------------
+
+    def filter(self, x):
+        x=np.asarray(x)
+        if x.shape[-1:]<>(self.N,):
+            raise spectralLibError("x.shape[-1]==N")
+        tf=fft.rfft(x, axis=-1)
+        tf[...,~self.mask]=0.
+        return fft.irfft(tf, n=self.N, axis=-1)
+
+    def __call__(self, x):
+        return self.filter(x)
+
+#---------------------------------------------------------------------
+
+_specFilters={}
+
+def getSpecFilter(N, Ntrc):
+    """
+    Cached SpectralFilter(N, Ntrc)
+    """
+    key=(N, Ntrc)
+    if not key in _specFilters:
+        _specFilters[key]=SpectralFilter(N, Ntrc)
+    return _specFilters[key]
 
 def specFilt(x, Ntrc):
-    N=len(x)
-    tf=fft.fft(x)
-    m=fftOrder(N)
-    for i in xrange(N):
-        # truncature
-        if np.abs(m[i])>Ntrc:
-            tf[i]=0.
-    f=(fft.ifft(tf)).real.copy(order='C')
-    return f
+    '''
+    Spectral truncature (along the last axis)
+
+        specFilt(x, Ntrc)
+
+        x       :   (N,), (nMembers, N) or (nTimes, N) array
+        Ntrc    :   truncature
+    '''
+    return getSpecFilter(np.shape(x)[-1], Ntrc).filter(x)
@@ -0,0 +1,103 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from pseudoSpec1D import PeriodicGrid
+from dVar import StaticObs, obsOp_Coord, obsOp_Coord_Adj, LBFGSHistory, \
+                    HessianEigen, OperatorMetric, B_isoHomo_inv_op, \
+                    make_BisoHomo_args, make_BisoHomo_op, saveTWObs, \
+                    openTWObs, saveStaticObs, openStaticObs, \
+                    saveJMinimum, openJMinimum, BinaryArchive, ArchiveError
+from test_observations import makeTWObs
+from test_dump import makeJMinimum
+
+#   Round trips of the binary archives (TimeWindowObs, JMinimum)
+
+#=====================================================================
+
+class TestBinaryArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.g=PeriodicGrid(32)
+        self.rng=np.random.RandomState(0)
+        self.tmp=tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testTWObs(self):
+        twObs=makeTWObs(self.g, self.rng)
+        dirName=os.path.join(self.tmp, 'twObs')
+        saveTWObs(twObs, dirName)
+        arch=openTWObs(dirName)
+        np.testing.assert_array_equal(arch.times, twObs.times)
+        twObs2=arch.load()
+        np.testing.assert_array_equal(twObs2.times, twObs.times)
+        np.testing.assert_array_equal(twObs2.stackedCoord,
+                                        twObs.stackedCoord)
+        np.testing.assert_array_equal(twObs2.stackedValues,
+                                        twObs.stackedValues)
+        np.testing.assert_allclose(twObs2.metric.dense(),
+                                    twObs.metric.dense())
+        self.assertTrue(twObs2[0.25].obsOp is obsOp_Coord)
+        # computed times find their observations
+        np.testing.assert_array_equal(arch[0.1+0.15].values,
+                                        twObs[0.25].values)
+        self.assertRaises(KeyError, arch.__getitem__, 0.3)
+
+    def testOverwrite(self):
+        dirName=os.path.join(self.tmp, 'twObs')
+        saveTWObs(makeTWObs(self.g, self.rng), dirName)
+        # without the correlated metric array (metric0_R)
+        twObs=makeTWObs(self.g, self.rng, times=(0.5,), correlated=False)
+        self.assertRaises(ArchiveError, saveTWObs, twObs, dirName)
+        saveTWObs(twObs, dirName, overwrite=True)
+        # no array left from the previous archive
+        arrays=BinaryArchive(dirName).index
+        self.assertEqual(sorted(os.listdir(dirName)), 
+                    sorted(['header.json']+[arrays[name]['file'] 
+                                            for name in arrays]))
+        np.testing.assert_array_equal(openTWObs(dirName).load().times,
+                                        [0.5])
+
+    def testJMinimum(self):
+        N=self.g.N
+        for BOpt in (LBFGSHistory(self.rng.randn(3, N),
+                                    self.rng.randn(3, N)**2),
+                     HessianEigen([4., 2.], np.eye(N)[:2]),
+                     np.diag(self.rng.rand(N)+1.)):
+            jMin=makeJMinimum(self.rng, N, BOpt)
+            dirName=os.path.join(self.tmp, type(BOpt).__name__)
+            saveJMinimum(jMin, dirName)
+            arch=openJMinimum(dirName)
+            np.testing.assert_array_equal(arch.xOpt, jMin.xOpt)
+            jMin2=arch.load()
+            np.testing.assert_array_equal(jMin2.allvecs,
+                                            np.array(jMin.allvecs))
+            self.assertEqual(list(jMin2.convergence), jMin.convergence)
+            self.assertEqual(list(jMin2.history.J), jMin.history.J)
+            v=self.rng.randn(N)
+            np.testing.assert_allclose(jMin2.BOpt.dot(v), BOpt.dot(v))
+            self.assertEqual(jMin2.instrumentation.report(),
+                                jMin.instrumentation.report())
+
+    def testOperatorMetric(self):
+        # identity observations of the whole grid, B^{-1} as R^{-1}
+        args=make_BisoHomo_args(self.g, 5., 0.3)
+        metric=OperatorMetric(B_isoHomo_inv_op, self.g.N, args=args)
+        obs=StaticObs(self.g, self.rng.randn(self.g.N), metric=metric)
+        dirName=os.path.join(self.tmp, 'operator')
+        saveStaticObs(obs, dirName)
+        obs2=openStaticObs(dirName)
+        self.assertTrue(obs2.metric.op is B_isoHomo_inv_op)
+        y=self.rng.randn(self.g.N)
+        np.testing.assert_allclose(obs2.metric.apply(y), metric.apply(y))
+        # bound methods cannot be found back by name
+        B=make_BisoHomo_op(self.g, 5., 0.3)
+        obs.metric=OperatorMetric(B.inv, self.g.N)
+        self.assertRaises(ArchiveError, saveStaticObs, obs, 
+                            os.path.join(self.tmp, 'bound'))
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import unittest
+import os
+import time
+import tempfile
+import numpy as np
+import pyKdV as kdv
+from dVar import StaticObs, TimeWindowObs, obsOp_Coord, obsOp_Coord_Adj, \
+                    PrecondTWObsJTerm, B_sqrt_isoHomo_op, \
+                    B_sqrt_isoHomo_op_Adj, make_BisoHomo_args, \
+                    AssimCycling, windowObs
+import dVar.cycling as cycling
+
+#   Window extraction from a long observation record, and what runs
+#   concurrently in AssimCycling: the observations of window k+1 are
+#   extracted by a worker process during the minimization of window k.
+
+def makeRecord(g, rng, times, nObs=6):
+    d_Obs={}
+    for t in times:
+        idx=np.sort(rng.choice(g.N, nObs, replace=False))
+        d_Obs[t]=StaticObs(g.x[idx], rng.randn(nObs), obsOp_Coord,
+                            obsOp_Coord_Adj, metric=1./0.1**2)
+    return TimeWindowObs(d_Obs)
+
+class SlowJTerm(PrecondTWObsJTerm):
+    '''
+    Records the interval of each minimization (the sleep stands for
+    a long one)
+    '''
+    intervals=[]
+
+    def minimize(self, **kwargs):
+        tStart=time.time()
+        time.sleep(0.3)
+        PrecondTWObsJTerm.minimize(self, **kwargs)
+        SlowJTerm.intervals.append((tStart, time.time()))
+
+#=====================================================================
+
+class TestWindowObs(unittest.TestCase):
+
+    def setUp(self):
+        self.g=kdv.PeriodicGrid(32)
+        self.rng=np.random.RandomState(0)
+        self.times=[0.1*(i+1) for i in xrange(40)]
+        self.record=makeRecord(self.g, self.rng, self.times)
+
+    def testMatchesSelection(self):
+        for t0, tf in ((0., 1.), (1., 2.), (0.95, 1.25), (3.9, 5.),
+                        (5., 6.)):
+            window=windowObs(self.record, t0, tf)
+            ref=TimeWindowObs(dict((t, self.record[t]) for t in self.times
+                                    if t>t0 and t<=tf))
+            np.testing.assert_array_equal(window.times, ref.times)
+            np.testing.assert_array_equal(window.offsets, ref.offsets)
+            np.testing.assert_array_equal(window.stackedCoord,
+                                            ref.stackedCoord)
+            np.testing.assert_array_equal(window.stackedValues,
+                                            ref.stackedValues)
+            self.assertEqual((window.nObs, window.empty),
+                                (ref.nObs, ref.empty))
+            if not ref.empty:
+                X=self.rng.randn(ref.nTimes, self.g.N)
+                y=self.rng.randn(ref.nObs)
+                np.testing.assert_array_equal(
+                        window._stackedModelEquivalent(X, self.g),
+                        ref._stackedModelEquivalent(X, self.g))
+                np.testing.assert_array_equal(
+                        window._stackedModelEquivalent_Adj(y, self.g),
+                        ref._stackedModelEquivalent_Adj(y, self.g))
+                np.testing.assert_allclose(window.metric.dense(),
+                                            ref.metric.dense())
+
+#=====================================================================
+
+class TestCyclingPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.g=kdv.PeriodicGrid(32)
+        self.rng=np.random.RandomState(0)
+        param=kdv.Param(self.g)
+        self.model=kdv.kdvLauncher(param, dt=0.01)
+        self.tlm=kdv.kdvTLMLauncher(param)
+        self.record=makeRecord(self.g, self.rng, [0.25, 0.5, 0.75, 1.,
+                                                    1.25, 1.5])
+        self.args=make_BisoHomo_args(self.g, 5., 0.3)
+        self.log=tempfile.mktemp()
+        self.windowObs=cycling.windowObs
+        SlowJTerm.intervals=[]
+
+    def tearDown(self):
+        cycling.windowObs=self.windowObs
+        if os.path.exists(self.log):
+            os.remove(self.log)
+
+    def testNextWindowDuringMinimization(self):
+        log=self.log
+        def loggedWindowObs(obs, t0, tf):
+            # called in the worker processes (forked after the patch)
+            with open(log, 'a') as f:
+                f.write("%d %f %f\n"%(os.getpid(), t0, time.time()))
+            return self.windowObs(obs, t0, tf)
+        cycling.windowObs=loggedWindowObs
+
+        cycles=AssimCycling(self.record, self.model, self.tlm,
+                            np.zeros(self.g.N), B_sqrt_isoHomo_op,
+                            B_sqrt_isoHomo_op_Adj, 0.5,
+                            B_sqrtArgs=self.args, JTermClass=SlowJTerm,
+                            minimizeArgs=dict(maxiter=5, testGrad=False,
+                                                disp=False))
+        results=cycles.run()
+        self.assertEqual(len(results), 3)
+        self.assertEqual([res.nObs for res in results], [12, 12, 12])
+
+        extractions=np.loadtxt(log, ndmin=2)
+        self.assertEqual(len(extractions), 3)
+        self.assertTrue(np.all(extractions[:,0]<>os.getpid()))
+        starts=dict((t0, tExtract) for pid, t0, tExtract in extractions)
+        for k, (tMinStart, tMinEnd) in enumerate(SlowJTerm.intervals[:-1]):
+            # window k+1 is ready before the end of minimization k
+            self.assertTrue(starts[cycles.window(k+1)[0]]<tMinEnd)
+
+if __name__=='__main__':
+    unittest.main()
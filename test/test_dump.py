@@ -0,0 +1,74 @@
+import unittest
+import pickle
+import StringIO
+import numpy as np
+from dVar import JMinimum, loadJMinimum, LBFGSHistory, \
+                    ConvergenceRecorder, Instrument
+
+#   Round trips of the pickled JMinimum dumps, versioned and
+#   unversioned records
+
+def makeJMinimum(rng, N, BOpt):
+    history=ConvergenceRecorder()
+    history.start()
+    for k in xrange(3):
+        history.record(rng.randn(N), 10.-k, rng.randn(N))
+    instrument=Instrument('test')
+    instrument.record('obsOp', 0.5, 64)
+    return JMinimum(rng.randn(N), 1.5, rng.randn(N), BOpt, 12, 12, 0, 50,
+                    allvecs=[rng.randn(N) for k in xrange(4)],
+                    convergence=[4., 3., 2., 1.5], history=history,
+                    instrumentation=instrument)
+
+#=====================================================================
+
+class TestDumpLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.rng=np.random.RandomState(0)
+        self.N=32
+
+    def assertSameMinimum(self, m1, m2):
+        np.testing.assert_array_equal(m1.xOpt, m2.xOpt)
+        np.testing.assert_array_equal(m1.gOpt, m2.gOpt)
+        self.assertEqual(m1.fOpt, m2.fOpt)
+        self.assertEqual((m1.fCalls, m1.gCalls, m1.warnFlag, m1.maxiter),
+                            (m2.fCalls, m2.gCalls, m2.warnFlag, m2.maxiter))
+        np.testing.assert_array_equal(np.array(m1.allvecs),
+                                        np.array(m2.allvecs))
+        self.assertEqual(list(m1.convergence), list(m2.convergence))
+        v=self.rng.randn(self.N)
+        np.testing.assert_allclose(m1.BOpt.dot(v), m2.BOpt.dot(v))
+
+    def testJMinimum(self):
+        BOpt=LBFGSHistory(self.rng.randn(3, self.N),
+                            self.rng.randn(3, self.N)**2)
+        jMin=makeJMinimum(self.rng, self.N, BOpt)
+        f=StringIO.StringIO()
+        jMin.dump(f)
+        f.seek(0)
+        jMin2=loadJMinimum(f)
+        self.assertSameMinimum(jMin, jMin2)
+        self.assertEqual(jMin2.history.J, jMin.history.J)
+        self.assertEqual(jMin2.instrumentation.calls, {'obsOp':1})
+        self.assertEqual(jMin2.instrumentation.peakResultBytes, 64)
+
+    def testUnversionedDumps(self):
+        # dumps without version marker, followed by a versioned one
+        jMin=makeJMinimum(self.rng, self.N, None)
+        f=StringIO.StringIO()
+        for k in xrange(2):
+            for record in (jMin.xOpt, jMin.fOpt, jMin.gOpt, jMin.BOpt,
+                            jMin.fCalls, jMin.gCalls, jMin.warnFlag,
+                            jMin.maxiter, jMin.allvecs, jMin.convergence):
+                pickle.dump(record, f)
+        jMin.dump(f)
+        f.seek(0)
+        for k in xrange(2):
+            old=loadJMinimum(f)
+            np.testing.assert_array_equal(old.xOpt, jMin.xOpt)
+            self.assertTrue(old.history is None)
+        self.assertEqual(loadJMinimum(f).history.J, jMin.history.J)
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import sys
+import StringIO
+import numpy as np
+import pyKdV as kdv
+from dVar import StaticObs, TimeWindowObs, obsOp_Coord, obsOp_Coord_Adj, \
+                    B_sqrt_isoHomo_op, B_sqrt_isoHomo_op_Adj, \
+                    make_BisoHomo_args, EDARunner
+
+#   Ensemble of data assimilations: members only depend on
+#   (seed, member index), whatever the number of processes
+
+class TestEDA(unittest.TestCase):
+
+    def setUp(self):
+        self.g=kdv.PeriodicGrid(32)
+        rng=np.random.RandomState(0)
+        param=kdv.Param(self.g)
+        self.model=kdv.kdvLauncher(param, dt=0.01)
+        self.tlm=kdv.kdvTLMLauncher(param)
+        d_Obs={}
+        for t in (0.25, 0.5):
+            idx=np.sort(rng.choice(self.g.N, 6, replace=False))
+            d_Obs[t]=StaticObs(self.g.x[idx], rng.randn(6), obsOp_Coord,
+                                obsOp_Coord_Adj, metric=1./0.1**2)
+        self.obs=TimeWindowObs(d_Obs)
+        self.xb=0.1*rng.randn(self.g.N)
+        self.args=make_BisoHomo_args(self.g, 5., 0.3)
+
+    def runEDA(self, seed, nProc, **kwargs):
+        return EDARunner(self.obs, self.model, self.tlm, self.xb,
+                            B_sqrt_isoHomo_op, B_sqrt_isoHomo_op_Adj,
+                            B_sqrtArgs=self.args, nMembers=3, seed=seed,
+                            nProc=nProc, minimizeArgs=dict(maxiter=5),
+                            **kwargs).run()
+
+    def testReproducible(self):
+        serial=self.runEDA(1, 1)
+        parallel=self.runEDA(1, 3)
+        np.testing.assert_array_equal(parallel.bkgs, serial.bkgs)
+        np.testing.assert_array_equal(parallel.analyses, serial.analyses)
+        other=self.runEDA(2, 1)
+        self.assertFalse(np.allclose(other.bkgs, serial.bkgs))
+        # distinct members
+        self.assertFalse(np.allclose(serial.bkgs[0], serial.bkgs[1]))
+
+    def testQuietMembers(self):
+        stdout=sys.stdout
+        sys.stdout=StringIO.StringIO()
+        try:
+            self.runEDA(1, 1)
+            output=sys.stdout.getvalue()
+        finally:
+            sys.stdout=stdout
+        self.assertEqual(output, '')
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import numpy as np
+import pyKdV as kdv
+from dVar import Instrument, timedCall, activate, deactivate, \
+                    instrumenting, isActive
+from test_precondJTerm import make4DVar
+
+#   Instrumentation: call counts of the costly operations, recorded
+#   by nested instruments, and attached to the minima
+
+class TestTimedCall(unittest.TestCase):
+
+    def testCounts(self):
+        outer=Instrument('outer')
+        inner=Instrument('inner')
+        self.assertEqual(timedCall('f', np.ones, 4).shape, (4,))
+        with instrumenting(outer):
+            timedCall('f', np.ones, 4)
+            with instrumenting(inner):
+                timedCall('f', np.ones, 4)
+                timedCall('g', np.ones, 8)
+        self.assertFalse(isActive())
+        self.assertEqual(outer.calls, {'f':2, 'g':1})
+        self.assertEqual(inner.calls, {'f':1, 'g':1})
+        self.assertEqual(outer.maxResultBytes['g'], 64)
+        self.assertEqual(Instrument.fromReport(outer.report()).calls,
+                            outer.calls)
+
+    def testActivate(self):
+        instrument=activate()
+        try:
+            self.assertRaises(RuntimeError, instrument.start)
+        finally:
+            self.assertTrue(deactivate() is instrument)
+        self.assertRaises(RuntimeError, deactivate)
+
+#=====================================================================
+
+class TestMinimizeCounts(unittest.TestCase):
+
+    def setUp(self):
+        self.g=kdv.PeriodicGrid(32)
+        self.J=make4DVar(self.g, np.random.RandomState(0))
+
+    def testCallsPerEvaluation(self):
+        self.J.minimize(maxiter=10, testGrad=False, disp=False,
+                        instrument=True)
+        minimum=self.J.minimum
+        calls=minimum.instrumentation.calls
+        # one fused evaluation (cost and gradient) per point
+        self.assertEqual(minimum.gCalls, minimum.fCalls)
+        for name in ('nlModel.integrate', 'tlm.reference',
+                        'tlm.d_nDtIntAdj', 'obsOp', 'obsOpAdj',
+                        'B_sqrtAdj'):
+            self.assertEqual(calls[name], minimum.fCalls)
+        # and the analysis
+        self.assertEqual(calls['B_sqrt'], minimum.fCalls+1)
+
+    def testNested(self):
+        self.J.minimize(maxiter=5, testGrad=False, disp=False,
+                        instrument=False)
+        self.assertEqual(self.J.minimum.instrumentation, None)
+        session=Instrument('session')
+        with instrumenting(session):
+            self.J.minimize(maxiter=5, testGrad=False, disp=False)
+            first=self.J.minimum.instrumentation
+            self.J.minimize(maxiter=3, testGrad=False, disp=False)
+            second=self.J.minimum.instrumentation
+        self.assertFalse(first is second)
+        for name in session.calls:
+            self.assertEqual(session.calls[name],
+                                first.calls[name]+second.calls[name])
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,359 @@
+import unittest
+import os
+import shutil
+import tempfile
+import pickle
+import numpy as np
+from pseudoSpec1D import PeriodicGrid
+from dVar import StaticObs, obsOp_Coord, obsOp_Coord_Adj, BkgJTerm, \
+                    StaticObsJTerm, JTerm, JSum, IterateStore, \
+                    OperatorMetric, DiagMetric, B_isoHomo_inv_op, \
+                    make_BisoHomo_args, BIsoHomo
+
+#   Behaviour of the JTerm machinery on a quadratic 3D-Var cost
+#   (background and static observation terms, no model)
+
+def make3DVar(g, rng, nObs=12, sigObs=0.1, sigBkg=0.5):
+    idx=np.sort(rng.choice(g.N, nObs, replace=False))
+    obs=StaticObs(g.x[idx], rng.randn(nObs), obsOp_Coord, obsOp_Coord_Adj,
+                    metric=1./sigObs**2)
+    xb=rng.randn(g.N)
+    return BkgJTerm(xb, g, metric=1./sigBkg**2)+StaticObsJTerm(obs, g)
+
+def makeQuadratic(A, b):
+    '''
+    J(x)=0.5*x'Ax-b'x
+    '''
+    return JTerm(lambda x: 0.5*np.dot(x, np.dot(A, x))-np.dot(b, x),
+                    lambda x: np.dot(A, x)-b)
+
+#=====================================================================
+
+class TestGradTest(unittest.TestCase):
+
+    def setUp(self):
+        self.g=PeriodicGrid(32)
+        self.rng=np.random.RandomState(0)
+        self.J=make3DVar(self.g, self.rng)
+        self.x=self.rng.randn(self.g.N)
+
+    def testParallelMatchesSerial(self):
+        serial=self.J.gradTest(self.x, output=False, nProc=1)
+        parallel=self.J.gradTest(self.x, output=False, nProc=3)
+        self.assertEqual(serial.J0, parallel.J0)
+        np.testing.assert_array_equal(parallel.powers, serial.powers)
+        np.testing.assert_array_equal(parallel.ratios, serial.ratios)
+
+    def testStopTol(self):
+        full=self.J.gradTest(self.x, output=False)
+        self.assertEqual(len(full.powers), 13)
+        self.assertFalse(full.converged)
+        early=self.J.gradTest(self.x, output=False, stopTol=1e-6)
+        self.assertTrue(early.converged)
+        self.assertTrue(len(early.powers)<len(full.powers))
+        self.assertTrue(abs(1.-early.ratios[-1])<=1e-6)
+        # same ratios as the full table up to the stop
+        np.testing.assert_array_equal(early.ratios,
+                                        full.ratios[:len(early.ratios)])
+        # former tuple return
+        J0, n2GradJ0, test=early
+        self.assertEqual(len(test), len(early.powers))
+
+    def testMinimizeFullTableByDefault(self):
+        self.J.minimize(self.x, testGrad=True, maxiter=5, disp=False)
+        self.assertEqual(len(self.J.testGradInit.powers), 13)
+
+#=====================================================================
+
+class TestBackends(unittest.TestCase):
+
+    def setUp(self):
+        self.g=PeriodicGrid(32)
+        self.rng=np.random.RandomState(0)
+        self.J=make3DVar(self.g, self.rng)
+        self.x0=np.zeros(self.g.N)
+
+    def minimum(self, minimizer, **kwargs):
+        self.J.minimize(self.x0, testGrad=False, minimizer=minimizer,
+                        disp=False, **kwargs)
+        return self.J.minimum
+
+    def testSameMinimum(self):
+        mBFGS=self.minimum('bfgs', maxiter=200)
+        mLBFGS=self.minimum('lbfgs', maxiter=200)
+        self.assertEqual((mBFGS.warnFlag, mLBFGS.warnFlag), (0, 0))
+        np.testing.assert_allclose(mLBFGS.xOpt, mBFGS.xOpt, atol=1e-5)
+        # fused evaluations: one gradient per cost
+        self.assertEqual(mLBFGS.gCalls, mLBFGS.fCalls)
+
+    def testTolerances(self):
+        loose=self.minimum('lbfgs', maxiter=200, 
+                            minimizerOptions=dict(gtol=1e-1, ftol=1e-3))
+        tight=self.minimum('lbfgs', maxiter=200, 
+                            minimizerOptions=dict(gtol=1e-8, ftol=0.))
+        self.assertTrue(loose.fCalls<tight.fCalls)
+        self.assertTrue(np.abs(tight.gOpt).max()<=1e-8)
+        bfgs=self.minimum('bfgs', maxiter=200, 
+                            minimizerOptions=dict(gtol=1e-1))
+        self.assertTrue(np.abs(bfgs.gOpt).max()<=1e-1)
+
+#=====================================================================
+
+class TestJSum(unittest.TestCase):
+
+    N=8
+
+    def setUp(self):
+        self.rng=np.random.RandomState(0)
+        self.terms=[makeQuadratic(np.diag(self.rng.rand(self.N)+1.),
+                                    10.*self.rng.randn(self.N))
+                    for i in xrange(3)]
+        self.x=self.rng.randn(self.N)
+
+    def testFlattening(self):
+        J1, J2, J3=self.terms
+        J=((J1+J2)+J3)*.5
+        self.assertTrue(isinstance(J, JSum))
+        self.assertEqual(J.nTerms, 3)
+        self.assertTrue(all(Ji is Ti for Ji, Ti in zip(J.terms, self.terms)))
+        self.assertEqual(J.weights, [.5, .5, .5])
+        costs=[Ji.J(self.x) for Ji in self.terms]
+        np.testing.assert_allclose(J.J(self.x), 0.5*sum(costs))
+        np.testing.assert_allclose(J.termCosts, costs)
+        grad=0.5*sum(Ji.gradJ(self.x) for Ji in self.terms)
+        np.testing.assert_allclose(J.gradJ(self.x), grad)
+        cost, g=J.costAndGradJ(self.x)
+        np.testing.assert_allclose(g, grad)
+        # a clipped sum stays a node
+        clipped=JSum([J1, J2], maxGradNorm=1.)
+        self.assertEqual((clipped+J3).nTerms, 2)
+
+    def testClippingOnlyWithMaxGradNorm(self):
+        J=JSum(self.terms)
+        grad=sum(Ji.gradJ(self.x) for Ji in self.terms)
+        self.assertTrue(np.linalg.norm(grad)>1.)
+        np.testing.assert_allclose(J.gradJ(self.x), grad)
+        clipped=JSum(self.terms, maxGradNorm=1.)
+        np.testing.assert_allclose(clipped.gradJ(self.x), 
+                                    grad/np.linalg.norm(grad))
+        np.testing.assert_allclose(clipped.costAndGradJ(self.x)[1],
+                                    grad/np.linalg.norm(grad))
+        self.assertEqual(clipped.J(self.x), J.J(self.x))
+
+#=====================================================================
+
+class TestEvalCache(unittest.TestCase):
+
+    def setUp(self):
+        self.rng=np.random.RandomState(0)
+        self.calls={'cost':0, 'grad':0}
+        A=np.diag(self.rng.rand(8)+1.)
+        b=self.rng.randn(8)
+        def costFunc(x):
+            self.calls['cost']+=1
+            return 0.5*np.dot(x, np.dot(A, x))-np.dot(b, x)
+        def gradCostFunc(x):
+            self.calls['grad']+=1
+            return np.dot(A, x)-b
+        self.J=JTerm(costFunc, gradCostFunc)
+        self.x=self.rng.randn(8)
+
+    def testHits(self):
+        J0=self.J.J(self.x)
+        self.assertEqual(self.J.J(self.x.copy()), J0)
+        grad=self.J.gradJ(self.x)
+        grad[:]=0.
+        cost, g=self.J.costAndGradJ(self.x)
+        self.assertEqual(cost, J0)
+        self.assertTrue(np.all(g<>0.))
+        self.assertEqual(self.calls, {'cost':1, 'grad':1})
+        # least recently used points dropped
+        for i in xrange(JTerm.evalCacheSize):
+            self.J.J(self.x+i+1.)
+        self.J.J(self.x)
+        self.assertEqual(self.calls['cost'], JTerm.evalCacheSize+2)
+
+    def testInvalidate(self):
+        self.J.J(self.x)
+        self.J.args=()
+        self.J.J(self.x)
+        self.assertEqual(self.calls['cost'], 2)
+        self.J.invalidate()
+        self.J.J(self.x)
+        self.assertEqual(self.calls['cost'], 3)
+
+    def testBkgReassigned(self):
+        g=PeriodicGrid(16)
+        J=BkgJTerm(self.rng.randn(g.N), g, metric=2.)
+        x=self.rng.randn(g.N)
+        J.J(x)
+        J.bkg=x.copy()
+        self.assertEqual(J.J(x), 0.)
+        np.testing.assert_array_equal(J.gradJ(x), 0.)
+
+#=====================================================================
+
+class TestBkgJTerm(unittest.TestCase):
+
+    def setUp(self):
+        self.g=PeriodicGrid(32)
+        self.rng=np.random.RandomState(0)
+        self.xb=self.rng.randn(self.g.N)
+        self.x=self.rng.randn(self.g.N)
+
+    def assertMatchesDense(self, J, BInv):
+        # J=0.5*(x-xb)'B^{-1}(x-xb), grad J=+B^{-1}(x-xb)
+        d=self.x-self.xb
+        np.testing.assert_allclose(J.J(self.x), 0.5*np.dot(d, 
+                                    np.dot(BInv, d)), rtol=1e-10)
+        np.testing.assert_allclose(J.gradJ(self.x), np.dot(BInv, d),
+                                    rtol=1e-8, atol=1e-10)
+        cost, grad=J.costAndGradJ(self.x+1.)
+        np.testing.assert_allclose(grad, np.dot(BInv, d+1.), rtol=1e-8,
+                                    atol=1e-10)
+        self.assertTrue(J.gradTest(self.x, output=False, 
+                                    stopTol=1e-6).converged)
+
+    def testOperatorMetric(self):
+        args=make_BisoHomo_args(self.g, 5., 0.3)
+        BInv=B_isoHomo_inv_op(np.eye(self.g.N), *args).T
+        J=BkgJTerm(self.xb, self.g, metric=B_isoHomo_inv_op, 
+                    metricArgs=args)
+        self.assertTrue(isinstance(J.metric, OperatorMetric))
+        self.assertMatchesDense(J, BInv)
+        self.assertMatchesDense(BkgJTerm(self.xb, self.g, 
+                                    metric=BIsoHomo(*args).inv), BInv)
+        self.assertMatchesDense(BkgJTerm(self.xb, self.g, metric=BInv),
+                                BInv)
+
+    def testDiagonalMetric(self):
+        w=1.+self.rng.rand(self.g.N)
+        J=BkgJTerm(self.xb, self.g, metric=w)
+        self.assertTrue(isinstance(J.metric, DiagMetric))
+        self.assertMatchesDense(J, np.diag(w))
+        self.assertMatchesDense(BkgJTerm(self.xb, self.g, metric=2.),
+                                2.*np.eye(self.g.N))
+
+    def testMinimizesToBkg(self):
+        J=BkgJTerm(self.xb, self.g, metric=1.+self.rng.rand(self.g.N))
+        J.minimize(np.zeros(self.g.N), testGrad=False, disp=False)
+        self.assertEqual(J.minimum.warnFlag, 0)
+        np.testing.assert_allclose(J.analysis, self.xb, atol=1e-5)
+
+#=====================================================================
+
+class TestWarmStart(unittest.TestCase):
+
+    N=20
+
+    def setUp(self):
+        self.rng=np.random.RandomState(0)
+        Q=np.linalg.qr(self.rng.randn(self.N, self.N))[0]
+        # ill-conditioned: the identity is a poor first inverse Hessian
+        self.A=np.dot(Q*np.logspace(0, 3, self.N), Q.T)
+
+    def minimum(self, J, minimizer, hessInv0=None):
+        J.minimize(np.zeros(self.N), testGrad=False, minimizer=minimizer,
+                    maxiter=500, hessInv0=hessInv0, disp=False)
+        return J.minimum
+
+    def testFewerCalls(self):
+        for minimizer in ('lbfgs', 'bfgs'):
+            # previous cycle: same curvature, other innovations
+            previous=self.minimum(makeQuadratic(self.A, 
+                                    self.rng.randn(self.N)), minimizer)
+            b=self.rng.randn(self.N)
+            J=makeQuadratic(self.A, b)
+            cold=self.minimum(J, minimizer)
+            warm=self.minimum(J, minimizer, hessInv0=previous)
+            self.assertEqual((cold.warnFlag, warm.warnFlag), (0, 0))
+            self.assertTrue(warm.fCalls<cold.fCalls, 
+                            (minimizer, warm.fCalls, cold.fCalls))
+            np.testing.assert_allclose(warm.xOpt, np.linalg.solve(self.A, b),
+                                        atol=1e-3)
+
+#=====================================================================
+
+class TestIterateStore(unittest.TestCase):
+
+    N=3
+
+    def fill(self, store, nIterates):
+        # iterate k is k*ones(N), up to nIterates iterates
+        for k in xrange(store.nIterates, nIterates):
+            store.append(k*np.ones(self.N))
+        return store
+
+    def assertKept(self, store, iterations):
+        np.testing.assert_array_equal(store.iterations(), iterations)
+        self.assertEqual(len(store), len(iterations))
+        np.testing.assert_array_equal(np.array(store), 
+                    np.outer(iterations, np.ones(self.N)))
+        np.testing.assert_array_equal(store[-1], iterations[-1])
+
+    def testEvery(self):
+        store=self.fill(IterateStore(self.N, 10, every=3), 10)
+        self.assertKept(store, [0, 3, 6, 9])
+        # the latest iterate is kept until the next one
+        self.fill(store, 11)
+        self.assertKept(store, [0, 3, 6, 9, 10])
+        self.assertEqual(store.nIterates, 11)
+        # beyond maxiter
+        self.assertKept(self.fill(IterateStore(self.N, 2), 7), range(7))
+
+    def testLast(self):
+        store=self.fill(IterateStore(self.N, 10, last=3), 2)
+        self.assertKept(store, [0, 1])
+        self.fill(store, 11)
+        self.assertKept(store, [8, 9, 10])
+        self.assertEqual([x[0] for x in store], [8, 9, 10])
+
+    def testMemmap(self):
+        tmpDir=tempfile.mkdtemp()
+        try:
+            fileName=os.path.join(tmpDir, 'iterates.dat')
+            store=self.fill(IterateStore(self.N, 4, every=2, 
+                                            fileName=fileName), 5)
+            store.flush()
+            self.assertKept(store, [0, 2, 4])
+            onDisk=np.memmap(fileName, dtype=float, mode='r')
+            np.testing.assert_array_equal(onDisk[:3*self.N].reshape(3, 
+                                            self.N), np.array(store))
+            # pickled in memory
+            copy=pickle.loads(pickle.dumps(store))
+            self.assertEqual(copy.fileName, None)
+            np.testing.assert_array_equal(np.array(copy), np.array(store))
+            self.assertRaises(RuntimeError, self.fill, store, 10)
+            del store, copy, onDisk
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testLastFinite(self):
+        store=self.fill(IterateStore(self.N, 10), 3)
+        store.append(np.nan*np.ones(self.N))
+        np.testing.assert_array_equal(store.lastFinite(), 2.)
+        np.testing.assert_array_equal(store.lastFinite(before=2), 1.)
+        store.append(np.array([1., np.inf, 1.]))
+        np.testing.assert_array_equal(store.lastFinite(before=1), 2.)
+        self.assertEqual(store.lastFinite(before=5), None)
+
+    def testMinimize(self):
+        g=PeriodicGrid(32)
+        J=make3DVar(g, np.random.RandomState(0))
+        store=IterateStore(g.N, 50, every=2)
+        J.minimize(np.zeros(g.N), retall=store, testGrad=False, 
+                    disp=False)
+        self.assertTrue(J.minimum.allvecs is store)
+        its=store.iterations()
+        self.assertEqual(its[0], 0)
+        self.assertTrue(np.all(its[1:-1]%2==0))
+        self.assertEqual(its[-1], store.nIterates-1)
+        np.testing.assert_array_equal(store[0], 0.)
+        np.testing.assert_allclose(store[-1], J.minimum.xOpt)
+        # non finite minimum: analysis from the last finite iterate
+        J.minimum.gOpt=np.nan*J.minimum.gOpt
+        J.createAnalysis()
+        np.testing.assert_array_equal(J.analysis, store[-2])
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import numpy as np
+from pseudoSpec1D import PeriodicGrid
+from dVar import StaticObs, obsOp_Coord, obsOp_Coord_Adj, \
+                    PrecondStaticObsJTerm, HessianEigen, \
+                    B_sqrt_isoHomo_op, B_sqrt_isoHomo_op_Adj, \
+                    make_BisoHomo_args
+
+#   Ritz pairs of the 'cg' (Lanczos) minimizer on a quadratic
+#   preconditioned 3D-Var cost: they must be eigenpairs of the
+#   Hessian, and warm started minimizations must compose every
+#   preconditioning level.
+
+class TestLanczosRitzPairs(unittest.TestCase):
+
+    def setUp(self):
+        self.g=PeriodicGrid(64)
+        self.rng=np.random.RandomState(0)
+        self.obs=self.staticObs(0.05)
+        self.args=make_BisoHomo_args(self.g, 5., 0.3)
+        self.xb=self.rng.randn(self.g.N)
+
+    def staticObs(self, sig):
+        idx=np.sort(self.rng.choice(self.g.N, 20, replace=False))
+        return StaticObs(self.g.x[idx], self.rng.randn(20),
+                            obsOp_Coord, obsOp_Coord_Adj,
+                            metric=1./sig**2)
+
+    def jTerm(self, obs=None):
+        if obs is None:
+            obs=self.obs
+        return PrecondStaticObsJTerm(obs, self.g, self.xb,
+                                    B_sqrt_isoHomo_op,
+                                    B_sqrt_isoHomo_op_Adj, self.args)
+
+    def minimizeCG(self, J, hessInv0=None):
+        J.minimize(testGrad=False, minimizer='cg', maxiter=200,
+                    hessInv0=hessInv0, disp=False)
+        return J.minimum
+
+    def testEigenpairs(self):
+        J=self.jTerm()
+        minimum=self.minimizeCG(J)
+        E=minimum.BOpt
+        self.assertTrue(isinstance(E, HessianEigen))
+        self.assertTrue(E.k>0)
+        self.assertTrue(np.all(E.eigVals>1.))
+        # orthonormal eigenvectors
+        np.testing.assert_allclose(np.dot(E.eigVecs, E.eigVecs.T),
+                                    np.eye(E.k), atol=1e-8)
+        # Hessian products as gradient differences (quadratic cost)
+        g0=J.gradJ(np.zeros(self.g.N))
+        for lam, v in zip(E.eigVals, E.eigVecs):
+            Hv=J.gradJ(v)-g0
+            self.assertTrue(np.linalg.norm(Hv-lam*v)<=1e-6*lam)
+
+    def testMinimumMatchesLBFGS(self):
+        J=self.jTerm()
+        J.minimize(testGrad=False, minimizer='lbfgs', maxiter=500,
+                    disp=False)
+        ref=J.minimum.xOpt
+        minimum=self.minimizeCG(self.jTerm())
+        self.assertTrue(np.abs(minimum.xOpt-ref).max()
+                            <=1e-3*np.abs(ref).max())
+
+    def testWarmStartComposition(self):
+        # new observations at each cycle: a new Hessian
+        E1=self.minimizeCG(self.jTerm()).BOpt
+        E2=self.minimizeCG(self.jTerm(self.staticObs(0.02)), 
+                            hessInv0=E1).BOpt
+        E3=self.minimizeCG(self.jTerm(self.staticObs(0.01)), 
+                            hessInv0=E2).BOpt
+        self.assertTrue(E2.base is E1)
+        self.assertTrue(E3.base is E2)
+        self.assertTrue(E3.base.base is E1)
+
+    def testNoHessInv(self):
+        J=self.jTerm()
+        J.minimize(testGrad=False, minimizer='cg', maxiter=200,
+                    storeHessInv=False, disp=False)
+        self.assertTrue(J.minimum.BOpt is None)
+
+if __name__=='__main__':
+    unittest.main()
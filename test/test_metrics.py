@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+from dVar import corrCovMetric, BandedCovMetric, CovMetric
+
+#   Correlated observation error metrics: the banded R built from the
+#   neighbour distances must match the band of the dense R
+
+class TestCorrCovMetric(unittest.TestCase):
+
+    def setUp(self):
+        self.rng=np.random.RandomState(0)
+
+    def testBandMatchesDense(self):
+        coord=np.arange(40)*0.25+0.05*self.rng.rand(40)
+        sig=0.5+self.rng.rand(40)
+        dense=corrCovMetric(coord, sig, 0.2)
+        for bandwidth in (0, 3, 39):
+            banded=corrCovMetric(coord, sig, 0.2, bandwidth=bandwidth)
+            self.assertTrue(isinstance(banded, BandedCovMetric))
+            ref=BandedCovMetric.fromDense(dense.R, bandwidth)
+            np.testing.assert_allclose(banded.RBand, ref.RBand)
+        # full band: same metric as the dense one
+        y=self.rng.randn(40)
+        np.testing.assert_allclose(banded.apply(y), dense.apply(y))
+        # band wider than R
+        wide=corrCovMetric(coord, sig, 0.2, bandwidth=60)
+        np.testing.assert_allclose(wide.RBand[:40], banded.RBand)
+        np.testing.assert_array_equal(wide.RBand[40:], 0.)
+
+    def testLargeBanded(self):
+        # a dense R would need n**2 floats
+        n=100000
+        coord=np.arange(n)*0.1
+        banded=corrCovMetric(coord, 1., 0.1, bandwidth=4)
+        self.assertEqual(banded.RBand.shape, (5, n))
+        y=np.ones(n)
+        self.assertEqual(banded.apply(y).shape, (n,))
+
+    def testUnsortedBanded(self):
+        self.assertRaises(ValueError, corrCovMetric, [1., 0., 2.], 1., 0.5,
+                            bandwidth=1)
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import unittest
+import StringIO
+import numpy as np
+from pseudoSpec1D import PeriodicGrid
+from dVar import StaticObs, TimeWindowObs, loadTWObs, obsOp_Coord, \
+                    obsOp_Coord_Adj, corrCovMetric, rndSampling, degrad, \
+                    makeRNG
+
+#   Adjoint (dot product) tests of the columnar TimeWindowObs
+#   observation operators: <y, H.X> = <H*.y, X> for each of the
+#   stacked code paths ('coord' gather, identity, generic per time),
+#   round trips of the pickled TimeWindowObs dumps and seeded sampling
+
+def genericOp(x, g, obsCoord):
+    return obsOp_Coord(x, g, obsCoord)
+
+def genericOpAdj(obsValues, g, obsCoord):
+    return obsOp_Coord_Adj(obsValues, g, obsCoord)
+
+def makeTWObs(g, rng, times=(0.25, 0.5, 1.), nObs=8, correlated=True):
+    d_Obs={}
+    for k, t in enumerate(times):
+        idx=np.sort(rng.choice(g.N, nObs, replace=False))
+        if k==0 and correlated:
+            # correlated errors
+            metric=corrCovMetric(g.x[idx], 0.1, 5.)
+        else:
+            metric=1./0.1**2
+        d_Obs[t]=StaticObs(g.x[idx], rng.randn(nObs), obsOp_Coord,
+                            obsOp_Coord_Adj, metric=metric)
+    return TimeWindowObs(d_Obs)
+
+#=====================================================================
+
+class TestStackedObsOpAdjoint(unittest.TestCase):
+
+    def setUp(self):
+        self.g=PeriodicGrid(64)
+        self.rng=np.random.RandomState(0)
+        self.times=[0.25, 0.5, 1.]
+
+    def twObs(self, obsOp, obsOpAdj, nObs=10):
+        d_Obs={}
+        for t in self.times:
+            if obsOp==None:
+                coord=self.g
+                values=self.rng.randn(self.g.N)
+            else:
+                # repeated coordinates: the adjoint must accumulate
+                idx=self.rng.randint(0, self.g.N, nObs)
+                idx[1]=idx[0]
+                coord=self.g.x[idx]
+                values=self.rng.randn(nObs)
+            d_Obs[t]=StaticObs(coord, values, obsOp=obsOp,
+                                obsOpTLMAdj=obsOpAdj)
+        return TimeWindowObs(d_Obs)
+
+    def checkAdjoint(self, twObs):
+        X=self.rng.randn(twObs.nTimes, self.g.N)
+        y=self.rng.randn(twObs.nObs)
+        HX=twObs._stackedModelEquivalent(X, self.g)
+        HAdjy=twObs._stackedModelEquivalent_Adj(y, self.g)
+        self.assertEqual(HX.shape, (twObs.nObs,))
+        self.assertEqual(HAdjy.shape, X.shape)
+        self.assertAlmostEqual(np.dot(y, HX), np.sum(HAdjy*X), places=10)
+
+    def testCoord(self):
+        self.checkAdjoint(self.twObs(obsOp_Coord, obsOp_Coord_Adj))
+
+    def testIdentity(self):
+        self.checkAdjoint(self.twObs(None, None))
+
+    def testGeneric(self):
+        self.checkAdjoint(self.twObs(genericOp, genericOpAdj))
+
+    def testGenericMatchesCoord(self):
+        twCoord=self.twObs(obsOp_Coord, obsOp_Coord_Adj)
+        twGeneric=TimeWindowObs(dict((t, StaticObs(twCoord[t].coord,
+                                        twCoord[t].values, genericOp,
+                                        genericOpAdj))
+                                    for t in twCoord.times))
+        X=self.rng.randn(twCoord.nTimes, self.g.N)
+        y=self.rng.randn(twCoord.nObs)
+        np.testing.assert_allclose(
+                twGeneric._stackedModelEquivalent(X, self.g),
+                twCoord._stackedModelEquivalent(X, self.g))
+        np.testing.assert_allclose(
+                twGeneric._stackedModelEquivalent_Adj(y, self.g),
+                twCoord._stackedModelEquivalent_Adj(y, self.g))
+
+    def testCoordBeyondGrid(self):
+        dx=self.g.x[1]-self.g.x[0]
+        obs=StaticObs(np.array([self.g.x[-1]+0.5*dx]),
+                        np.zeros(1))
+        self.assertRaises(ValueError, obs.interpolate, self.g)
+
+#=====================================================================
+
+class TestTWObsDump(unittest.TestCase):
+
+    def setUp(self):
+        self.g=PeriodicGrid(32)
+        self.rng=np.random.RandomState(0)
+
+    def testTWObs(self):
+        twObs=makeTWObs(self.g, self.rng)
+        f=StringIO.StringIO()
+        twObs.dump(f)
+        f.seek(0)
+        twObs2=loadTWObs(f)
+        np.testing.assert_array_equal(twObs2.times, twObs.times)
+        np.testing.assert_array_equal(twObs2.stackedValues,
+                                        twObs.stackedValues)
+        np.testing.assert_allclose(twObs2.metric.dense(),
+                                    twObs.metric.dense())
+
+#=====================================================================
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.g=PeriodicGrid(32)
+
+    def testRndSampling(self):
+        for seed in (1, 0.25):
+            coord=rndSampling(self.g, 20, seed=seed)
+            np.testing.assert_array_equal(rndSampling(self.g, 20, 
+                                            seed=seed), coord)
+            self.assertEqual(len(np.unique(coord)), 20)
+            self.assertTrue(np.all(np.diff(coord)>0.))
+            self.assertTrue(coord[0]>=self.g.min())
+            self.assertTrue(coord[-1]<=self.g.max())
+            np.testing.assert_allclose(np.round(coord, 2), coord, atol=1e-9)
+        self.assertFalse(np.array_equal(rndSampling(self.g, 20, seed=2),
+                                        rndSampling(self.g, 20, seed=1)))
+        np.testing.assert_array_equal(
+                    rndSampling(self.g, 20, seed=makeRNG(1)),
+                    rndSampling(self.g, 20, seed=1))
+        # every admissible position
+        coord=rndSampling(self.g, 3, precision=0, xlim=(-2., 0.), seed=1)
+        np.testing.assert_array_equal(coord, [-2., -1., 0.])
+        self.assertRaises(ValueError, rndSampling, self.g, 4, precision=0,
+                            xlim=(-2., 0.))
+
+    def testDegrad(self):
+        signal=np.arange(10.)
+        noisy=degrad(signal, 1., 0.1, seed=3)
+        np.testing.assert_array_equal(degrad(signal, 1., 0.1, seed=3),
+                                        noisy)
+        self.assertEqual(noisy.shape, signal.shape)
+        self.assertTrue(np.all(np.abs(noisy-signal-1.)<1.))
+        self.assertFalse(np.array_equal(degrad(signal, 1., 0.1, seed=4),
+                                        noisy))
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+import numpy as np
+import pyKdV as kdv
+from dVar import StaticObs, TimeWindowObs, obsOp_Coord, obsOp_Coord_Adj, \
+                    B_sqrt_isoHomo_op, B_sqrt_isoHomo_op_Adj, \
+                    make_BisoHomo_args, PrecondTWObsJTerm, \
+                    IncrPrecondTWObsJTerm
+
+#   Preconditionned 4D-Var: the incremental (Gauss-Newton) outer loops
+#   must reach the minimum of the full nonlinear cost
+
+def make4DVar(g, rng, JClass=PrecondTWObsJTerm, nObs=8, sigObs=0.2):
+    param=kdv.Param(g)
+    model=kdv.kdvLauncher(param, dt=0.01)
+    tlm=kdv.kdvTLMLauncher(param)
+    d_Obs={}
+    for t in (0.25, 0.5, 1.):
+        idx=np.sort(rng.choice(g.N, nObs, replace=False))
+        d_Obs[t]=StaticObs(g.x[idx], rng.randn(nObs), obsOp_Coord,
+                            obsOp_Coord_Adj, metric=1./sigObs**2)
+    xb=0.1*rng.randn(g.N)
+    return JClass(TimeWindowObs(d_Obs), model, tlm, xb, B_sqrt_isoHomo_op,
+                    B_sqrt_isoHomo_op_Adj, make_BisoHomo_args(g, 5., 0.3))
+
+#=====================================================================
+
+class TestIncremental(unittest.TestCase):
+
+    def setUp(self):
+        self.g=kdv.PeriodicGrid(32)
+        self.full=make4DVar(self.g, np.random.RandomState(0))
+        self.incr=make4DVar(self.g, np.random.RandomState(0),
+                            JClass=IncrPrecondTWObsJTerm)
+
+    def testOuterLoopsConverge(self):
+        self.full.minimize(maxiter=200, testGrad=False, disp=False)
+        self.incr.minimize(maxiter=200, nOuter=5, testGrad=False,
+                            disp=False)
+        JOpt=self.full.minimum.fOpt
+        outerJ=self.incr.outerJ
+        self.assertEqual(len(outerJ), 5)
+        self.assertEqual(len(self.incr.outerMinima), 5)
+        # J(x_k) of the full cost decreases towards its minimum
+        self.assertTrue(np.all(np.diff(outerJ)<=1e-6*JOpt))
+        self.assertTrue(outerJ[0]-JOpt>1e-2*JOpt)
+        np.testing.assert_allclose(outerJ[-1], JOpt, rtol=1e-6)
+        xiOpt=self.incr.minimum.xOpt
+        np.testing.assert_allclose(self.full.J(xiOpt), JOpt, rtol=1e-6)
+        np.testing.assert_allclose(self.incr.xi2x(xiOpt),
+                            self.full.analysis, atol=1e-3)
+
+if __name__=='__main__':
+    unittest.main()
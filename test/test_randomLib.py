@@ -0,0 +1,91 @@
+import unittest
+import numpy as np
+from pseudoSpec1D import PeriodicGrid
+from dVar import spawnRNGs, makeRNG, RunningStats, errStr_isoHomo, \
+                    errEnsGen_isoHomo, sample_err_isoHomo
+
+#   Seeded random streams: a given seed gives the same draws whatever
+#   the process or order consuming the streams, and the global numpy
+#   random state is left alone
+
+class TestSpawnRNGs(unittest.TestCase):
+
+    def testReproducible(self):
+        for seed in (1, 0.25):
+            draws=[rng.standard_normal(5) for rng in spawnRNGs(seed, 3)]
+            again=[rng.standard_normal(5) for rng in spawnRNGs(seed, 3)]
+            np.testing.assert_array_equal(draws, again)
+            # distinct streams
+            self.assertFalse(np.allclose(draws[0], draws[1]))
+        other=[rng.standard_normal(5) for rng in spawnRNGs(2, 3)]
+        self.assertFalse(np.allclose(other, draws))
+
+    def testStreamOnlyDependsOnIndex(self):
+        few=spawnRNGs(7, 2)
+        many=spawnRNGs(7, 5)
+        # consumed in another order
+        lastFirst=[rng.standard_normal(4) for rng in many[::-1]][::-1]
+        for i in xrange(2):
+            np.testing.assert_array_equal(few[i].standard_normal(4),
+                                            lastFirst[i])
+
+    def testMakeRNG(self):
+        rng=makeRNG(3)
+        self.assertTrue(makeRNG(rng) is rng)
+        np.testing.assert_array_equal(makeRNG(3).standard_normal(4),
+                                        rng.standard_normal(4))
+
+#=====================================================================
+
+class TestErrorEnsembles(unittest.TestCase):
+
+    def setUp(self):
+        self.g=PeriodicGrid(32)
+
+    def ensemble(self, seed, chunkSize):
+        return np.concatenate(list(errEnsGen_isoHomo(self.g, 5., nRlz=25,
+                                    chunkSize=chunkSize, seed=seed)))
+
+    def testChunkedEnsemble(self):
+        chunks=list(errEnsGen_isoHomo(self.g, 5., nRlz=25, chunkSize=10,
+                                        seed=1))
+        self.assertEqual([len(c) for c in chunks], [10, 10, 5])
+        ens=np.concatenate(chunks)
+        self.assertEqual(ens.shape, (25, self.g.N))
+        np.testing.assert_array_equal(self.ensemble(1, 10), ens)
+        self.assertFalse(np.allclose(self.ensemble(2, 10), ens))
+
+    def testSampleReproducible(self):
+        mean, std=sample_err_isoHomo(self.g, 5., nRlz=50, std=True,
+                                        chunkSize=20, seed=3)
+        mean2, std2=sample_err_isoHomo(self.g, 5., nRlz=50, std=True,
+                                        chunkSize=20, seed=3)
+        np.testing.assert_array_equal(mean, mean2)
+        np.testing.assert_array_equal(std, std2)
+
+    def testGlobalStateUntouched(self):
+        np.random.seed(0)
+        ref=np.random.rand(3)
+        np.random.seed(0)
+        errStr_isoHomo(self.g, 5., seed=1)
+        list(errEnsGen_isoHomo(self.g, 5., nRlz=5, seed=1))
+        np.testing.assert_array_equal(np.random.rand(3), ref)
+        np.testing.assert_array_equal(errStr_isoHomo(self.g, 5., seed=1),
+                                        errStr_isoHomo(self.g, 5., seed=1))
+
+#=====================================================================
+
+class TestRunningStats(unittest.TestCase):
+
+    def testChunkedMatchesNumpy(self):
+        X=np.random.RandomState(0).randn(103, 6)
+        stats=RunningStats()
+        for i in xrange(0, len(X), 25):
+            stats.update(X[i:i+25])
+        self.assertEqual(stats.n, 103)
+        np.testing.assert_allclose(stats.mean, X.mean(axis=0))
+        np.testing.assert_allclose(stats.var(), X.var(axis=0))
+        np.testing.assert_allclose(stats.std(), X.std(axis=0))
+
+if __name__=='__main__':
+    unittest.main()
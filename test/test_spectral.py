@@ -0,0 +1,180 @@
+import unittest
+import numpy as np
+from pseudoSpec1D import PeriodicGrid
+from dVar import c2r, r2c, r2c_Adj, specFilt, SpectralFilter, BIsoHomo, \
+                    fCorr_isoHomo, \
+                    make_BisoHomo_args, B_sqrt_isoHomo_op, \
+                    B_sqrt_isoHomo_op_Adj, B_isoHomo_op, \
+                    B_sqrt_isoHomo_inv_op, B_sqrt_isoHomo_inv_op_Adj, \
+                    B_isoHomo_inv_op
+
+#   Vectorized canonical injections, spectral filter and isotropic-
+#   homogeneous B operators against the loop versions they replaced
+#   (reproduced below), for odd and even N, single and batched input
+
+def loopC2r(csp):
+    N=len(csp)-1
+    rsp=np.zeros(N+1)
+    rsp[0]=csp[0].real
+    for i in xrange(1,N/2+1):
+        rsp[2*i-1]    =2.*csp[i].real
+        rsp[2*i]      =2.*csp[i].imag
+    return rsp
+
+def loopR2c(rsp):
+    N=len(rsp)-1
+    csp=np.zeros(N+1, dtype=complex)
+    csp[0]=rsp[0]
+    for i in xrange(1,N/2+1):
+        csp[i]     =0.5*(rsp[2*i-1]+1j*rsp[2*i])
+        csp[N-i+1]   =0.5*(rsp[2*i-1]-1j*rsp[2*i])
+    return csp
+
+def loopR2c_Adj(csp):
+    N=len(csp)-1
+    rsp=np.zeros(N+1)
+    for i in xrange(1, N/2+1):
+        rsp[2*i-1]  =csp[i].real
+        rsp[2*i]    =csp[i].imag
+    rsp[0]=csp[0].real
+    return rsp
+
+def loopSpecFilt(x, Ntrc):
+    N=len(x)
+    tf=np.fft.fft(x)
+    for i in xrange(N):
+        if i<=(N-1)/2:
+            m=i
+        else:
+            m=i-N
+        if np.abs(m)>Ntrc:
+            tf[i]=0.
+    return np.fft.ifft(tf).real
+
+def loopRCTilde_sqrt(g, fCorr):
+    rFTilde=g.N*loopC2r(np.fft.fft(fCorr))
+    rCTilde=np.zeros(g.N)
+    rCTilde[0]=np.abs(rFTilde[0])
+    for i in xrange(1, (g.N-1)/2+1):
+        rCTilde[2*i-1]=np.abs(rFTilde[2*i-1])
+        rCTilde[2*i]=np.abs(rFTilde[2*i-1])
+    return np.sqrt(rCTilde)
+
+def loopB_sqrt(xi, sig, rCTilde_sqrt):
+    return np.fft.ifft(loopR2c(rCTilde_sqrt*xi)).real*sig
+
+def loopB_sqrt_Adj(x, sig, rCTilde_sqrt):
+    xiC=np.fft.fft(x*sig)/len(x)
+    return rCTilde_sqrt*loopR2c_Adj(xiC)
+
+def pseudoInv(w):
+    # the loop versions divided by the zero weight of the Nyquist
+    # mode (even N: nan); the vectorized ones pseudo-invert it
+    wInv=np.zeros(len(w))
+    wInv[w<>0.]=1./w[w<>0.]
+    return wInv
+
+def loopB_sqrt_inv(x, sig, rCTilde_sqrt):
+    N=len(x)
+    xiR=loopR2c_Adj(np.fft.fft(x/sig))
+    xiR2=np.zeros(N)
+    xiR2[0]=xiR[0]
+    for i in xrange(1,N):
+        xiR2[i]=2.*xiR[i]
+    return xiR2*pseudoInv(rCTilde_sqrt)
+
+def loopB_sqrt_inv_Adj(xi, sig, rCTilde_sqrt):
+    N=len(xi)
+    xiR2=xi*pseudoInv(rCTilde_sqrt)
+    xiR=np.zeros(N)
+    for i in xrange(1,N):
+        xiR[i]=2.*xiR2[i]
+    xiR[0]=xiR2[0]
+    return np.fft.ifft(loopR2c(xiR)).real*N/sig
+
+def rowWise(func, X, *args):
+    return np.array([func(x, *args) for x in X])
+
+#=====================================================================
+
+class TestVectorizedEquivalence(unittest.TestCase):
+
+    sizes=(16, 17)
+    nMembers=4
+
+    def setUp(self):
+        self.rng=np.random.RandomState(0)
+
+    def batch(self, N, complexValued=False):
+        X=self.rng.randn(self.nMembers, N)
+        if complexValued:
+            X=X+1j*self.rng.randn(self.nMembers, N)
+        return X
+
+    def assertRowWise(self, vectorized, loop, X, *args):
+        np.testing.assert_allclose(vectorized(X[0], *args), 
+                                    loop(X[0], *args),
+                                    rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(vectorized(X, *args),
+                                    rowWise(loop, X, *args),
+                                    rtol=1e-12, atol=1e-12)
+
+    def testInjections(self):
+        for N in self.sizes:
+            C=self.batch(N, complexValued=True)
+            self.assertRowWise(c2r, loopC2r, C)
+            self.assertRowWise(r2c_Adj, loopR2c_Adj, C)
+            self.assertRowWise(r2c, loopR2c, self.batch(N))
+
+    def testInjectionsOut(self):
+        C=self.batch(17, complexValued=True)
+        out=np.empty(C.shape)
+        self.assertTrue(c2r(C, out=out) is out)
+        np.testing.assert_allclose(out, rowWise(loopC2r, C))
+        # stale content overwritten
+        out=np.ones(C.shape, dtype=complex)
+        r2c(C.real, out=out)
+        np.testing.assert_allclose(out, rowWise(loopR2c, C.real))
+
+    def testSpectralFilter(self):
+        for N in self.sizes:
+            X=self.batch(N)
+            for Ntrc in (0, 3, N/2-1, N/2, N):
+                np.testing.assert_allclose(SpectralFilter(N, Ntrc)(X),
+                                    rowWise(loopSpecFilt, X, Ntrc),
+                                    atol=1e-12)
+                np.testing.assert_allclose(specFilt(X[0], Ntrc),
+                                    loopSpecFilt(X[0], Ntrc), atol=1e-12)
+
+    def testBIsoHomo(self):
+        for N in self.sizes:
+            g=PeriodicGrid(N)
+            sig, rCTilde_sqrt=make_BisoHomo_args(g, 5., 0.3)
+            np.testing.assert_allclose(rCTilde_sqrt,
+                    loopRCTilde_sqrt(g, fCorr_isoHomo(g, 5.)), rtol=1e-12)
+            sig=sig*(1.+0.5*self.rng.rand(N))
+            B=BIsoHomo(sig, rCTilde_sqrt)
+            X=self.batch(N)
+            for vectorized, loop in ((B.sqrt, loopB_sqrt),
+                                    (B.sqrt_adj, loopB_sqrt_Adj),
+                                    (B.inv_sqrt, loopB_sqrt_inv),
+                                    (B.inv_sqrt_adj, loopB_sqrt_inv_Adj)):
+                np.testing.assert_allclose(vectorized(X),
+                        rowWise(loop, X, sig, rCTilde_sqrt),
+                        rtol=1e-10, atol=1e-12)
+            np.testing.assert_allclose(B.apply(X), rowWise(lambda x:
+                    loopB_sqrt(loopB_sqrt_Adj(x, sig, rCTilde_sqrt),
+                                sig, rCTilde_sqrt), X), atol=1e-12)
+            # the functional operators
+            for func, loop in ((B_sqrt_isoHomo_op, loopB_sqrt),
+                        (B_sqrt_isoHomo_op_Adj, loopB_sqrt_Adj),
+                        (B_sqrt_isoHomo_inv_op, loopB_sqrt_inv),
+                        (B_sqrt_isoHomo_inv_op_Adj, loopB_sqrt_inv_Adj)):
+                self.assertRowWise(func, loop, X, sig, rCTilde_sqrt)
+            np.testing.assert_allclose(B_isoHomo_op(X, sig, rCTilde_sqrt),
+                                        B.apply(X), atol=1e-12)
+            np.testing.assert_allclose(B_isoHomo_inv_op(X, sig,
+                                        rCTilde_sqrt), B.inv(X), rtol=1e-10)
+
+if __name__=='__main__':
+    unittest.main()